@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""Wall time, API calls and peak memory of haunts commands, on synthetic data and offline.
+
+sync (``sync_report``), report and read (``extract_events``) run against a fake Google API
+(see fake_google.py), on month sheets of every size given, with a simulated latency for
+every HTTP request. Peak memory is measured with tracemalloc, which slows down the run:
+use --no-memory for more accurate times.
+
+Usage: python benchmarks/commands.py [--rows 100,1000,10000] [--latency MS] [--no-memory]
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from fake_google import USER_EMAIL, FakeGoogle, synthetic_config, synthetic_events, synthetic_month
+
+# Measure the working tree, not an installed haunts
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from googleapiclient.discovery import build_from_document  # noqa: E402
+
+from haunts import api, services  # noqa: E402
+from haunts.profiles import Profile, activate  # noqa: E402
+
+PROJECTS = ["Project A", "Project B", "Project C", "Project D", "Project E"]
+
+SETTINGS = f"""[haunts]
+CONTROLLER_SHEET_DOCUMENT_ID=benchmark
+USER_EMAIL={USER_EMAIL}
+TIMEZONE=Etc/GMT
+SHEETS_READ_QUOTA=1000000000
+SHEETS_WRITE_QUOTA=1000000000
+CALENDAR_QUOTA=1000000000
+"""
+
+
+def setup(config_dir, fake):
+    """Profile of a run, with API clients built on the fake API."""
+    profile = Profile(config_dir)
+    profile.parser.read_string(SETTINGS)
+    for api_name, api_version, token_file in (
+        ("sheets", "v4", "sheets-token.json"),
+        ("calendar", "v3", "calendars-token.json"),
+    ):
+        document = services.get_discovery_document(config_dir, api_name, api_version)
+        services.services_cache[(api_name, api_version, str(config_dir / token_file))] = (
+            build_from_document(document, http=fake)
+        )
+    return profile
+
+
+def run_sync(config_dir):
+    from haunts.spreadsheet import sync_report
+
+    sync_report(config_dir, "May")
+
+
+def run_report(config_dir):
+    from haunts.report import report
+
+    report(config_dir, "May")
+
+
+def run_read(config_dir):
+    from haunts.download import extract_events
+
+    extract_events(config_dir, "May", from_day="2024-05-01", to_day="2024-05-31")
+
+
+COMMANDS = {"sync": run_sync, "report": run_report, "read": run_read}
+
+
+def measure(command, rows, latency, memory):
+    fake = FakeGoogle(
+        {"May": synthetic_month(rows, PROJECTS), "config": synthetic_config(PROJECTS)},
+        {
+            f"calendar{index}@example.com": synthetic_events(
+                f"calendar{index}@example.com", 31, max(1, rows // 31 // len(PROJECTS))
+            )
+            for index in range(len(PROJECTS))
+        },
+        latency=latency,
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        config_dir = Path(tmp)
+        profile = setup(config_dir, fake)
+        api.buckets.clear()
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with activate(profile), contextlib.redirect_stdout(io.StringIO()):
+            COMMANDS[command](config_dir)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        services.services_cache.clear()
+    return elapsed, peak, fake.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--rows", default="100,1000,10000", help="comma separated sizes of month sheets"
+    )
+    parser.add_argument("--latency", type=float, default=20, help="latency of requests (ms)")
+    parser.add_argument(
+        "--commands", default=",".join(COMMANDS), help="comma separated commands to run"
+    )
+    parser.add_argument("--no-memory", action="store_true", help="do not measure peak memory")
+    options = parser.parse_args()
+
+    print(f"{'command':<8} {'rows':>7} {'time':>9} {'peak':>10}  API calls")
+    for command in options.commands.split(","):
+        for rows in [int(size) for size in options.rows.split(",")]:
+            elapsed, peak, calls = measure(
+                command, rows, options.latency / 1000, not options.no_memory
+            )
+            memory = f"{peak / 1024 / 1024:7.1f} MB" if peak is not None else f"{'-':>10}"
+            calls = ", ".join(f"{endpoint} {count}" for endpoint, count in sorted(calls.items()))
+            print(f"{command:<8} {rows:>7} {elapsed:>8.2f}s {memory}  {calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Fake Google Sheets and Calendar APIs, answering haunts requests from synthetic data.
+
+FakeGoogle has the httplib2.Http interface used by API clients: services built on it send
+real (serialized) requests, including batch requests, without any network access.
+Every request sleeps for the simulated latency, and is counted by endpoint.
+"""
+
+import collections
+import datetime
+import json
+import re
+import threading
+import time
+import urllib.parse
+from email.parser import FeedParser
+
+import httplib2
+
+# 2024-05-01, as a Google Sheets serial number
+MAY_2024 = 45413
+USER_EMAIL = "user@example.com"
+HEADERS = [
+    "Date",
+    "Start time",
+    "Spent",
+    "Project",
+    "Activity",
+    "Details",
+    "Event id",
+    "Link",
+    "Action",
+]
+PAGE_SIZE = 250
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def parse_range(a1_range):
+    """Sheet name, first/last column index and first/last row index (None if open)."""
+    sheet, _, cells = a1_range.partition("!")
+    start, _, end = cells.partition(":")
+    start_col, start_row = re.match(r"([A-Z]*)(\d*)", start).groups()
+    end_col, end_row = re.match(r"([A-Z]*)(\d*)", end or start).groups()
+    return (
+        sheet,
+        column_index(start_col) if start_col else 0,
+        column_index(end_col) if end_col else None,
+        int(start_row) - 1 if start_row else 0,
+        int(end_row) - 1 if end_row else None,
+    )
+
+
+def trim(values):
+    """Remove empty cells at the end of rows, and empty rows at the end (like the API does)."""
+    values = [list(row) for row in values]
+    for row in values:
+        while row and row[-1] in ("", None):
+            row.pop()
+    while values and not values[-1]:
+        values.pop()
+    return values
+
+
+def synthetic_month(rows, projects, new_ratio=0.1, delete_ratio=0.01):
+    """Rows of a May 2024 month sheet (headers included).
+
+    Most rows are already synced (action "I"), new_ratio of them have no action (to be synced)
+    and delete_ratio of them are flagged for deletion.
+    """
+    values = [list(HEADERS)]
+    per_day = max(1, rows // 31)
+    new_every = round(1 / new_ratio) if new_ratio else 0
+    delete_every = round(1 / delete_ratio) if delete_ratio else 0
+    for index in range(rows):
+        if new_every and index % new_every == 0:
+            action, event_id = "", ""
+        elif delete_every and index % delete_every == 1:
+            action, event_id = "D", f"ev{index}"
+        else:
+            action, event_id = "I", f"ev{index}"
+        values.append(
+            [
+                MAY_2024 + min(index // per_day, 30),
+                "",
+                (index % 4 + 1) / 2,
+                projects[index % len(projects)],
+                f"Activity {index % 97}",
+                f"Details of row {index}" if index % 3 else "",
+                event_id,
+                "=HYPERLINK(\"https://calendar.example.com\";\"open\")" if event_id else "",
+                action,
+            ]
+        )
+    return values
+
+
+def synthetic_config(projects):
+    return [["Calendar id", "Alias", "Linked"]] + [
+        [f"calendar{index}@example.com", project] for index, project in enumerate(projects)
+    ]
+
+
+def synthetic_events(calendar_id, days, per_day):
+    """Events of a calendar: per_day events a day, every day from 2024-05-01 on."""
+    events = []
+    for day in range(days):
+        date = datetime.date(2024, 5, 1) + datetime.timedelta(days=day)
+        for index in range(per_day):
+            start = datetime.datetime.combine(date, datetime.time(8 + index % 10))
+            end = start + datetime.timedelta(hours=1)
+            events.append(
+                {
+                    "id": f"{calendar_id.split('@')[0]}-{day}-{index}",
+                    "summary": f"Meeting {index}",
+                    "description": "Synthetic event",
+                    "start": {"dateTime": start.isoformat() + "+00:00"},
+                    "end": {"dateTime": end.isoformat() + "+00:00"},
+                    "creator": {"email": USER_EMAIL},
+                    "htmlLink": f"https://calendar.example.com/{calendar_id}/{day}/{index}",
+                }
+            )
+    return events
+
+
+class FakeGoogle:
+    """Answer Sheets and Calendar requests from a synthetic spreadsheet and calendars."""
+
+    def __init__(self, sheets, calendars, latency=0.0):
+        self.sheets = sheets
+        self.calendars = calendars
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    # httplib2.Http interface
+    def request(
+        self,
+        uri,
+        method="GET",
+        body=None,
+        headers=None,
+        redirections=5,
+        connection_type=None,
+    ):
+        if self.latency:
+            time.sleep(self.latency)
+        headers = headers or {}
+        if "/batch/" in uri:
+            self.count("calendar.batch")
+            return self.batch(body, headers)
+        status, content = self.dispatch(method, uri, body)
+        return self.response(status), content
+
+    @staticmethod
+    def response(status, content_type="application/json"):
+        return httplib2.Response({"status": str(status), "content-type": content_type})
+
+    def dispatch(self, method, uri, body):
+        url = urllib.parse.urlsplit(uri)
+        path = urllib.parse.unquote(url.path)
+        query = urllib.parse.parse_qs(url.query)
+        data = json.loads(body) if body else None
+        match = re.search(r"/v4/spreadsheets/[^/:]+(.*)$", path)
+        if match:
+            return self.sheets_request(method, match.group(1), query, data)
+        match = re.search(r"/calendar/v3/calendars/([^/]+)/events(?:/([^/]+))?$", path)
+        if match:
+            return self.calendar_request(method, match.group(1), match.group(2), query, data)
+        return 404, b'{"error": {"code": 404, "message": "Not found"}}'
+
+    # Sheets API
+    def read_range(self, a1_range, major_dimension="ROWS"):
+        sheet, first_col, last_col, first_row, last_row = parse_range(a1_range)
+        rows = self.sheets[sheet][first_row : None if last_row is None else last_row + 1]
+        values = trim(row[first_col : None if last_col is None else last_col + 1] for row in rows)
+        if major_dimension == "COLUMNS":
+            width = max((len(row) for row in values), default=0)
+            values = trim(
+                [row[index] if index < len(row) else "" for row in values]
+                for index in range(width)
+            )
+        return {"range": a1_range, "majorDimension": major_dimension, "values": values}
+
+    def sheets_request(self, method, path, query, data):
+        if path == "/values:batchGet":
+            self.count("sheets.values.batchGet")
+            dimension = query.get("majorDimension", ["ROWS"])[0]
+            ranges = [self.read_range(a1_range, dimension) for a1_range in query["ranges"]]
+            return 200, json.dumps({"valueRanges": ranges}).encode()
+        if path == "/values:batchUpdate":
+            self.count("sheets.values.batchUpdate")
+            return 200, json.dumps({"totalUpdatedCells": len(data["data"])}).encode()
+        if path.startswith("/values/") and path.endswith(":append"):
+            self.count("sheets.values.append")
+            return 200, json.dumps({"updates": {"updatedRows": len(data["values"])}}).encode()
+        if path.startswith("/values/"):
+            self.count("sheets.values.get")
+            return 200, json.dumps(self.read_range(path[len("/values/") :])).encode()
+        if path == ":batchUpdate":
+            self.count("sheets.batchUpdate")
+            return 200, b"{}"
+        if path == "":
+            self.count("sheets.get")
+            sheets = [
+                {"properties": {"sheetId": index, "title": title}}
+                for index, title in enumerate(self.sheets)
+            ]
+            return 200, json.dumps({"sheets": sheets}).encode()
+        return 404, b'{"error": {"code": 404, "message": "Not found"}}'
+
+    # Calendar API
+    def calendar_request(self, method, calendar_id, event_id, query, data):
+        if method == "GET" and event_id is None:
+            self.count("calendar.events.list")
+            time_min = query.get("timeMin", [""])[0][:10]
+            time_max = query.get("timeMax", ["9999"])[0][:10]
+            events = [
+                event
+                for event in self.calendars.get(calendar_id, [])
+                if time_min <= event["start"]["dateTime"][:10] <= time_max
+            ]
+            offset = int(query.get("pageToken", ["0"])[0])
+            page = {"items": events[offset : offset + PAGE_SIZE]}
+            if offset + PAGE_SIZE < len(events):
+                page["nextPageToken"] = str(offset + PAGE_SIZE)
+            return 200, json.dumps(page).encode()
+        if method == "POST":
+            self.count("calendar.events.insert")
+            with self.lock:
+                self.created += 1
+                new_id = f"new{self.created}"
+            event = {
+                **data,
+                "id": data.get("id", new_id),
+                "htmlLink": f"https://calendar.example.com/{calendar_id}/{new_id}",
+                "organizer": {"displayName": calendar_id},
+            }
+            return 200, json.dumps(event).encode()
+        if method == "DELETE":
+            self.count("calendar.events.delete")
+            return 204, b""
+        if method == "PATCH":
+            self.count("calendar.events.patch")
+            return 200, json.dumps({"id": event_id, **data}).encode()
+        return 404, b'{"error": {"code": 404, "message": "Not found"}}'
+
+    def batch(self, body, headers):
+        """Execute every request of a multipart batch, answering with a multipart response."""
+        parser = FeedParser()
+        parser.feed(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        parts = []
+        for part in parser.close().get_payload():
+            request_line, _, rest = part.get_payload().partition("\n")
+            method, path, _ = request_line.split(" ", 2)
+            _, _, request_body = rest.replace("\r\n", "\n").partition("\n\n")
+            status, content = self.dispatch(
+                method, f"https://www.googleapis.com{path}", request_body.strip() or None
+            )
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            parts.append(
+                "Content-Type: application/http\r\n"
+                f"Content-ID: {content_id}\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n"
+                f"{content.decode()}\r\n"
+            )
+        boundary = "batch_fake_boundary"
+        content = "".join(f"--{boundary}\r\n{part}" for part in parts) + f"--{boundary}--"
+        return (
+            self.response(200, f"multipart/mixed; boundary={boundary}"),
+            content.encode(),
+        )
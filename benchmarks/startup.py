@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Import time of the haunts CLI, for every command.
+
+``--version`` and ``--help`` are really executed, while for other commands the modules they
+import are measured (running them would need a configuration and Google APIs).
+Times come from ``python -X importtime`` and do not include interpreter startup (``site``).
+
+Usage: python benchmarks/startup.py [--repeat N] [--budget MS] [--top N]
+"""
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+# Measure the working tree, not an installed haunts
+ROOT = Path(__file__).resolve().parent.parent
+
+COMMAND_MODULES = "from haunts import calendars, credentials, snapshots, spreadsheet"
+
+COMMANDS = {
+    "--version": ["-m", "haunts.cli", "--version"],
+    "--help": ["-m", "haunts.cli", "--help"],
+    "sync": ["-c", f"import haunts.cli; {COMMAND_MODULES}"],
+    "report": ["-c", f"import haunts.cli; {COMMAND_MODULES}; import haunts.report"],
+    "read": ["-c", f"import haunts.cli; {COMMAND_MODULES}; import haunts.download"],
+}
+
+
+def parse_importtime(output):
+    """Return the total import time and self time of every module, in microseconds."""
+    total = 0
+    modules = {}
+    # Output is in post-order: imported modules come before the module importing them
+    children = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:") :].split("|")
+        level = len(name) - len(name.lstrip())
+        name = name.strip()
+        children[name] = int(self_time)
+        if level > 1:
+            continue
+        if name != "site":
+            total += int(cumulative)
+            modules.update(children)
+        children = {}
+    return total, modules
+
+
+def measure(args):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+    )
+    if result.returncode:
+        # Imports are measured anyway (for example, --version fails if haunts is not installed)
+        print(f"Warning: {' '.join(args)} exited with status {result.returncode}", file=sys.stderr)
+    return parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="runs per command (best is kept)")
+    parser.add_argument("--budget", type=float, help="fail if a command takes more (ms)")
+    parser.add_argument("--top", type=int, default=5, help="slowest modules to show")
+    options = parser.parse_args()
+
+    over_budget = []
+    for command, args in COMMANDS.items():
+        total, modules = min((measure(args) for _ in range(options.repeat)), key=lambda m: m[0])
+        print(f"{command:<10} {total / 1000:8.1f} ms  ({len(modules)} modules)")
+        slowest = sorted(modules.items(), key=lambda module: module[1], reverse=True)
+        for name, self_time in slowest[: options.top]:
+            print(f"{'':<10} {self_time / 1000:8.1f} ms  {name}")
+        if options.budget and total / 1000 > options.budget:
+            over_budget.append(command)
+
+    if over_budget:
+        print(f"Over the budget of {options.budget} ms: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Execution of Google API requests.
+
+Every request is paced by a token bucket sized on the per-minute quota of the API it targets,
+and retried with exponential backoff when Google asks to slow down or has a temporary failure.
+"""
+
+import email.utils
+import random
+import threading
+import time
+
+import click
+from googleapiclient.errors import HttpError
+
+from . import LOGGER
+from .ini import get
+from .metrics import metrics
+
+# Quotas, with the .ini option to customize them and the default requests per minute
+SHEETS_READ = "sheets.read"
+SHEETS_WRITE = "sheets.write"
+CALENDAR = "calendar"
+DRIVE = "drive"
+QUOTAS = {
+    SHEETS_READ: ("SHEETS_READ_QUOTA", 60),
+    SHEETS_WRITE: ("SHEETS_WRITE_QUOTA", 60),
+    CALENDAR: ("CALENDAR_QUOTA", 600),
+    DRIVE: ("DRIVE_QUOTA", 600),
+}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Calendar API reports rate limits as 403 errors
+RETRY_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+MAX_BACKOFF = 64
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Allow up to ``per_minute`` requests in a minute, refilling tokens continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.rate = self.capacity / 60
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        """Take tokens from the bucket, waiting for them when needed.
+
+        Returns the time spent waiting.
+        """
+        cost = min(cost, self.capacity)
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return waited
+                delay = (cost - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def get_bucket(quota):
+    with buckets_lock:
+        bucket = buckets.get(quota)
+        if bucket is None:
+            option, default = QUOTAS[quota]
+            bucket = buckets[quota] = TokenBucket(int(get(option, default)))
+        return bucket
+
+
+def is_retryable(err):
+    if err.status_code in RETRY_STATUSES:
+        return True
+    if err.status_code == 403:
+        details = err.error_details if isinstance(err.error_details, list) else []
+        return any(
+            isinstance(detail, dict) and detail.get("reason") in RETRY_REASONS
+            for detail in details
+        )
+    return False
+
+
+def retry_delay(err, attempt):
+    """Seconds to wait before retrying a failed request.
+
+    The Retry-After header is honored when provided, otherwise an exponential backoff
+    with random jitter is used.
+    """
+    retry_after = err.resp.get("retry-after") if err.resp is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            if retry_date:
+                return max(0.0, retry_date.timestamp() - time.time())
+    return min(MAX_BACKOFF, 2**attempt + random.random())
+
+
+def pause(err, attempt, delay=None):
+    """Wait before retrying a failed request (for delay seconds, when provided)."""
+    if delay is None:
+        delay = retry_delay(err, attempt)
+    click.echo(
+        f"Google API answered with status {err.status_code}: "
+        f"haunts will now pause for {delay:.1f}s ⏲…"
+    )
+    time.sleep(delay)
+    return delay
+
+
+def max_retries():
+    return int(get("API_MAX_RETRIES", 5))
+
+
+def endpoint_name(request, quota):
+    """Name of the API method called by a request, like "sheets.spreadsheets.values.get".
+
+    Batch requests are named after their quota, like "calendar.batch".
+    """
+    return getattr(request, "methodId", None) or f"{quota}.batch"
+
+
+def execute(request, quota, cost=1):
+    """Execute a request (or a batch of ``cost`` requests) on the given quota."""
+    bucket = get_bucket(quota)
+    endpoint = endpoint_name(request, quota)
+    attempt = 0
+    while True:
+        waited = bucket.acquire(cost)
+        if waited:
+            LOGGER.debug(f"Waited {waited:.2f}s for {quota} quota")
+            metrics.add_quota_wait(endpoint, waited)
+        try:
+            with metrics.request(endpoint):
+                return request.execute()
+        except HttpError as err:
+            if not is_retryable(err) or attempt >= max_retries():
+                raise
+            metrics.add_retry(endpoint, pause(err, attempt))
+            attempt += 1
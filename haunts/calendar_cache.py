@@ -0,0 +1,175 @@
+"""Local copies of calendars, kept current with the incremental sync of the Calendar API.
+
+The first time a calendar is read all its events in a range of months are listed, then only
+events changed since the previous read are downloaded, using the sync token returned by
+the last request. The range grows (with a new full listing) when dates outside of it are read.
+Copies are stored in the "calendar-cache" folder inside the configuration directory, one JSON
+file per calendar.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+
+from dateutil import parser
+from googleapiclient.errors import HttpError
+
+from . import LOGGER
+from .calendars import day_range, list_events
+from .ini import get
+
+
+def event_bounds(event, tz_obj):
+    """Start and end of an event, as datetimes with a timezone."""
+    bounds = []
+    for key in ("start", "end"):
+        if "dateTime" in event[key]:
+            bounds.append(parser.isoparse(event[key]["dateTime"]))
+        else:
+            date = parser.isoparse(event[key]["date"])
+            bounds.append(date.replace(tzinfo=tz_obj))
+    return bounds
+
+
+def overlaps(event, tz_obj, start, end):
+    event_start, event_end = event_bounds(event, tz_obj)
+    return event_end > start and event_start < end
+
+
+class CalendarCache:
+    """Events of a calendar between two dates, and the token to update them.
+
+    time_min is the first day held, time_max the last one.
+    """
+
+    def __init__(self, config_dir, calendar_id):
+        self.calendar_id = calendar_id
+        self.path = config_dir / "calendar-cache"
+        key = hashlib.sha1(calendar_id.encode("utf-8")).hexdigest()
+        self.file = self.path / f"{key}.json"
+        self.time_min = None
+        self.time_max = None
+        self.sync_token = None
+        self.events = {}
+
+    def load(self):
+        try:
+            with open(self.file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            LOGGER.debug(f"No valid cache of calendar {self.calendar_id}")
+            return False
+        if data.get("timezone") != get("TIMEZONE", "Etc/GMT") or not data.get("time_max"):
+            # Event times are stored in the timezone they were read with
+            return False
+        self.time_min = datetime.date.fromisoformat(data["time_min"])
+        self.time_max = datetime.date.fromisoformat(data["time_max"])
+        self.sync_token = data["sync_token"]
+        self.events = data["events"]
+        return True
+
+    def save(self):
+        # Many threads or processes can write the same calendar: each one writes its own
+        # temporary file, then moves it in place
+        temporary = None
+        try:
+            self.path.mkdir(exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path, prefix=self.file.stem, suffix=".tmp", delete=False
+            ) as f:
+                temporary = f.name
+                json.dump(
+                    {
+                        "timezone": get("TIMEZONE", "Etc/GMT"),
+                        "time_min": self.time_min.isoformat(),
+                        "time_max": self.time_max.isoformat(),
+                        "sync_token": self.sync_token,
+                        "events": self.events,
+                    },
+                    f,
+                )
+            os.replace(temporary, self.file)
+        except OSError:
+            LOGGER.debug(f"Cannot write calendar cache at {self.file}")
+            if temporary:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+
+    def full_sync(self, events_service, time_min, time_max):
+        start, end = day_range(time_min, time_max)
+        events, self.sync_token = list_events(
+            events_service, self.calendar_id, timeMin=start.isoformat(), timeMax=end.isoformat()
+        )
+        self.time_min = time_min
+        self.time_max = time_max
+        self.events = {event["id"]: event for event in events}
+
+    def update(self, events_service, time_min, time_max):
+        """Bring the cache up to date, making sure it holds events from time_min to time_max."""
+        if (
+            not self.load()
+            or not self.sync_token
+            or time_min < self.time_min
+            or time_max > self.time_max
+        ):
+            LOGGER.debug(f"Full sync of calendar {self.calendar_id}")
+            self.full_sync(
+                events_service,
+                min(time_min, self.time_min or time_min),
+                max(time_max, self.time_max or time_max),
+            )
+        else:
+            try:
+                events, self.sync_token = list_events(
+                    events_service, self.calendar_id, syncToken=self.sync_token
+                )
+            except HttpError as err:
+                if err.status_code != 410:
+                    raise
+                # Sync token expired: start again
+                LOGGER.debug(f"Sync token of calendar {self.calendar_id} expired")
+                self.full_sync(events_service, self.time_min, self.time_max)
+            else:
+                LOGGER.debug(f"{len(events)} events changed in calendar {self.calendar_id}")
+                start, end = day_range(self.time_min, self.time_max)
+                tz_obj = start.tzinfo
+                for event in events:
+                    # Changes are not bounded: events out of the range are not kept
+                    if event.get("status") == "cancelled" or not overlaps(
+                        event, tz_obj, start, end
+                    ):
+                        self.events.pop(event["id"], None)
+                    else:
+                        self.events[event["id"]] = event
+        self.save()
+
+    def between(self, from_date, to_date):
+        """Events in a range of dates (both included), sorted by start time."""
+        start, end = day_range(from_date, to_date)
+        tz_obj = start.tzinfo
+        events = []
+        for event in self.events.values():
+            if overlaps(event, tz_obj, start, end):
+                events.append((event_bounds(event, tz_obj)[0], event))
+        events.sort(key=lambda item: item[0])
+        return [event for _, event in events]
+
+
+def month_end(date):
+    """Last day of the month of a date."""
+    next_month = date.replace(day=28) + datetime.timedelta(days=4)
+    return next_month - datetime.timedelta(days=next_month.day)
+
+
+def get_events_between(config_dir, events_service, calendar_id, from_date, to_date):
+    """Get all events from a calendar in a range of dates (both included), through its cache.
+
+    Caches hold whole months, from the first to the last month ever read.
+    """
+    cache = CalendarCache(config_dir, calendar_id)
+    cache.update(events_service, from_date.replace(day=1), month_end(to_date))
+    return [{**e, "calendar_id": calendar_id} for e in cache.between(from_date, to_date)]
@@ -1,15 +1,18 @@
-import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+
 import click
 from colorama import Back, Fore, Style
-from dateutil import parser
+from dateutil import parser, tz
 
 from googleapiclient.errors import HttpError
-from googleapiclient.discovery import build
 
 from . import LOGGER
+from .api import CALENDAR, execute, is_retryable, max_retries, pause, retry_delay
 from .ini import get
-from .credentials import get_credentials
+from .metrics import metrics
+from .profiles import bind
+from .services import get_service
 
 LOCAL_TIMEZONE = datetime.datetime.utcnow().astimezone().strftime("%z")
 # Weird google spreadsheet date management
@@ -24,14 +27,46 @@ def formatDate(date, format):
     return parser.isoparse(date).strftime(format)
 
 
-def init(config_dir):
-    get_credentials(config_dir, SCOPES, "calendars-token.json")
+def get_calendar_service(config_dir):
+    return get_service(config_dir, "calendar", "v3", SCOPES, "calendars-token.json")
+
+
+def day_range(from_date, to_date):
+    """Start of from_date and end (excluded) of to_date, as datetimes in TIMEZONE."""
+    tz_obj = tz.gettz(get("TIMEZONE", "Etc/GMT"))
+    start = datetime.datetime.combine(from_date, datetime.time.min).replace(tzinfo=tz_obj)
+    end = datetime.datetime.combine(
+        to_date + datetime.timedelta(days=1), datetime.time.min
+    ).replace(tzinfo=tz_obj)
+    return start, end
+
+
+def list_events(events_service, calendar_id, **params):
+    """All events of a listing (every page of it) and the sync token returned at its end.
 
+    Recurring events are expanded into their instances.
+    """
+    events = []
+    page_token = None
+    while True:
+        events_result = execute(
+            events_service.list(
+                calendarId=calendar_id,
+                singleEvents=True,
+                timeZone=get("TIMEZONE", "Etc/GMT"),
+                pageToken=page_token,
+                **params,
+            ),
+            CALENDAR,
+        )
+        events.extend(events_result.get("items", []))
+        page_token = events_result.get("nextPageToken")
+        if not page_token:
+            return events, events_result.get("nextSyncToken")
 
-def create_event(config_dir, calendar, date, summary, details, length, from_time=None):
-    creds = get_credentials(config_dir, SCOPES, "calendars-token.json")
-    service = build("calendar", "v3", credentials=creds)
 
+def prepare_event(date, summary, details, length, from_time=None):
+    """Compute the body of a new event and where the next event in the same day can start."""
     from_time = from_time or get("START_TIME", "09:00")
     start = datetime.datetime.strptime(
         f"{date.strftime('%Y-%m-%d')}T{from_time}:00Z",
@@ -41,7 +76,6 @@ def create_event(config_dir, calendar, date, summary, details, length, from_time
     startParams = None
     endParams = None
     haveLength = length is not None and not isinstance(length, str)
-    duration = None
     if haveLength:
         duration = float(length)
         delta = datetime.timedelta(hours=duration)
@@ -76,37 +110,22 @@ def create_event(config_dir, calendar, date, summary, details, length, from_time
         "start": startParams,
         "end": endParams,
     }
+    next_slot = end.strftime("%H:%M") if haveLength else from_time
+    return event_body, next_slot
 
-    def execute_creation():
-        LOGGER.debug(calendar, date, summary, details, length, event_body, from_time)
-        try:
-            event = (
-                service.events().insert(calendarId=calendar, body=event_body).execute()
-            )
-        except HttpError as err:
-            LOGGER.error(f"Cannot create the event: {err.status_code}")
-            raise
-        return event
-
-    try:
-        event = execute_creation()
-    except HttpError as err:
-        if err.status_code == 429:
-            click.echo("Too many requests")
-            click.echo(err.error_details)
-            click.echo("haunts will now pause for a while ⏲…")
-            time.sleep(60)
-            click.echo("Retrying…")
-            event = execute_creation()
-        else:
-            raise
 
+def echo_created_event(event):
+    """Log a successfully created event."""
     LOGGER.debug(event.items())
-    if duration:
+    summary = event.get("summary")
+    if "dateTime" in event["start"]:
+        start = parser.isoparse(event["start"]["dateTime"])
+        end = parser.isoparse(event["end"]["dateTime"])
+        duration = (end - start).total_seconds() / 3600
         click.echo(
-            f'Created event "{summary}" from {formatDate(event["start"]["dateTime"], "%H:%M")} '
-            f'to {formatDate(event["end"]["dateTime"], "%H:%M")} ({duration}h) '
-            f'in date {formatDate(event["start"]["dateTime"], "%d/%m")} '
+            f'Created event "{summary}" from {start.strftime("%H:%M")} '
+            f'to {end.strftime("%H:%M")} ({duration:g}h) '
+            f'in date {start.strftime("%d/%m")} '
             f'on calendar {event["organizer"]["displayName"]}'
         )
     else:
@@ -118,35 +137,170 @@ def create_event(config_dir, calendar, date, summary, details, length, from_time
     if not summary:
         click.echo(Back.YELLOW + Fore.BLACK + "Summary is empty!" + Style.RESET_ALL)
 
-    event_data = {
-        "id": event["id"],
-        "next_slot": end.strftime("%H:%M") if haveLength else from_time,
-        "link": event["htmlLink"],
-    }
-    return event_data
+
+def echo_missing_event(event_id, status_code):
+    click.echo(
+        Back.YELLOW
+        + Fore.BLACK
+        + (
+            f"Event {event_id} not found (status code {status_code}). "
+            f"Maybe it's has been already deleted?"
+        )
+        + Style.RESET_ALL
+    )
 
 
-def delete_event(config_dir, calendar, event_id):
-    creds = get_credentials(config_dir, SCOPES, "calendars-token.json")
-    service = build("calendar", "v3", credentials=creds)
-    if not event_id:
-        click.echo(
-            Back.YELLOW
-            + Fore.BLACK
-            + "Missing event id, cannot delete"
-            + Style.RESET_ALL
+class CalendarBatch:
+    """Group calendar inserts, deletes, patches and moves, sending them as batch HTTP requests.
+
+    Every operation is identified by a key (like the sheet row it comes from) and comes
+    with a callback, called as ``callback(key, response, exception)`` when the
+    operation has been executed.
+    Operations failed because of too many requests or temporary errors are sent again,
+    with an exponential backoff.
+
+    Batches are executed by a pool of CALENDAR_WORKERS threads, sharing the pooled HTTP
+    transport, while callbacks are always called in the thread that owns the batch.
+    """
+
+    # Google Calendar API does not accept more than 50 requests in a batch
+    MAX_SIZE = 50
+
+    def __init__(self, config_dir, size=None, workers=None):
+        self.config_dir = config_dir
+        self.size = min(int(size or get("CALENDAR_BATCH_SIZE", self.MAX_SIZE)), self.MAX_SIZE)
+        workers = int(workers or get("CALENDAR_WORKERS", 4))
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.pending = []
+        self.running = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not send anything more to calendars when something went wrong,
+        # but results of batches already sent must be handled anyway
+        if exc_type is None:
+            self.flush()
+        else:
+            self.pending = []
+            self.wait()
+        if self.executor:
+            self.executor.shutdown()
+
+    def insert(self, key, calendar, event_body, callback):
+        self._add(
+            key,
+            lambda service: service.events().insert(calendarId=calendar, body=event_body),
+            callback,
         )
-        return
-    try:
-        service.events().delete(calendarId=calendar, eventId=event_id).execute()
-    except HttpError as err:
-        if err.status_code >= 400 and err.status_code < 500:
-            click.echo(
-                Back.YELLOW
-                + Fore.BLACK
-                + (
-                    f"Event {event_id} not found (status code {err.status_code}). "
-                    f"Maybe it's has been already deleted?"
+
+    def delete(self, key, calendar, event_id, callback):
+        self._add(
+            key,
+            lambda service: service.events().delete(calendarId=calendar, eventId=event_id),
+            callback,
+        )
+
+    def patch(self, key, calendar, event_id, body, callback):
+        self._add(
+            key,
+            lambda service: service.events().patch(
+                calendarId=calendar, eventId=event_id, body=body
+            ),
+            callback,
+        )
+
+    def move(self, key, calendar, event_id, destination, callback):
+        self._add(
+            key,
+            lambda service: service.events().move(
+                calendarId=calendar, eventId=event_id, destination=destination
+            ),
+            callback,
+        )
+
+    def _add(self, key, request_factory, callback):
+        self.pending.append((key, request_factory, callback))
+        if len(self.pending) >= self.size:
+            self._submit()
+        self._dispatch(wait=False)
+
+    def _submit(self):
+        operations, self.pending = self.pending, []
+        if not operations:
+            return
+        if self.executor:
+            self.running.append(self.executor.submit(bind(self._run), operations))
+        else:
+            self._call_back(self._run(operations))
+
+    def flush(self):
+        """Send all pending operations and wait for their results."""
+        self._submit()
+        self.wait()
+
+    def wait(self):
+        self._dispatch(wait=True)
+
+    def _dispatch(self, wait):
+        """Call callbacks of executed batches."""
+        still_running = []
+        for future in self.running:
+            if wait or future.done():
+                self._call_back(future.result())
+            else:
+                still_running.append(future)
+        self.running = still_running
+
+    def _call_back(self, results):
+        for (key, _, callback), response, exception in results:
+            callback(key, response, exception)
+
+    def _run(self, operations):
+        """Execute operations, retrying the ones failed with a temporary error.
+
+        Returns a list of (operation, response, exception).
+        """
+        service = get_calendar_service(self.config_dir)
+        results = []
+        attempt = 0
+        while operations:
+            done, retry = self._execute(service, operations, can_retry=attempt < max_retries())
+            results.extend(done)
+            operations = [operation for operation, _ in retry]
+            if retry:
+                click.echo(f"{len(retry)} calendar operations must be retried")
+                # Wait for the longest delay asked: delays have a random jitter,
+                # so they are computed once
+                delay, err = max(
+                    ((retry_delay(err, attempt), err) for _, err in retry),
+                    key=lambda delay_err: delay_err[0],
                 )
-                + Style.RESET_ALL
-            )
+                pause(err, attempt, delay)
+                metrics.add_retry(f"{CALENDAR}.batch", delay, count=len(retry))
+                attempt += 1
+        return results
+
+    def _execute(self, service, operations, can_retry=True):
+        """Execute operations in a single batch request.
+
+        Returns results and (operation, exception) that can be retried later.
+        """
+        results = []
+        retry = []
+        by_id = {str(i): operation for i, operation in enumerate(operations)}
+
+        def on_response(request_id, response, exception):
+            operation = by_id[request_id]
+            if can_retry and isinstance(exception, HttpError) and is_retryable(exception):
+                retry.append((operation, exception))
+                return
+            results.append((operation, response, exception))
+
+        batch = service.new_batch_http_request(callback=on_response)
+        for request_id, (_, request_factory, _) in by_id.items():
+            batch.add(request_factory(service), request_id=request_id)
+        LOGGER.debug(f"Sending {len(operations)} calendar operations in a batch")
+        execute(batch, CALENDAR, cost=len(operations))
+        return results, retry
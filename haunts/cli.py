@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 
-"""Console script for haunts."""
+"""Console script for haunts.
+
+Modules using Google APIs are slow to import: they are imported only by commands using them.
+"""
 import datetime
 import os
 import sys
 from pathlib import Path
-from importlib.metadata import version
 from colorama import Fore, Style
 import click
 
 from .ini import create_default, init, get
-from .calendars import init as init_calendars
-from .spreadsheet import sync_report
-from .report import report
 from . import actions
-from .download import extract_events
+
+ROLLUPS = ("day", "week", "month", "project")
+
+
+def check_days(ctx, param, value):
+    """Make sure days are in "YYYY-MM-DD" format, keeping them as strings."""
+    for day in value if isinstance(value, tuple) else [value] if value else []:
+        try:
+            datetime.datetime.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            raise click.BadParameter(f'"{day}" is not a day in format "YYYY-MM-DD".')
+    return value
 
 
 @click.command()
@@ -23,8 +33,23 @@ from .download import extract_events
     "--day",
     "-d",
     multiple=True,
+    callback=check_days,
     help='day filter in format "YYYY-MM-DD". Can be provided multiple times.',
 )
+@click.option(
+    "--from",
+    "from_day",
+    callback=check_days,
+    help='start of a range of days in format "YYYY-MM-DD". Used by "read" and "report".',
+)
+@click.option(
+    "--to",
+    "to_day",
+    callback=check_days,
+    help=(
+        'end of a range of days (included) in format "YYYY-MM-DD". Used by "read" and "report".'
+    ),
+)
 @click.option(
     "--config",
     "-c",
@@ -37,7 +62,7 @@ from .download import extract_events
 @click.option(
     "--execute",
     "-e",
-    type=click.Choice(["sync", "report", "read"], case_sensitive=False),
+    type=click.Choice(["sync", "report", "read", "reconcile"], case_sensitive=False),
     help="select which action to execute.",
     show_default=True,
     default="sync",
@@ -76,6 +101,111 @@ from .download import extract_events
     "-f",
     help='filter report glob search inside "Activity" columns. ',
 )
+@click.option(
+    "--rollup",
+    "-r",
+    type=click.Choice(ROLLUPS, case_sensitive=False),
+    help="sum report totals by day, week, month or just by project.",
+    show_default=True,
+    default="day",
+)
+@click.option(
+    "--incremental",
+    "-i",
+    help=(
+        "sync only rows added or changed since last incremental sync, "
+        "based on the local state stored in the configuration directory."
+    ),
+    is_flag=True,
+    show_default=True,
+    default=False,
+)
+@click.option(
+    "--plan",
+    "plan_file",
+    type=click.Path(dir_okay=False),
+    help=(
+        "save the sync plan (events to create or delete) to a JSON file and show it, "
+        'without changing anything. Used by "sync".'
+    ),
+)
+@click.option(
+    "--apply",
+    "apply_file",
+    type=click.Path(exists=True, dir_okay=False),
+    help='apply a sync plan saved before with "--plan". Used by "sync".',
+)
+@click.option(
+    "--resume",
+    help=(
+        "complete the last sync of SHEET, if it was interrupted, without creating "
+        "its events again."
+    ),
+    is_flag=True,
+    show_default=True,
+    default=False,
+)
+@click.option(
+    "--watch",
+    "-w",
+    help=(
+        "keep running, syncing rows of SHEET as soon as they change "
+        "(checked every WATCH_INTERVAL seconds)."
+    ),
+    is_flag=True,
+    show_default=True,
+    default=False,
+)
+@click.option(
+    "--offline",
+    help=(
+        "report using local snapshots of sheets, without calling Google APIs. "
+        'Used by "report".'
+    ),
+    is_flag=True,
+    show_default=True,
+    default=False,
+)
+@click.option(
+    "--stats",
+    help="print a summary of the Google API requests made, by endpoint, at the end of the run.",
+    is_flag=True,
+    show_default=True,
+    default=False,
+)
+@click.option(
+    "--metrics",
+    "metrics_file",
+    type=click.Path(dir_okay=False, writable=True),
+    help="save metrics of the Google API requests made, by endpoint, to a JSON file.",
+)
+@click.option(
+    "--batch",
+    help=(
+        "run the command for many profiles at once, sharing connections and API rate limits. "
+        'Used by "sync", "report" and "read".'
+    ),
+    is_flag=True,
+    show_default=True,
+    default=False,
+)
+@click.option(
+    "--profiles",
+    "-P",
+    type=click.Path(exists=True, file_okay=False),
+    multiple=True,
+    help=(
+        "configuration directory of a profile (like ~/.haunts). Can be provided multiple times. "
+        'Used by "--batch".'
+    ),
+)
+@click.option(
+    "--workers",
+    type=int,
+    help='how many profiles run at the same time. Used by "--batch".',
+    show_default=True,
+    default=4,
+)
 @click.option(
     "--version",
     "-v",
@@ -86,12 +216,26 @@ from .download import extract_events
 def main(
     sheet=None,
     day=[],
+    from_day=None,
+    to_day=None,
     run_configuration=False,
     execute="sync",
     action=[],
     project=[],
     overtime=False,
     filter=None,
+    rollup="day",
+    incremental=False,
+    plan_file=None,
+    apply_file=None,
+    resume=False,
+    watch=False,
+    offline=False,
+    stats=False,
+    metrics_file=None,
+    batch=False,
+    profiles=[],
+    workers=4,
     show_version=False,
 ):
     """
@@ -99,9 +243,45 @@ def main(
     """
 
     if show_version:
+        from importlib.metadata import version
+
         click.echo(version("haunts"))
         sys.exit(0)
 
+    if profiles and not batch:
+        click.echo("The '--profiles' option can only be used with '--batch'.")
+        sys.exit(1)
+    if batch:
+        if not profiles:
+            click.echo("The '--batch' flag requires at least a profile ('--profiles').")
+            sys.exit(1)
+        if execute not in ("sync", "report", "read"):
+            click.echo(f"'--execute {execute}' cannot be used with '--batch'.")
+            sys.exit(1)
+        if run_configuration or any((plan_file, apply_file, resume, watch, offline)):
+            click.echo(
+                "The '--config', '--plan', '--apply', '--resume', '--watch' and '--offline' "
+                "options cannot be used with '--batch'."
+            )
+            sys.exit(1)
+        run_batch(
+            profiles,
+            execute,
+            sheet,
+            workers=workers,
+            stats=stats,
+            metrics_file=metrics_file,
+            day=day,
+            from_day=from_day,
+            to_day=to_day,
+            action=action,
+            project=project,
+            overtime=overtime,
+            filter=filter,
+            rollup=rollup,
+            incremental=incremental,
+        )
+
     # config phase
     config_dir = Path(os.path.expanduser("~/.haunts"))
 
@@ -131,8 +311,16 @@ def main(
             )
             sys.exit(1)
 
-    if not run_configuration and not sheet:
-        click.echo("Argument SHEET is required if no '--config' flag is provided.")
+    if (
+        not run_configuration
+        and not sheet
+        and not (execute == "report" and (from_day or to_day))
+        and not (execute == "sync" and apply_file)
+    ):
+        click.echo(
+            "Argument SHEET is required if no '--config' flag is provided "
+            "(or a range of days for '--execute report', or a plan for '--apply')."
+        )
         sys.exit(1)
 
     init(config)
@@ -152,16 +340,121 @@ def main(
             + Style.RESET_ALL
         )
 
-    init_calendars(config_dir)
-    if execute == "sync":
+    if offline and execute != "report":
+        click.echo("The '--offline' flag can only be used with '--execute report'.")
+        sys.exit(1)
+
+    if (plan_file or apply_file) and execute != "sync":
+        click.echo("The '--plan' and '--apply' options can only be used with '--execute sync'.")
+        sys.exit(1)
+    if (resume or watch) and execute != "sync":
+        click.echo("The '--resume' and '--watch' flags can only be used with '--execute sync'.")
+        sys.exit(1)
+    if len([option for option in (plan_file, apply_file, resume, watch) if option]) > 1:
+        click.echo(
+            "The '--plan', '--apply', '--resume' and '--watch' options cannot be used together."
+        )
+        sys.exit(1)
+
+    try:
+        prepare_profile(config_dir, offline=offline, watch=watch)
+        run_command(
+            config_dir,
+            execute,
+            sheet,
+            day=day,
+            from_day=from_day,
+            to_day=to_day,
+            action=action,
+            project=project,
+            overtime=overtime,
+            filter=filter,
+            rollup=rollup,
+            incremental=incremental,
+            plan_file=plan_file,
+            apply_file=apply_file,
+            resume=resume,
+            watch=watch,
+        )
+    finally:
+        report_metrics(stats, metrics_file or get("METRICS_FILE", ""))
+    return 0
+
+
+def report_metrics(stats=False, metrics_file=None):
+    """Print and save metrics of the Google API requests of the run, when asked to."""
+    if not stats and not metrics_file:
+        return
+    from .metrics import metrics
+
+    if stats:
+        click.echo()
+        metrics.echo()
+    if metrics_file:
+        metrics.save(Path(metrics_file).expanduser())
+
+
+def prepare_profile(config_dir, offline=False, watch=False):
+    """Load the tokens the current profile needs (users may be asked to log in)."""
+    from . import calendars, credentials, snapshots, spreadsheet
+
+    snapshots.init(config_dir, offline=offline)
+    if not offline:
+        tokens = [
+            (calendars.SCOPES, "calendars-token.json"),
+            (spreadsheet.SCOPES, "sheets-token.json"),
+        ]
+        if snapshots.get_cache() or watch:
+            tokens.append((snapshots.SCOPES, "drive-token.json"))
+        credentials.init(config_dir, tokens)
+
+
+def run_command(
+    config_dir,
+    execute,
+    sheet,
+    day=[],
+    from_day=None,
+    to_day=None,
+    action=[],
+    project=[],
+    overtime=False,
+    filter=None,
+    rollup="day",
+    incremental=False,
+    plan_file=None,
+    apply_file=None,
+    resume=False,
+    watch=False,
+):
+    """Execute a command for the current profile."""
+    if execute == "sync" and watch:
+        from .watch import watch_sheet
+
+        watch_sheet(
+            config_dir,
+            sheet,
+            days=[datetime.datetime.strptime(d, "%Y-%m-%d") for d in day],
+            projects=project,
+            allowed_actions=action,
+        )
+    elif execute == "sync":
+        from .spreadsheet import sync_report
+
         sync_report(
             config_dir,
             sheet,
             days=[datetime.datetime.strptime(d, "%Y-%m-%d") for d in day],
             projects=project,
             allowed_actions=action,
+            incremental=incremental,
+            plan_file=plan_file,
+            apply_file=apply_file,
+            resume=resume,
         )
     elif execute == "report":
+        from .report import report
+
         report(
             config_dir,
             sheet,
@@ -169,14 +462,82 @@ def main(
             projects=project,
             overtime=overtime,
             filter=filter,
+            from_day=from_day,
+            to_day=to_day,
+            rollup=rollup,
         )
-    elif execute == "read":
-        extract_events(
+    elif execute == "reconcile":
+        from .reconcile import reconcile_events
+
+        reconcile_events(
             config_dir,
             sheet,
-            day=day[0] if day else datetime.date.today().strftime("%Y-%m-%d"),
+            days=[datetime.datetime.strptime(d, "%Y-%m-%d") for d in day],
+            projects=project,
         )
-    return 0
+    elif execute == "read":
+        from .download import extract_events
+
+        if from_day or to_day:
+            extract_events(config_dir, sheet, from_day=from_day or to_day, to_day=to_day)
+        else:
+            extract_events(
+                config_dir,
+                sheet,
+                day=day[0] if day else datetime.date.today().strftime("%Y-%m-%d"),
+            )
+
+
+def run_batch(profiles, execute, sheet, workers=4, stats=False, metrics_file=None, **options):
+    """Run a command for many profiles at once, sharing connections and API rate limits.
+
+    options are passed to run_command for every profile.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .profiles import Profile, activate
+
+    if not sheet and not (
+        execute == "report" and (options.get("from_day") or options.get("to_day"))
+    ):
+        click.echo("Argument SHEET is required (or a range of days for '--execute report').")
+        sys.exit(1)
+
+    loaded = []
+    for config_dir in profiles:
+        profile = Profile(Path(config_dir).expanduser().resolve())
+        if not profile.config.is_file():
+            click.echo(f"Configuation file at {profile.config} not found.")
+            sys.exit(1)
+        profile.load()
+        # Users are asked to log in one at a time, before running anything
+        with activate(profile):
+            prepare_profile(profile.config_dir)
+        loaded.append(profile)
+
+    def run_profile(profile):
+        with activate(profile):
+            click.echo(f"Running {execute} for profile {profile.config_dir}")
+            try:
+                run_command(profile.config_dir, execute, sheet, **options)
+            except SystemExit as err:
+                return err.code or 0
+            except Exception as err:
+                click.echo(
+                    Fore.RED + f"Profile {profile.config_dir} failed: {err}" + Style.RESET_ALL
+                )
+                return 1
+            return 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(run_profile, loaded))
+
+    failed = [profile for profile, result in zip(loaded, results) if result]
+    click.echo(f"{len(loaded) - len(failed)} of {len(loaded)} profiles completed")
+    for profile in failed:
+        click.echo(Fore.RED + f"Failed: {profile.config_dir}" + Style.RESET_ALL)
+    report_metrics(stats, metrics_file)
+    sys.exit(1 if failed else 0)
 
 
 if __name__ == "__main__":
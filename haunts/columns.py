@@ -0,0 +1,271 @@
+"""Columnar representation of sheet data, used to aggregate many rows quickly.
+
+Aggregations use NumPy when installed, otherwise the same operations run in pure Python
+on typed arrays.
+"""
+
+import numbers
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import click
+from colorama import Back, Fore, Style
+
+from . import actions
+from .entries import day_minutes, from_serial, to_serial
+
+# Spent hours are stored as integer hundredths of minute
+SPENT_SCALE = 60 * 100
+
+
+class ReportColumns:
+    """Report relevant columns of one or more sheets, as typed arrays.
+
+    Every position in arrays is a sheet row: date serial, project code, spent time (fixed-point
+    hundredths of minute), full day flag, overtime flag and match with the activity filter.
+    """
+
+    def __init__(self):
+        self.dates = array("l")
+        self.projects = array("l")
+        self.spent = array("q")
+        self.full_day = array("b")
+        self.overtime = array("b")
+        self.matching = array("b")
+        self.project_names = []
+        self.project_codes = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def project_code(self, name):
+        code = self.project_codes.get(name)
+        if code is None:
+            code = self.project_codes[name] = len(self.project_names)
+            self.project_names.append(name)
+        return code
+
+    def add(self, entries, overtime_from=None, filter=None, from_date=None, to_date=None):
+        """Add sheet entries to the report.
+
+        Entries out of the range from_date - to_date (both included) are ignored.
+        """
+        overtime_minutes = day_minutes(overtime_from) if overtime_from else None
+        from_serial = to_serial(from_date) if from_date else None
+        to_serial_ = to_serial(to_date) if to_date else None
+
+        for entry in entries:
+            if entry.action == actions.IGNORE_ALL:
+                continue
+            date = entry.serial
+            if date is None:
+                continue
+            if (from_serial is not None and date < from_serial) or (
+                to_serial_ is not None and date > to_serial_
+            ):
+                continue
+            spent = entry.spent
+            self.dates.append(date)
+            self.projects.append(self.project_code(entry.project))
+            self.spent.append(
+                round(spent * SPENT_SCALE) if isinstance(spent, numbers.Number) else 0
+            )
+            self.full_day.append(spent == "")
+            self.overtime.append(
+                overtime_minutes is not None
+                and entry.start is not None
+                and entry.start >= overtime_minutes
+            )
+            self.matching.append(not filter or filter in str(entry.activity or ""))
+
+    def aggregate(self, working_hours):
+        """Sum rows by date and project.
+
+        Dates come in order of first appearance, then projects of every date in order of
+        first appearance on that date.
+
+        Full day events take the time left by other events on the same date, up to
+        working_hours (overtime not included).
+        """
+        aggregate = aggregate_numpy if np is not None else aggregate_arrays
+        return aggregate(self, working_hours * SPENT_SCALE)
+
+
+class DayStats:
+    """Totals by date and project: every position in lists is a (date, project) pair"""
+
+    def __init__(self, dates, projects, totals, overtimes, ignored, project_names):
+        self.dates = dates
+        self.projects = projects
+        self.totals = totals
+        self.overtimes = overtimes
+        self.ignored = ignored
+        self.project_names = project_names
+
+    def __len__(self):
+        return len(self.dates)
+
+
+def warn_multiple_full_days(serial):
+    click.echo(
+        Back.YELLOW
+        + Fore.BLACK
+        + f"There are multiple full days in the same day: {from_serial(serial)}"
+        + Style.RESET_ALL
+    )
+
+
+def aggregate_numpy(columns, working_time):
+    dates = np.frombuffer(columns.dates, dtype=columns.dates.typecode).astype(np.int64)
+    projects = np.frombuffer(columns.projects, dtype=columns.projects.typecode)
+    spent = np.frombuffer(columns.spent, dtype=np.int64)
+    full_day = np.frombuffer(columns.full_day, dtype=np.int8).astype(bool)
+    overtime = np.frombuffer(columns.overtime, dtype=np.int8).astype(bool)
+    matching = np.frombuffer(columns.matching, dtype=np.int8).astype(bool)
+
+    # Group rows by (date, project), numbering groups by first appearance of their date,
+    # then of their project on that date
+    keys = dates * max(len(columns.project_names), 1) + projects
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    _, date_first, date_inverse = np.unique(dates, return_index=True, return_inverse=True)
+    order = np.lexsort((first, date_first[date_inverse.ravel()[first]]))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    groups = rank[inverse.ravel()]
+    first = first[order]
+    size = len(first)
+
+    totals = np.bincount(groups, weights=spent, minlength=size).round().astype(np.int64)
+    overtimes = (
+        np.bincount(groups, weights=spent * overtime, minlength=size).round().astype(np.int64)
+    )
+    ignored = np.bincount(groups, weights=~matching, minlength=size) > 0
+    group_dates = dates[first]
+
+    # Only the first full day event of a date is taken into account
+    full_day_rows = np.flatnonzero(full_day)
+    _, first_full_day = np.unique(dates[full_day_rows], return_index=True)
+    for row in np.setdiff1d(full_day_rows, full_day_rows[first_full_day]):
+        warn_multiple_full_days(int(dates[row]))
+    full_day_groups = groups[full_day_rows[first_full_day]]
+    if len(full_day_groups):
+        _, date_ids = np.unique(group_dates, return_inverse=True)
+        date_ids = date_ids.ravel()
+        date_totals = np.bincount(date_ids, weights=totals).round().astype(np.int64)
+        date_overtimes = np.bincount(date_ids, weights=overtimes).round().astype(np.int64)
+        full_day_dates = date_ids[full_day_groups]
+        totals[full_day_groups] += (
+            working_time - date_totals[full_day_dates] + date_overtimes[full_day_dates]
+        )
+
+    return DayStats(
+        group_dates.tolist(),
+        projects[first].tolist(),
+        totals.tolist(),
+        overtimes.tolist(),
+        ignored.tolist(),
+        columns.project_names,
+    )
+
+
+def aggregate_arrays(columns, working_time):
+    groups = {}
+    group_dates = array("l")
+    group_projects = array("l")
+    totals = array("q")
+    overtimes = array("q")
+    ignored = array("b")
+    date_totals = {}
+    full_day_groups = {}
+
+    for date, project, spent, full_day, overtime, matching in zip(
+        columns.dates,
+        columns.projects,
+        columns.spent,
+        columns.full_day,
+        columns.overtime,
+        columns.matching,
+    ):
+        group = groups.get((date, project))
+        if group is None:
+            group = groups[(date, project)] = len(group_dates)
+            group_dates.append(date)
+            group_projects.append(project)
+            totals.append(0)
+            overtimes.append(0)
+            ignored.append(False)
+        totals[group] += spent
+        date_totals[date] = date_totals.get(date, 0) + spent
+        if overtime:
+            overtimes[group] += spent
+            date_totals[date] -= spent
+        if not matching:
+            ignored[group] = True
+        if full_day:
+            if date in full_day_groups:
+                warn_multiple_full_days(date)
+            else:
+                full_day_groups[date] = group
+
+    for date, group in full_day_groups.items():
+        totals[group] += working_time - date_totals[date]
+
+    # Sort groups by first appearance of their date (date_totals keeps that order),
+    # then of their project on that date
+    date_rank = {date: rank for rank, date in enumerate(date_totals)}
+    order = sorted(range(len(group_dates)), key=lambda group: date_rank[group_dates[group]])
+    return DayStats(
+        [group_dates[group] for group in order],
+        [group_projects[group] for group in order],
+        [totals[group] for group in order],
+        [overtimes[group] for group in order],
+        [bool(ignored[group]) for group in order],
+        columns.project_names,
+    )
+
+
+def period_label(serial, rollup):
+    """Label of the period a date serial belongs to"""
+    date = from_serial(serial)
+    if rollup == "week":
+        year, week, _ = date.isocalendar()
+        return f"{year}-W{week:02d}"
+    if rollup == "month":
+        return date.strftime("%Y-%m")
+    if rollup == "project":
+        return ""
+    return str(date)
+
+
+def rollup_rows(stats, selected, rollup="day", overtime=False):
+    """Sum selected (date, project) totals by period and project.
+
+    Returns a list of (period, project, total hours): periods in order of first appearance,
+    then projects of every period in order of first appearance in that period.
+    """
+    labels = {}
+    label_rank = {}
+    totals = {}
+    for position in selected:
+        serial = stats.dates[position]
+        label = labels.get(serial)
+        if label is None:
+            label = labels[serial] = period_label(serial, rollup)
+            label_rank.setdefault(label, len(label_rank))
+        total = (
+            stats.overtimes[position]
+            if overtime and stats.overtimes[position]
+            else stats.totals[position]
+        )
+        key = (label, stats.projects[position])
+        totals[key] = totals.get(key, 0) + total
+    return [
+        (label, stats.project_names[project], total / SPENT_SCALE)
+        for (label, project), total in sorted(
+            totals.items(), key=lambda item: label_rank[item[0][0]]
+        )
+    ]
@@ -1,24 +1,123 @@
-"""Credentials for Google Calendar API"""
+"""Credentials for Google APIs.
 
+Every token file holds the access and refresh tokens for some scopes. Tokens are loaded once
+per profile, refreshed ahead of their expiration by a background timer, and can be shared by
+many threads.
+"""
+
+import datetime
+import json
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
-credentials_cache = {}
+from . import LOGGER
+from .ini import get_boolean
+from .profiles import bind, current
 
+# Token file used for all scopes, when COMBINED_TOKEN is enabled
+COMBINED_TOKEN = "token.json"
+# Tokens are refreshed this long before they expire
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
 
-def get_credentials(config_dir, scopes, token_file):
-    global credentials_cache
-    creds = credentials_cache.get(token_file)
-    if creds:
-        return creds
-    # The file at token_file stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
+
+def utcnow():
+    # Credentials expiry is a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class SharedCredentials(Credentials):
+    """Credentials that can be used by many threads.
+
+    A single thread at a time can refresh the token, and the token is refreshed only if it's
+    going to expire: threads that were waiting for the refresh just use the new token.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refresh_lock = threading.RLock()
+        self.token_path = None
+        self.timer = None
+
+    def expiring(self):
+        if not self.token:
+            return True
+        return self.expiry is not None and utcnow() >= self.expiry - REFRESH_MARGIN
+
+    def refresh(self, request):
+        with self.refresh_lock:
+            if not self.expiring():
+                return
+            super().refresh(request)
+            self.save()
+        self.schedule_refresh()
+
+    def invalidate(self, authorization):
+        """Mark the token as expired, unless the one in authorization was already replaced."""
+        with self.refresh_lock:
+            if authorization == f"Bearer {self.token}":
+                self.expiry = utcnow()
+
+    def save(self):
+        """Save the credentials for the next run"""
+        if self.token_path:
+            with open(self.token_path, "w") as token:
+                token.write(self.to_json())
+
+    def schedule_refresh(self):
+        """Refresh the token in background, shortly before it expires."""
+        if self.expiry is None:
+            return
+        if self.timer:
+            self.timer.cancel()
+        delay = (self.expiry - REFRESH_MARGIN - utcnow()).total_seconds()
+        self.timer = threading.Timer(max(delay, 0), self.refresh_ahead)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def refresh_ahead(self):
+        try:
+            self.refresh(Request())
+        except Exception as err:
+            # The token will be refreshed again when used
+            LOGGER.debug(f"Cannot refresh token at {self.token_path}: {err}")
+
+
+def get_token_lock(token_file):
+    profile = current()
+    with profile.lock:
+        return profile.token_locks.setdefault(token_file, threading.Lock())
+
+
+def resolve(scopes, token_file):
+    """Token file and scopes really used: all scopes share a single token when combined."""
+    if not get_boolean("COMBINED_TOKEN"):
+        return list(scopes), token_file
+    combined = {scope for required in current().token_scopes.values() for scope in required}
+    return sorted(combined.union(scopes)), COMBINED_TOKEN
+
+
+def load_credentials(config_dir, scopes, token_file):
+    """Load credentials stored in a token file, if they cover the required scopes."""
     token = config_dir / token_file
+    if not token.is_file():
+        return None
+    info = json.loads(token.read_text())
+    if info.get("scopes") and not set(scopes).issubset(info["scopes"]):
+        LOGGER.debug(f"Token at {token} does not cover all the required scopes")
+        return None
+    creds = SharedCredentials.from_authorized_user_info(info, scopes)
+    creds.token_path = token.resolve()
+    return creds
+
+
+def authorize(config_dir, scopes, token_file):
+    """Let the user log in, then store the new token."""
     credentials = config_dir / "credentials.json"
     if not credentials.exists():
         click.echo(
@@ -26,20 +125,75 @@ def get_credentials(config_dir, scopes, token_file):
             f"Did you created a Google Cloud project and downloaded the credentials file?"
         )
         sys.exit(1)
-    if token.is_file():
-        creds = Credentials.from_authorized_user_file(token.resolve(), scopes)
-        credentials_cache[token_file] = creds
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+    flow = InstalledAppFlow.from_client_secrets_file(credentials.resolve(), scopes)
+    creds = SharedCredentials.from_authorized_user_info(
+        json.loads(flow.run_local_server(port=0).to_json()), scopes
+    )
+    creds.token_path = (config_dir / token_file).resolve()
+    creds.save()
+    return creds
+
+
+def get_credentials(config_dir, scopes, token_file):
+    """Return credentials for some scopes, stored in token_file.
+
+    The file at token_file stores the user's access and refresh tokens, and is created
+    automatically when the authorization flow completes for the first time.
+    """
+    scopes, token_file = resolve(scopes, token_file)
+    credentials_cache = current().credentials
+    creds = credentials_cache.get(token_file)
+    if creds and creds.has_scopes(scopes):
+        return creds
+    with get_token_lock(token_file):
+        creds = credentials_cache.get(token_file)
+        if creds and creds.has_scopes(scopes):
+            return creds
+        if creds:
+            # A combined token loaded before other scopes were required: services using it
+            # keep working, but it's not saved anymore, as a new token replaces it
+            LOGGER.debug(f"Token {token_file} does not cover all the required scopes")
+            creds.token_path = None
+            scopes = sorted(set(scopes).union(creds.scopes or ()))
+        creds = load_credentials(config_dir, scopes, token_file)
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or (creds.expiring() and not creds.refresh_token):
+            creds = authorize(config_dir, scopes, token_file)
+        elif creds.expiring():
             creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                credentials.resolve(), scopes
-            )
-            creds = flow.run_local_server(port=0)
-            credentials_cache[token_file] = creds
-        # Save the credentials for the next run
-        with open(token.resolve(), "w") as token:
-            token.write(creds.to_json())
+        creds.schedule_refresh()
+        credentials_cache[token_file] = creds
     return creds
+
+
+def needs_login(config_dir, scopes, token_file):
+    creds = current().credentials.get(token_file)
+    if creds and creds.has_scopes(scopes):
+        return False
+    creds = load_credentials(config_dir, scopes, token_file)
+    return not creds or (creds.expiring() and not creds.refresh_token)
+
+
+def init(config_dir, tokens):
+    """Load all the tokens a command will use, refreshing them concurrently.
+
+    tokens is a list of (scopes, token_file). Tokens requiring the user to log in are
+    authorized first, one at a time.
+    """
+    for scopes, token_file in tokens:
+        current().token_scopes[token_file] = list(scopes)
+    required = dict(resolve(scopes, token_file)[::-1] for scopes, token_file in tokens)
+    for token_file, scopes in required.items():
+        if needs_login(config_dir, scopes, token_file):
+            get_credentials(config_dir, scopes, token_file)
+    with ThreadPoolExecutor(max_workers=len(required) or 1) as executor:
+        list(
+            executor.map(
+                bind(
+                    lambda token_file: get_credentials(
+                        config_dir, required[token_file], token_file
+                    )
+                ),
+                required,
+            )
+        )
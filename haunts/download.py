@@ -1,19 +1,23 @@
-from dateutil import tz
-from googleapiclient.discovery import build
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from datetime import datetime
 import click
 from colorama import Back, Fore, Style
 
-from .ini import get
-from .credentials import get_credentials
+from . import calendar_cache
+from .ini import get, get_boolean
+from .profiles import bind
+from .entries import EntryDecoder, to_serial
 from .spreadsheet import (
-    append_line,
+    append_lines,
+    format_line,
+    insert_lines_sorted,
     get_calendars_names,
     get_calendars,
-    get_calendar_col_values,
+    get_month,
+    get_sheet_service,
 )
-from .spreadsheet import SCOPES as SPREADSHEET_SCOPES
-from .calendars import SCOPES as CALENDAR_SCOPES
+from .calendars import day_range, get_calendar_service, list_events
 
 
 def filter_my_events(events):
@@ -37,75 +41,99 @@ def filter_my_events(events):
             yield event
 
 
-def get_events_at(events_service, calendar_id, date):
-    """Get all events from a calendar in a specific date."""
-    start_datetime = datetime.combine(date, datetime.min.time())
-    end_datetime = (
-        datetime.combine(date, datetime.min.time()) + timedelta(days=1) - timedelta(seconds=1)
-    )
-    tz_obj = tz.gettz(get("TIMEZONE", "Etc/GMT"))
-    start_datetime = start_datetime.replace(tzinfo=tz_obj)
-    end_datetime = end_datetime.replace(tzinfo=tz_obj)
-    events_result = events_service.list(
-        calendarId=calendar_id,
-        timeMin=start_datetime.isoformat(),
-        timeMax=end_datetime.isoformat(),
-        singleEvents=True,
+def list_events_between(events_service, calendar_id, from_date, to_date):
+    """Get all events from a calendar in a range of dates (both included)."""
+    start, end = day_range(from_date, to_date)
+    events, _ = list_events(
+        events_service,
+        calendar_id,
+        timeMin=start.isoformat(),
+        timeMax=end.isoformat(),
         orderBy="startTime",
-        timeZone=get("TIMEZONE", "Etc/GMT"),
-    ).execute()
-    events = events_result.get("items", [])
+    )
     # Enrich events with calendar_id
     return [{**e, "calendar_id": calendar_id} for e in events]
 
 
-def extract_events(config_dir, sheet, day):
+def get_calendars_events_between(config_dir, calendar_ids, from_date, to_date):
+    """Get all events from many calendars in a range of dates (both included).
+
+    Calendars are read concurrently. Returns a list of events for every calendar,
+    in the same order of calendar_ids.
+    When CALENDAR_CACHE is enabled, events come from local copies of calendars, updated with
+    the events changed since the last read.
+    """
+
+    events = get_calendar_service(config_dir).events()
+
+    def get_calendar_events(calendar_id):
+        if get_boolean("CALENDAR_CACHE"):
+            return calendar_cache.get_events_between(
+                config_dir, events, calendar_id, from_date, to_date
+            )
+        return list_events_between(events, calendar_id, from_date, to_date)
+
+    with ThreadPoolExecutor(max_workers=int(get("CALENDAR_WORKERS", 4))) as executor:
+        return list(executor.map(bind(get_calendar_events), calendar_ids))
+
+
+def get_event_start(event):
+    return event["start"].get("dateTime", event["start"].get("date"))
+
+
+def extract_events(config_dir, sheet, day=None, from_day=None, to_day=None):
     """Public module entry point.
 
     Extract events from Google Calendar and copy them to proper Google Sheet.
+    Events are read from a single day or from a range of days (both included), every calendar
+    being read once for the whole range.
     """
-    calendar_credentials = get_credentials(config_dir, CALENDAR_SCOPES, "calendars-token.json")
-    spreadsheeet_credentials = get_credentials(config_dir, SPREADSHEET_SCOPES, "sheets-token.json")
-    calendar_service = build("calendar", "v3", credentials=calendar_credentials)
-    spreadsheet_service = build("sheets", "v4", credentials=spreadsheeet_credentials)
+    from_day = from_day or day
+    to_day = to_day or from_day
+    from_date = datetime.strptime(from_day, "%Y-%m-%d").date()
+    to_date = datetime.strptime(to_day, "%Y-%m-%d").date()
 
-    date_to_check = datetime.strptime(day, "%Y-%m-%d").date()  # Replace with the desired date
+    sheet_service = get_sheet_service(config_dir)
 
-    events_service = calendar_service.events()
-    sheet_service = spreadsheet_service.spreadsheets()
-
-    click.echo(f"Checking your calendars at {day}…")
+    if from_date == to_date:
+        click.echo(f"Checking your calendars at {from_day}…")
+    else:
+        click.echo(f"Checking your calendars from {from_day} to {to_day}…")
 
     configured_calendars = get_calendars(sheet_service, ignore_alias=True, use_read_col=True)
     configured_calendars["???"] = get("USER_EMAIL")
     all_events = []
-    # Get "my events" from all configured calendars in the selected date
+    # Get "my events" from all configured calendars in the selected dates
     already_added_events = set()
-    for calendar_id in configured_calendars.values():
-        events = get_events_at(events_service, calendar_id, date_to_check)
+    for events in get_calendars_events_between(
+        config_dir, configured_calendars.values(), from_date, to_date
+    ):
         new_events = [e for e in filter_my_events(events) if e["id"] not in already_added_events]
         already_added_events.update([e["id"] for e in new_events])
         all_events.extend(new_events)
 
     # Sort events by start time
-    all_events.sort(key=lambda x: x["start"].get("dateTime", x["start"].get("date")))
+    all_events.sort(key=get_event_start)
 
     # Get calendar configurations
     calendar_names = get_calendars_names(sheet_service, flat=False)
     # Forcibly add the user's calendar to the list
     calendar_names[get("USER_EMAIL")] = {"alias": "???", "is_linked": False}
 
-    # Get a list of all events ids already present in the sheet
+    # Get a list of all events ids and links already present in the sheet
     # This to prevent adding the same event multiple times
-    all_sheet_events = get_calendar_col_values(sheet_service, sheet, "Event id")
-    all_sheet_event_urls = get_calendar_col_values(sheet_service, sheet, "Link")
-
-    click.echo(f"Start downloading events for day {day}")
-
+    schema, data = get_month(sheet_service, sheet)
+    entries = list(EntryDecoder(schema).decode_rows(data["values"]))
+    all_sheet_events = {str(entry.event_id) for entry in entries if entry.event_id}
+    all_sheet_event_urls = {str(entry.link) for entry in entries if entry.link}
+    sheet_dates = [entry.serial for entry in entries]
+
+    new_lines = []
+    current_day = None
     # Main operation loop
     for event in all_events:
         event_summary = event.get("summary", "No summary")
-        start = event["start"].get("dateTime", event["start"].get("date"))
+        start = get_event_start(event)
         end = event["end"].get("dateTime", event["end"].get("date"))
         project = calendar_names[event["calendar_id"]]["alias"]
         is_linked = calendar_names[event["calendar_id"]]["is_linked"]
@@ -113,6 +141,9 @@ def extract_events(config_dir, sheet, day):
         start_date = datetime.fromisoformat(start).date()
         start_time = datetime.fromisoformat(start).time()
         duration = datetime.fromisoformat(end) - datetime.fromisoformat(start)
+        if start_date != current_day:
+            current_day = start_date
+            click.echo(f"Start downloading events for day {start_date.strftime('%Y-%m-%d')}")
         event_id = event["id"] if not is_linked else ""
         if event_id and event_id in all_sheet_events:
             click.echo(
@@ -138,20 +169,30 @@ def extract_events(config_dir, sheet, day):
             f"Adding new event {event_summary} ({project}) "
             f"{f'at {start_time}' if duration else 'full day'} to selected sheet"
         )
-        append_line(
-            sheet_service,
-            sheet,
-            date_col=start_date,
-            time_col=start_time,
-            duration_col=duration,
-            project_col=project,
-            activity_col=event_summary,
-            details_col=event.get("description", ""),
-            event_id_col=event_id,
-            link_col=event_link,
-            action_col="I" if not is_linked and project != "???" else "",
+        new_lines.append(
+            (
+                to_serial(start_date),
+                format_line(
+                    schema,
+                    date_col=start_date,
+                    time_col=start_time,
+                    duration_col=duration,
+                    project_col=project,
+                    activity_col=event_summary,
+                    details_col=event.get("description", ""),
+                    event_id_col=event_id,
+                    link_col=event_link,
+                    action_col="I" if not is_linked and project != "???" else "",
+                ),
+            )
         )
 
+    # All new lines are written at once
+    if get_boolean("READ_INSERT_SORTED"):
+        insert_lines_sorted(sheet_service, sheet, new_lines, sheet_dates)
+    else:
+        append_lines(sheet_service, sheet, [values_line for _, values_line in new_lines])
+
     if not all_events:
         click.echo("No events found.")
     else:
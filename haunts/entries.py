@@ -0,0 +1,200 @@
+"""Rows of month sheets, decoded once into TimesheetEntry records.
+
+The decoder is compiled from the sheet schema and the column names configured in the .ini
+file, so decoding a row does not look up any setting or header.
+"""
+
+import datetime
+import numbers
+from operator import itemgetter
+
+from .calendars import ORIGIN_TIME
+from .ini import get
+
+# Entry values, with the .ini option naming their column and its default
+COLUMNS = {
+    "date": ("DATE_COLUMN_NAME", "Date"),
+    "start": ("START_TIME_COLUMN_NAME", "Start time"),
+    "spent": ("SPENT_COLUMN_NAME", "Spent"),
+    "project": ("PROJECT_COLUMN_NAME", "Project"),
+    "activity": ("ACTIVITY_COLUMN_NAME", "Activity"),
+    "details": ("DETAILS_COLUMN_NAME", "Details"),
+    "event_id": ("EVENT_ID_COLUMN_NAME", "Event id"),
+    "link": ("LINK_COLUMN_NAME", "Link"),
+    "action": ("ACTION_COLUMN_NAME", "Action"),
+}
+
+
+def to_serial(date):
+    """Sheet serial number of a date"""
+    return (date - ORIGIN_TIME.date()).days
+
+
+def from_serial(serial):
+    return (ORIGIN_TIME + datetime.timedelta(days=serial)).date()
+
+
+def day_minutes(value):
+    """Minutes from midnight of a time cell: a fraction of day or a "HH:MM" text"""
+    if isinstance(value, numbers.Number):
+        return round((value % 1) * 1440)
+    if isinstance(value, str) and value:
+        hours, _, minutes = value.partition(":")
+        try:
+            return int(hours) * 60 + int(minutes or 0)
+        except ValueError:
+            return None
+    return None
+
+
+def format_time(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def pad_columns(columns):
+    """Make all columns of the same length, as rows would be read.
+
+    Reading rows, the API does not return empty cells at the end of a row, so they are missing
+    (None), while empty cells followed by a filled cell on the same row are empty strings.
+    """
+    size = max((len(column) for column in columns), default=0)
+    widths = [0] * size
+    for index, column in enumerate(columns):
+        for row, value in enumerate(column):
+            if value != "" and value is not None:
+                widths[row] = index + 1
+    padded = [
+        [value if widths[row] > index else None for row, value in enumerate(column)]
+        + [None] * (size - len(column))
+        for index, column in enumerate(columns)
+    ]
+    for index, column in enumerate(padded):
+        for row in range(len(columns[index]), size):
+            if widths[row] > index:
+                column[row] = ""
+    return padded, size
+
+
+class TimesheetEntry:
+    """A row of a month sheet.
+
+    row is the sheet row number, serial and date the day of the entry (None if the row has
+    no date), start the start time in minutes from midnight (None if not set).
+    Other values are cells as read from the sheet, spent being an empty string for full day
+    events. action is an empty string when not set.
+    """
+
+    __slots__ = (
+        "row",
+        "serial",
+        "date",
+        "start",
+        "spent",
+        "project",
+        "activity",
+        "details",
+        "event_id",
+        "link",
+        "action",
+    )
+
+    def __init__(
+        self, row, serial, date, start, spent, project, activity, details, event_id, link, action
+    ):
+        self.row = row
+        self.serial = serial
+        self.date = date
+        self.start = start
+        self.spent = spent
+        self.project = project
+        self.activity = activity
+        self.details = details
+        self.event_id = event_id
+        self.link = link
+        self.action = action
+
+    @property
+    def start_time(self):
+        """Start time in HH:MM format"""
+        return format_time(self.start) if self.start is not None else None
+
+    def __repr__(self):
+        return f"<TimesheetEntry row {self.row}: {self.date} {self.project} {self.activity!r}>"
+
+
+class EntryDecoder:
+    """Decode rows of a month sheet, with column indexes resolved once from its schema."""
+
+    def __init__(self, schema):
+        self.indexes = [
+            schema.indexes.get(get(option, default)) for option, default in COLUMNS.values()
+        ]
+        self.width = max([index for index in self.indexes if index is not None], default=-1) + 1
+        self.getter = self.compile_getter()
+        self.dates = {}
+
+    def compile_getter(self):
+        """Function returning values of a padded row, in the order of COLUMNS.
+
+        Values of columns not in the sheet are always None.
+        """
+        if None not in self.indexes:
+            return itemgetter(*self.indexes)
+        present = [
+            (position, index) for position, index in enumerate(self.indexes) if index is not None
+        ]
+        empty = [None] * len(self.indexes)
+
+        def getter(values):
+            selected = list(empty)
+            for position, index in present:
+                selected[position] = values[index]
+            return selected
+
+        return getter
+
+    def entry(self, row, values):
+        date, start, spent, project, activity, details, event_id, link, action = values
+        serial = None
+        if isinstance(date, numbers.Number) and date:
+            serial = int(date)
+            date = self.dates.get(serial)
+            if date is None:
+                date = self.dates[serial] = from_serial(serial)
+        else:
+            date = None
+        return TimesheetEntry(
+            row,
+            serial,
+            date,
+            day_minutes(start),
+            spent,
+            project,
+            activity,
+            details,
+            event_id,
+            link,
+            action or "",
+        )
+
+    def decode_rows(self, rows, first_row=2):
+        """Decode rows read from the sheet, the first one being at sheet row first_row."""
+        width = self.width
+        getter = self.getter
+        entry = self.entry
+        for row, values in enumerate(rows, first_row):
+            if len(values) < width:
+                values = values + [None] * (width - len(values))
+            yield entry(row, getter(values))
+
+    def decode_columns(self, columns, first_row=2):
+        """Decode rows of a sheet read by columns (COLUMNS major dimension)."""
+        columns, size = pad_columns(columns)
+        empty = [None] * size
+        selected = [
+            columns[index] if index is not None and index < len(columns) else empty
+            for index in self.indexes
+        ]
+        entry = self.entry
+        for row, values in enumerate(zip(*selected), first_row):
+            yield entry(row, values)
@@ -1,4 +1,4 @@
-import configparser
+from .profiles import current
 
 
 DEFAULT_INI = """[haunts]
@@ -26,10 +26,76 @@ CONTROLLER_SHEET_DOCUMENT_ID=<Google Sheet Document Id here>
 # Required for `--execute read`
 # USER_EMAIL=<your email here>
 
+# Read events: insert new lines after the last line with the same date, instead of
+# appending them at the end of the sheet
+# Default is false
+# READ_INSERT_SORTED=false
+
+# Name of month sheets, as a strftime format, used by `--execute report` on a range of days
+# Default is %B (month name, like "May")
+# SHEET_NAME_FORMAT=%B
+
 # Preferred timezone
 # Default is GMT
 # TIMEZONE=Europe/Rom
 
+# How many sheet rows are updated by a single write request when syncing
+# Default is 50
+# SHEET_WRITE_BATCH_ROWS=50
+
+# How many calendar events are created or deleted by a single batch request when syncing
+# Default (and max) is 50
+# CALENDAR_BATCH_SIZE=50
+
+# How many calendar requests can run at the same time (batches when syncing,
+# calendars when reading)
+# Default is 4. Use 1 to disable concurrency
+# CALENDAR_WORKERS=4
+
+# Requests per minute haunts allows itself on every Google API, to avoid hitting quotas.
+# Defaults are the standard per-user quotas
+# SHEETS_READ_QUOTA=60
+# SHEETS_WRITE_QUOTA=60
+# CALENDAR_QUOTA=600
+# DRIVE_QUOTA=600
+
+# Keep a local snapshot of every sheet read, in the "cache" folder of the configuration
+# directory. A sheet is downloaded again only when the spreadsheet has been modified
+# (this check requires read access to Drive files metadata).
+# Snapshots can also be used by `--execute report --offline`, without any API call
+# Default is false
+# SNAPSHOT_CACHE=false
+
+# Keep a local copy of every calendar read, in the "calendar-cache" folder of the configuration
+# directory. After the first read, only events changed since the previous read are downloaded.
+# Copies hold whole months, from the first to the last month read
+# Default is false
+# CALENDAR_CACHE=false
+
+# Seconds between checks of the spreadsheet for changes, when running with `--watch`
+# Default is 60
+# WATCH_INTERVAL=60
+
+# Save metrics of Google API requests (requests, errors, retries, latency, bytes, backoff)
+# by endpoint in this JSON file at the end of every run. Also set by `--metrics`
+# METRICS_FILE=/path/to/haunts-metrics.json
+
+# Store a single token for all Google APIs (token.json), asking for authorization only once
+# Default is false (a token file for every API)
+# COMBINED_TOKEN=false
+
+# Connections kept open to Google APIs, shared by all requests (and threads)
+# Default is 10
+# HTTP_POOL_SIZE=10
+
+# Timeout of every request to Google APIs, in seconds
+# Default is 60
+# HTTP_TIMEOUT=60
+
+# How many times a request is retried on temporary errors (like too many requests)
+# Default is 5
+# API_MAX_RETRIES=5
+
 # Columns name
 # PROJECT_COLUMN_NAME=Project
 # SPENT_COLUMN_NAME=Spent
@@ -38,8 +104,6 @@ CONTROLLER_SHEET_DOCUMENT_ID=<Google Sheet Document Id here>
 # DETAILS_COLUMN_NAME=Details
 """
 
-parser = configparser.RawConfigParser(allow_no_value=True)
-
 
 def create_default(config):
     print("Creating default configuration")
@@ -49,13 +113,16 @@ def create_default(config):
 
 
 def init(config_file):
-    global configuration
-    with open(config_file.resolve(), "r") as config:
-        parser.read_file(config)
+    """Load settings of the current profile."""
+    current().load(config_file)
 
 
 def get(name, default=None):
-    value = parser["haunts"].get(name, default)
+    value = current().parser["haunts"].get(name, default)
     if value is None and default is None:
         raise KeyError(f"Not found: {name}")
     return default if value is None else value
+
+
+def get_boolean(name, default=False):
+    return current().parser["haunts"].getboolean(name, default)
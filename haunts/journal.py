@@ -0,0 +1,91 @@
+"""Write-ahead journal of a sync, used to resume it when interrupted.
+
+Before any calendar operation the whole plan is recorded, then every calendar result and
+every sheet write. The journal is removed when the sync completes: if it's still there,
+the last sync of that sheet was interrupted.
+"""
+
+import json
+import os
+import re
+
+from . import LOGGER
+
+
+class SyncJournal:
+    """Journal of the sync of a month sheet, as a JSON lines file inside the configuration
+    directory.
+
+    Every record is flushed to disk before going on, so a crash can lose at most the record
+    being written (a truncated last line is ignored).
+    """
+
+    def __init__(self, config_dir, spreadsheet, sheet):
+        name = re.sub(r"[^\w-]", "_", f"{spreadsheet}-{sheet}")
+        self.path = config_dir / "journal" / f"{name}.jsonl"
+        self.file = None
+
+    def exists(self):
+        return self.path.is_file()
+
+    def start(self, plan):
+        """Start a new journal, recording the plan being applied."""
+        self.path.parent.mkdir(exist_ok=True)
+        self.file = open(self.path, "w")
+        self.record({"type": "plan", "plan": plan.to_dict()})
+
+    def reopen(self):
+        """Continue writing an existing journal."""
+        self.file = open(self.path, "a")
+
+    def record(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def created(self, row, event_id, link):
+        self.record({"type": "created", "row": row, "event_id": event_id, "link": link})
+
+    def deleted(self, row):
+        self.record({"type": "deleted", "row": row})
+
+    def written(self, rows):
+        self.record({"type": "written", "rows": rows})
+
+    def read(self):
+        """Return the plan, the results of calendar operations by row and rows written back.
+
+        A result is the created event ({"event_id": ..., "link": ...}) or None for deletes.
+        """
+        plan = None
+        results = {}
+        written = set()
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    LOGGER.debug(f"Ignoring a truncated record in journal {self.path}")
+                    continue
+                if record["type"] == "plan":
+                    plan = record["plan"]
+                elif record["type"] == "created":
+                    results[record["row"]] = {
+                        "event_id": record["event_id"],
+                        "link": record["link"],
+                    }
+                elif record["type"] == "deleted":
+                    results[record["row"]] = None
+                elif record["type"] == "written":
+                    written.update(record["rows"])
+        return plan, results, written
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def complete(self):
+        """The sync is over: the journal is not needed anymore."""
+        self.close()
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,211 @@
+"""Metrics of the Google API requests of a run, by endpoint.
+
+For every endpoint (like "sheets.spreadsheets.values.batchGet", or "calendar.batch" for
+batch requests) haunts counts requests, errors and retries, and measures latency, bytes
+sent and received, time spent in backoff pauses and time spent waiting for quota.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+from tabulate import tabulate
+
+# Upper bounds of the latency histogram buckets, in milliseconds (the last one is unbounded)
+LATENCY_BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class EndpointStats:
+    """Counters of a single endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.backoff = 0.0
+        self.quota_wait = 0.0
+
+    def observe(self, latency):
+        self.requests += 1
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        milliseconds = latency * 1000
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if milliseconds <= bound:
+                self.histogram[index] += 1
+                return
+        self.histogram[-1] += 1
+
+    def percentile(self, percent):
+        """Upper bound (in milliseconds) of the bucket holding the given percentile."""
+        if not self.requests:
+            return None
+        threshold = self.requests * percent / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return None
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "latency_total": round(self.latency, 4),
+            "latency_max": round(self.max_latency, 4),
+            "latency_histogram": {
+                **{f"le_{bound}ms": count for bound, count in zip(LATENCY_BUCKETS, self.histogram)},
+                "le_inf": self.histogram[-1],
+            },
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "backoff": round(self.backoff, 4),
+            "quota_wait": round(self.quota_wait, 4),
+        }
+
+
+class Metrics:
+    """Metrics of all endpoints, shared by all threads.
+
+    Bytes are counted by the HTTP transport, and are assigned to the request the current
+    thread is executing.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.endpoints = {}
+
+    def _stats(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    @contextmanager
+    def request(self, endpoint):
+        """Measure a request to an endpoint."""
+        self.local.endpoint = endpoint
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            with self.lock:
+                self._stats(endpoint).errors += 1
+            raise
+        finally:
+            latency = time.monotonic() - start
+            self.local.endpoint = None
+            with self.lock:
+                self._stats(endpoint).observe(latency)
+
+    def add_bytes(self, sent, received):
+        endpoint = getattr(self.local, "endpoint", None) or "other"
+        with self.lock:
+            stats = self._stats(endpoint)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+
+    def add_retry(self, endpoint, backoff, count=1):
+        with self.lock:
+            stats = self._stats(endpoint)
+            stats.retries += count
+            stats.backoff += backoff
+
+    def add_quota_wait(self, endpoint, waited):
+        with self.lock:
+            self._stats(endpoint).quota_wait += waited
+
+    def to_dict(self):
+        with self.lock:
+            endpoints = {name: stats.to_dict() for name, stats in sorted(self.endpoints.items())}
+        totals = {
+            key: sum(endpoint[key] for endpoint in endpoints.values())
+            for key in (
+                "requests",
+                "errors",
+                "retries",
+                "bytes_sent",
+                "bytes_received",
+                "backoff",
+                "quota_wait",
+            )
+        }
+        return {
+            "elapsed": round(time.monotonic() - self.started, 4),
+            "totals": totals,
+            "endpoints": endpoints,
+        }
+
+    def save(self, path):
+        with open(path, "w") as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+
+    def echo(self):
+        """Print the summary table, with totals of the run."""
+        rows = self.summary()
+        if not rows:
+            click.echo("No Google API requests")
+            return
+        click.echo(tabulate(rows, headers=SUMMARY_HEADERS, tablefmt="simple"))
+        totals = self.to_dict()
+        click.echo(
+            f"{totals['totals']['requests']} requests in {totals['elapsed']:.1f}s "
+            f"({totals['totals']['retries']} retried, "
+            f"{totals['totals']['backoff']:.1f}s of backoff, "
+            f"{totals['totals']['quota_wait']:.1f}s waiting for quota)"
+        )
+
+    def summary(self):
+        """Rows of the summary table: one for every endpoint."""
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            return [
+                (
+                    name,
+                    stats.requests,
+                    stats.errors,
+                    stats.retries,
+                    f"{stats.latency / stats.requests * 1000:.0f}" if stats.requests else "-",
+                    stats.percentile(95) or f">{LATENCY_BUCKETS[-1]}",
+                    f"{stats.max_latency * 1000:.0f}",
+                    f"{stats.bytes_sent / 1024:.1f}",
+                    f"{stats.bytes_received / 1024:.1f}",
+                    f"{stats.backoff:.1f}",
+                    f"{stats.quota_wait:.1f}",
+                )
+                for name, stats in items
+            ]
+
+
+SUMMARY_HEADERS = (
+    "Endpoint",
+    "Requests",
+    "Errors",
+    "Retries",
+    "Avg ms",
+    "p95 ms",
+    "Max ms",
+    "Sent KB",
+    "Received KB",
+    "Backoff s",
+    "Quota wait s",
+)
+
+# Metrics of this run
+metrics = Metrics()
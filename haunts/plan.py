@@ -0,0 +1,119 @@
+"""Execution plans of a sync: calendar operations and sheet updates, computed before any write.
+
+A plan can be saved as JSON, shown as a dry run and applied later.
+"""
+
+import json
+import math
+
+import click
+from colorama import Back, Fore, Style
+
+from .calendars import CalendarBatch
+from .ini import get
+
+# Version 2: Action and Event id cells are part of row hashes
+PLAN_VERSION = 2
+
+
+class SyncPlan:
+    """Calendar operations required to sync a month sheet.
+
+    Every operation is a dict with the "type" ("insert" or "delete"), the sheet "row" it comes
+    from, the "hash" of the row content when planned (Link excluded), the "calendar" id and
+    the "event" body (inserts) or the "event_id" and a "description" (deletes).
+    columns are letters of the sheet columns written after every operation, by name
+    ("action", "event_id", "link").
+    """
+
+    def __init__(self, spreadsheet, sheet, headers, columns, operations, warn_lines=None):
+        self.spreadsheet = spreadsheet
+        self.sheet = sheet
+        self.headers = headers
+        self.columns = columns
+        self.operations = operations
+        self.warn_lines = warn_lines or []
+
+    @property
+    def inserts(self):
+        return [operation for operation in self.operations if operation["type"] == "insert"]
+
+    @property
+    def deletes(self):
+        return [operation for operation in self.operations if operation["type"] == "delete"]
+
+    def to_dict(self):
+        return {
+            "version": PLAN_VERSION,
+            "spreadsheet": self.spreadsheet,
+            "sheet": self.sheet,
+            "headers": self.headers,
+            "columns": self.columns,
+            "operations": self.operations,
+            "warn_lines": self.warn_lines,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version: {data.get('version')}")
+        return cls(
+            data["spreadsheet"],
+            data["sheet"],
+            data["headers"],
+            data["columns"],
+            data["operations"],
+            data.get("warn_lines", []),
+        )
+
+    def save(self, path):
+        with open(path, "w") as plan_file:
+            json.dump(self.to_dict(), plan_file, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as plan_file:
+            return cls.from_dict(json.load(plan_file))
+
+    def api_calls(self):
+        """Write requests needed to apply the plan, by API.
+
+        Deletes without an event id only clear their sheet row.
+        """
+        calendar_operations = len(self.inserts) + len(
+            [operation for operation in self.deletes if operation["event_id"]]
+        )
+        batch_size = min(
+            int(get("CALENDAR_BATCH_SIZE", CalendarBatch.MAX_SIZE)), CalendarBatch.MAX_SIZE
+        )
+        sheet_rows = max(1, int(get("SHEET_WRITE_BATCH_ROWS", 50)))
+        return {
+            "calendar": math.ceil(calendar_operations / batch_size),
+            "sheets": math.ceil(len(self.operations) / sheet_rows),
+        }
+
+    def echo(self):
+        """Show what applying the plan would do (dry run)."""
+        for operation in self.operations:
+            if operation["type"] == "insert":
+                event = operation["event"]
+                start = event["start"].get("dateTime", event["start"].get("date"))
+                click.echo(
+                    f'Line {operation["row"]}: create event "{event["summary"]}" at {start} '
+                    f'in calendar {operation["calendar"]}'
+                )
+            else:
+                click.echo(f'Line {operation["row"]}: delete event {operation["description"]}')
+        calls = self.api_calls()
+        click.echo(
+            f"{len(self.inserts)} events to create, {len(self.deletes)} to delete "
+            f"and {len(self.operations)} sheet rows to update on sheet {self.sheet}. "
+            f"API requests: {calls['calendar']} to Calendar (batches), {calls['sheets']} to Sheets"
+        )
+        if self.warn_lines:
+            click.echo(
+                Back.YELLOW
+                + Fore.BLACK
+                + f"Lines with warnings, not planned: {', '.join(map(str, self.warn_lines))}"
+                + Style.RESET_ALL
+            )
@@ -0,0 +1,67 @@
+"""Profiles: the configuration directory of a haunts user, with its settings and credentials.
+
+Commands run on behalf of the current profile: the default one, or the one activated in the
+current context (every thread of ``haunts batch`` runs a different profile). Functions run
+by other threads must be wrapped with ``bind`` to keep the profile of their caller.
+"""
+
+import configparser
+import contextvars
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Profile:
+    """Settings (from haunts.ini) and credentials of a configuration directory."""
+
+    def __init__(self, config_dir):
+        self.config_dir = Path(config_dir)
+        self.parser = configparser.RawConfigParser(allow_no_value=True)
+        # Credentials by token file, and scopes required by every token file
+        self.credentials = {}
+        self.token_scopes = {}
+        self.token_locks = {}
+        self.lock = threading.Lock()
+        # Sheet snapshots, when enabled
+        self.snapshots = None
+
+    def __repr__(self):
+        return f"<Profile {self.config_dir}>"
+
+    @property
+    def config(self):
+        return self.config_dir / "haunts.ini"
+
+    def load(self, config_file=None):
+        with open((config_file or self.config).resolve(), "r") as config:
+            self.parser.read_file(config)
+
+
+default_profile = Profile(Path("~/.haunts").expanduser())
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def current():
+    return current_profile.get() or default_profile
+
+
+@contextmanager
+def activate(profile):
+    """Run a block of code on behalf of a profile."""
+    token = current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        current_profile.reset(token)
+
+
+def bind(function):
+    """Wrap a function to run it, from any thread, with the profile of the caller."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can be entered by one thread at a time: every call gets its copy
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
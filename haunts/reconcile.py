@@ -0,0 +1,165 @@
+"""Reconcile calendar events with the sheet rows they were created from.
+
+Rows already synced (action "I" and an event id) are compared with their events: events
+are moved to another calendar when the project changed, and patched when the activity,
+details, date, start time or spent time changed.
+"""
+
+import datetime
+
+import click
+from colorama import Back, Fore, Style
+from dateutil import parser
+
+from . import actions
+from .calendars import CalendarBatch
+from .download import get_calendars_events_between
+from .entries import EntryDecoder
+from .ini import get
+from .spreadsheet import SheetWriteBuffer, get_calendars, get_month, get_sheet_service
+
+
+def text(value):
+    """Cell or event text, to be compared"""
+    return "" if value is None else str(value)
+
+
+def event_times(event):
+    """Start and end of an event: datetimes (in TIMEZONE) or dates for full day events."""
+    if "dateTime" in event["start"]:
+        return tuple(
+            parser.isoparse(event[key]["dateTime"]).replace(tzinfo=None) for key in ("start", "end")
+        )
+    return tuple(parser.isoparse(event[key]["date"]).date() for key in ("start", "end"))
+
+
+def expected_times(entry, event):
+    """Start and end the event of an entry should have.
+
+    Entries without a start time keep the start time of their event (when it has one).
+    """
+    if entry.spent is None or isinstance(entry.spent, str):
+        return entry.date, entry.date + datetime.timedelta(days=1)
+    if entry.start is not None:
+        start_time = datetime.time(entry.start // 60, entry.start % 60)
+    elif "dateTime" in event["start"]:
+        start_time = event_times(event)[0].time()
+    else:
+        start_time = datetime.datetime.strptime(get("START_TIME", "09:00"), "%H:%M").time()
+    start = datetime.datetime.combine(entry.date, start_time)
+    return start, start + datetime.timedelta(hours=float(entry.spent))
+
+
+def event_changes(entry, event):
+    """Body of the patch needed to make an event match its entry (empty if they already do)."""
+    changes = {}
+    if text(entry.activity) != text(event.get("summary")):
+        changes["summary"] = text(entry.activity)
+    if text(entry.details) != text(event.get("description")):
+        changes["description"] = text(entry.details)
+    times = expected_times(entry, event)
+    if times != event_times(event):
+        timezone = get("TIMEZONE", "Etc/GMT")
+        for key, value in zip(("start", "end"), times):
+            if isinstance(value, datetime.datetime):
+                changes[key] = {"dateTime": value.isoformat(), "date": None, "timeZone": timezone}
+            else:
+                changes[key] = {"date": value.isoformat(), "dateTime": None, "timeZone": timezone}
+    return changes
+
+
+def reconcile_events(config_dir, month, days=[], projects=[]):
+    """Public module entry point.
+
+    Read all events of the synced rows of a month sheet (every calendar once), then move and
+    patch only the events that differ from their rows.
+    """
+    sheet = get_sheet_service(config_dir)
+    click.echo(f"Reconciling calendars with sheet {month}…")
+
+    schema, data = get_month(sheet, month)
+    days = {d.date() for d in days}
+    entries = [
+        entry
+        for entry in EntryDecoder(schema).decode_rows(data["values"])
+        if entry.action == actions.IGNORE
+        and entry.event_id
+        and entry.serial is not None
+        and (not days or entry.date in days)
+        and (not projects or entry.project in projects)
+    ]
+    if not entries:
+        click.echo("No synced rows to reconcile.")
+        return
+
+    calendars = get_calendars(sheet)
+    calendar_ids = list(dict.fromkeys(calendars.values()))
+    events = {}
+    for calendar_events in get_calendars_events_between(
+        config_dir,
+        calendar_ids,
+        min(entry.date for entry in entries),
+        max(entry.date for entry in entries),
+    ):
+        events.update((event["id"], event) for event in calendar_events)
+
+    moves = []
+    patches = []
+    for entry in entries:
+        calendar = calendars.get(entry.project)
+        event = events.get(str(entry.event_id))
+        if calendar is None or event is None:
+            click.echo(
+                Back.YELLOW
+                + Fore.BLACK
+                + (
+                    f'Cannot find a calendar id associated to project "{entry.project}" '
+                    if calendar is None
+                    else f"Event {entry.event_id} not found in calendars around its date "
+                )
+                + f"at line {entry.row}. Skipping…"
+                + Style.RESET_ALL
+            )
+            continue
+        if event["calendar_id"] != calendar:
+            moves.append((entry, event["calendar_id"], calendar))
+        changes = event_changes(entry, event)
+        if changes:
+            patches.append((entry, calendar, changes))
+
+    click.echo(
+        f"{len(entries)} synced rows checked: {len(moves)} events to move "
+        f"and {len(patches)} to update"
+    )
+
+    def on_moved(entry, event, error):
+        if error is not None:
+            click.echo(
+                Back.RED
+                + f"Cannot move the event at line {entry.row}: {error.status_code}"
+                + Style.RESET_ALL
+            )
+            return
+        click.echo(f'Moved event "{entry.activity}" to calendar {entry.project}')
+        writer.update(entry.row, {link_col: f'=HYPERLINK("{event["htmlLink"]}";"open")'})
+
+    def on_patched(entry, event, error):
+        if error is not None:
+            click.echo(
+                Back.RED
+                + f"Cannot update the event at line {entry.row}: {error.status_code}"
+                + Style.RESET_ALL
+            )
+            return
+        click.echo(f'Updated event "{event.get("summary")}" from line {entry.row}')
+
+    link_col = schema.letter(get("LINK_COLUMN_NAME", "Link"))
+    with SheetWriteBuffer(sheet, month) as writer:
+        # Events are moved before being patched in their new calendar
+        with CalendarBatch(config_dir) as batch:
+            for entry, calendar, destination in moves:
+                batch.move(entry, calendar, str(entry.event_id), destination, on_moved)
+        with CalendarBatch(config_dir) as batch:
+            for entry, calendar, changes in patches:
+                batch.patch(entry, calendar, str(entry.event_id), changes, on_patched)
+    click.echo("Done!")
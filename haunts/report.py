@@ -1,93 +1,83 @@
 """Report module."""
 
 import datetime
-import numbers
 import sys
 
 import click
-from colorama import Back, Fore, Style
-from googleapiclient.discovery import build
+from colorama import Back, Style
 from googleapiclient.errors import HttpError
 from tabulate import SEPARATING_LINE, tabulate
 
 from . import LOGGER
-from . import actions
-from .calendars import LOCAL_TIMEZONE
-from .credentials import get_credentials
+from . import columns
+from . import snapshots
+from .entries import EntryDecoder, to_serial
 from .ini import get
-from .spreadsheet import ORIGIN_TIME, get_col, get_headers
+from .spreadsheet import SheetSchema, get_months, get_sheet_service
 
 # If scopes are modified, delete the sheets-token file
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
 
-def adjust_full_day(proj_stats):
-    """Calculate the value of a full day event, taking into account other events."""
-    value = 0
-    count = 0
-    total_overtime = 0
-    for entry_stats in proj_stats["projects"].values():
-        count += entry_stats["total"]
-        total_overtime += entry_stats["overtime"]
-    value = int(get("WORKING_HOURS", 8)) - count + total_overtime
-    # now properly adjust the full day value
-    for entry_stats in proj_stats["projects"].values():
-        if entry_stats["full_day"]:
-            entry_stats["total"] += value
-            break
-
-
-def print_report(report, days=[], projects=[], overtime=False):
-    rows = []
-    gran_total = 0
+def print_report(report, days=[], projects=[], overtime=False, rollup="day"):
+    """Print totals of a report, optionally rolled up by week, month or project."""
+    stats = report.aggregate(int(get("WORKING_HOURS", 8)))
     # Tranform report to be tabulate compatible
     headers = [
-        get("DATE_COLUMN_NAME", "Date"),
+        get("DATE_COLUMN_NAME", "Date") if rollup == "day" else rollup.capitalize(),
         get("PROJECT_COLUMN_NAME", "Project"),
         get("TOTAL_COLUMN_NAME", "Total"),
     ]
-    for date, proj_stats in report.items():
-        if proj_stats.get("have_full_day", False):
-            adjust_full_day(proj_stats)
-        for project, stat in proj_stats["projects"].items():
-            if stat.get("ignore"):
-                continue
-            overtime_value = stat["overtime"]
-            if overtime and overtime_value:
-                # Just want to count the overtime amount
-                total = overtime_value
-            else:
-                total = stat["total"]
-
-            if (
-                # not filtering by project, or project is in the list
-                (not projects or project in projects)
-                # not filtering by days, or day is in the list
-                and (not days or date in days)
-                # not filtering by overtime, or this is an overtime entry
-                and (not overtime or overtime_value)
-                # not marked has "ignore"
-                and (not proj_stats.get("ignore", False))
-            ):
-                rows.append([date, project, total])
-                gran_total += total
+    days = {to_serial(datetime.date.fromisoformat(day)) for day in days}
+    selected = [
+        position
+        for position in range(len(stats))
+        if (
+            # not marked has "ignore"
+            not stats.ignored[position]
+            # not filtering by project, or project is in the list
+            and (not projects or stats.project_names[stats.projects[position]] in projects)
+            # not filtering by days, or day is in the list
+            and (not days or stats.dates[position] in days)
+            # not filtering by overtime, or this is an overtime entry
+            and (not overtime or stats.overtimes[position])
+        )
+    ]
+    rows = [list(row) for row in columns.rollup_rows(stats, selected, rollup, overtime)]
+    if rollup == "project":
+        headers.pop(0)
+        rows = [row[1:] for row in rows]
 
     if not rows:
         click.echo("No data to display.")
         return
-    else:
-        rows.extend([SEPARATING_LINE, ["", "", gran_total]])
+    gran_total = sum(row[-1] for row in rows)
+    rows.extend([SEPARATING_LINE, [""] * (len(headers) - 1) + [gran_total]])
     click.echo(tabulate(rows, headers=headers, tablefmt="simple"))
 
 
-def create_report(sheet, sheet_name, data, overtime=False, filter=None):
-    """Create a time consumption report from a sheet."""
-    headers_id = get_headers(sheet, sheet_name, indexes=True)
+def create_report(
+    sheet,
+    sheet_name,
+    data,
+    overtime=False,
+    filter=None,
+    schema=None,
+    report=None,
+    from_date=None,
+    to_date=None,
+):
+    """Create a time consumption report from a sheet, read by columns.
+
+    When report is provided, sheet rows are added to it: this way a report can span many sheets.
+    Rows out of the range from_date - to_date (both included), when provided, are ignored.
+    """
+    decoder = EntryDecoder(schema or SheetSchema.fetch(sheet, sheet_name))
     overtime_from = get("OVERTIME_FROM", default=False)
 
-    dates = {}
+    report = columns.ReportColumns() if report is None else report
 
-    if overtime and not get("OVERTIME_FROM"):
+    if overtime and not overtime_from:
         click.echo(
             Back.RED
             + "Cannot filter by --overtime: OVERTIME_FROM is not set."
@@ -95,104 +85,57 @@ def create_report(sheet, sheet_name, data, overtime=False, filter=None):
         )
         sys.exit(1)
 
-    for y, row in enumerate(data["values"]):
-
-        action = ""
-        try:
-            action = row[headers_id["Action"]]
-        except IndexError:
-            # We have no action defined
-            pass
-
-        if action == actions.IGNORE_ALL:
-            continue
-
-        current_date = get_col(row, headers_id[get("DATE_COLUMN_NAME", "Date")])
-        if not current_date:
-            LOGGER.debug("No date found, skipping")
-            continue
-
-        date = (ORIGIN_TIME + datetime.timedelta(days=current_date)).date()
-        start_time = (
-            get_col(row, headers_id[get("START_TIME_COLUMN_NAME", "Start time")])
-            if headers_id.get(get("START_TIME_COLUMN_NAME", "Start time"))
-            and get_col(row, headers_id[get("START_TIME_COLUMN_NAME", "Start time")])
-            else None
-        )
-
-        in_overtime = False
-        if start_time and overtime_from:
-            start = datetime.datetime.strptime(
-                f"{date.strftime('%Y-%m-%d')}T{start_time}:00{LOCAL_TIMEZONE}",
-                "%Y-%m-%dT%H:%M:%S%z",
-            )
-            overtime = datetime.datetime.strptime(
-                f"{date.strftime('%Y-%m-%d')}T{overtime_from}:00{LOCAL_TIMEZONE}",
-                "%Y-%m-%dT%H:%M:%S%z",
-            )
-            if start >= overtime:
-                in_overtime = True
-
-        project = get_col(row, headers_id[get("PROJECT_COLUMN_NAME", "Project")])
-        date_stats = dates.get(
-            str(date),
-            {
-                "projects": {},
-                "have_full_day": False,
-            },
-        )
-        prog_stats = date_stats["projects"].get(
-            project,
-            {
-                "total": 0,
-                "overtime": 0,
-                "full_day": False,
-                "ignore": False,
-            },
-        )
-        spent = get_col(row, headers_id[get("SPENT_COLUMN_NAME", "Spent")])
-
-        # We have a value of spent hours in this event
-        if isinstance(spent, numbers.Number):
-            prog_stats["total"] += spent
-            if in_overtime:
-                prog_stats["overtime"] += spent
-        elif isinstance(spent, str) and not spent:
-            # Check: we have multiple full days in the same day! haunts is not supporting this
-            if date_stats["have_full_day"]:
-                click.echo(
-                    Back.YELLOW
-                    + Fore.BLACK
-                    + f"There are multiple full days in the same day: {str(date)}"
-                    + Style.RESET_ALL
-                )
-            else:
-                date_stats["have_full_day"] = True
-                prog_stats["full_day"] = True
-
-        # Filter defined, but it doesn't match
-        if filter and filter not in get_col(row, headers_id["Activity"], ""):
-            prog_stats["ignore"] = True
-
-        date_stats["projects"][project] = prog_stats
-        dates[str(date)] = date_stats
-
-    return dates
-
-
-def report(config_dir, sheet_name, days=[], projects=[], overtime=False, filter=None):
-    """Open a sheet, analyze it and extract stats."""
-    # The ID and range of the controller timesheet
-    creds = get_credentials(config_dir, SCOPES, "sheets-token.json")
-    service = build("sheets", "v4", credentials=creds)
-
-    # Call the Sheets API
-    sheet = service.spreadsheets()
+    report.add(
+        decoder.decode_columns(data["values"]),
+        overtime_from=overtime_from,
+        filter=filter,
+        from_date=from_date,
+        to_date=to_date,
+    )
+    LOGGER.debug(f"Report on {len(report)} rows after reading {sheet_name}")
+    return report
+
+
+def get_month_sheets(from_date, to_date):
+    """Get names of month sheets covering a range of dates.
+
+    Names are generated using the SHEET_NAME_FORMAT strftime format (default is "%B",
+    the month name).
+    """
+    names = []
+    current = from_date.replace(day=1)
+    while current <= to_date:
+        name = current.strftime(get("SHEET_NAME_FORMAT", "%B"))
+        if name not in names:
+            names.append(name)
+        current = (current + datetime.timedelta(days=32)).replace(day=1)
+    return names
+
+
+def report(
+    config_dir,
+    sheet_name=None,
+    days=[],
+    projects=[],
+    overtime=False,
+    filter=None,
+    from_day=None,
+    to_day=None,
+    rollup="day",
+):
+    """Open a sheet, analyze it and extract stats.
+
+    When a range of days is provided, all month sheets covering it are read at once
+    (or just sheet_name, if provided).
+    """
+    # Call the Sheets API (unless all sheets are read from local snapshots)
+    cache = snapshots.get_cache()
+    sheet = None if cache and cache.offline else get_sheet_service(config_dir)
 
     click.echo("Collecting report…")
 
     try:
-        document_id = get("CONTROLLER_SHEET_DOCUMENT_ID")
+        get("CONTROLLER_SHEET_DOCUMENT_ID")
     except KeyError:
         click.echo(
             "A value for CONTROLLER_SHEET_DOCUMENT_ID is required but "
@@ -200,29 +143,40 @@ def report(config_dir, sheet_name, days=[], projects=[], overtime=False, filter=
         )
         sys.exit(1)
 
+    from_date = datetime.datetime.strptime(from_day, "%Y-%m-%d").date() if from_day else None
+    to_date = datetime.datetime.strptime(to_day, "%Y-%m-%d").date() if to_day else None
+    if sheet_name:
+        sheet_names = [sheet_name]
+    else:
+        sheet_names = get_month_sheets(from_date or to_date, to_date or from_date)
+
     try:
-        data = (
-            sheet.values()
-            .get(
-                spreadsheetId=document_id,
-                range=f"{sheet_name}!A2:ZZ",
-                valueRenderOption="UNFORMATTED_VALUE",
-            )
-            .execute()
-        )
+        months_data = get_months(sheet, sheet_names, major_dimension="COLUMNS")
     except HttpError as err:
         click.echo(
             Back.RED
-            + f'Sheet "{sheet_name}" not found or not accessible.'
+            + f"Sheets {', '.join(sheet_names)} not found or not accessible."
             + Style.RESET_ALL
         )
         click.echo(err.error_details)
         sys.exit(1)
 
-    computed_report = create_report(
-        sheet=sheet, sheet_name=sheet_name, data=data, overtime=overtime, filter=filter
-    )
+    computed_report = columns.ReportColumns()
+    for name, (schema, data) in zip(sheet_names, months_data):
+        create_report(
+            sheet=sheet,
+            sheet_name=name,
+            data=data,
+            overtime=overtime,
+            filter=filter,
+            schema=schema,
+            report=computed_report,
+            from_date=from_date,
+            to_date=to_date,
+        )
 
     click.echo("")
-    print_report(computed_report, days=days, projects=projects, overtime=overtime)
+    print_report(
+        computed_report, days=days, projects=projects, overtime=overtime, rollup=rollup
+    )
     click.echo("")
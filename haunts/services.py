@@ -0,0 +1,80 @@
+"""Google API clients, built once and shared by all haunts commands"""
+
+import json
+import pickle
+import threading
+from importlib.metadata import version
+
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+
+from . import LOGGER
+from .credentials import get_credentials
+from .transport import SessionHttp
+
+# Built services, by (api, version, token file)
+services_cache = {}
+# Parsed discovery documents, by (api, version)
+documents_cache = {}
+# Building a service touches the shared discovery document
+build_lock = threading.Lock()
+
+
+def get_discovery_document(config_dir, api, api_version):
+    """Return the parsed discovery document of an API.
+
+    Parsed documents are stored in the "discovery" folder inside the configuration directory,
+    so next runs skip the JSON parsing.
+    """
+    document = documents_cache.get((api, api_version))
+    if document is not None:
+        return document
+    document = _load_discovery_document(config_dir, api, api_version)
+    documents_cache[(api, api_version)] = document
+    return document
+
+
+def _load_discovery_document(config_dir, api, api_version):
+    cache_dir = config_dir / "discovery"
+    cache_file = cache_dir / f"{api}.{api_version}.{version('google-api-python-client')}.pickle"
+    if cache_file.is_file():
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            LOGGER.debug(f"Discovery cache at {cache_file} is broken, ignoring it")
+    document = discovery_cache.get_static_doc(api, api_version)
+    if document is None:
+        return None
+    document = json.loads(document)
+    try:
+        cache_dir.mkdir(exist_ok=True)
+        with open(cache_file, "wb") as f:
+            pickle.dump(document, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        LOGGER.debug(f"Cannot write discovery cache at {cache_file}")
+    return document
+
+
+def get_service(config_dir, api, api_version, scopes, token_file):
+    """Return the service object for an API, building it only the first time.
+
+    All services share the same pooled HTTP transport, and can be used by many threads.
+    """
+    key = (api, api_version, str(config_dir / token_file))
+    service = services_cache.get(key)
+    if service is not None:
+        return service
+    http = SessionHttp(get_credentials(config_dir, scopes, token_file))
+    with build_lock:
+        service = services_cache.get(key)
+        if service is not None:
+            return service
+        document = get_discovery_document(config_dir, api, api_version)
+        if document is not None:
+            service = build_from_document(document, http=http)
+        else:
+            # Not a bundled API: let the client library discover it
+            service = build(api, api_version, http=http)
+        services_cache[key] = service
+    return service
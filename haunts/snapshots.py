@@ -0,0 +1,247 @@
+"""Local snapshots of month sheets, used to skip downloading sheets not changed since last read.
+
+Snapshots are stored in the "cache" folder inside the configuration directory, one file per
+sheet, in a binary format that is read through a memory map:
+
+- a fixed header (magic, lengths of the sections below)
+- the spreadsheet version the snapshot was taken at
+- the number of cells of every row
+- for every cell, the index of its value in the table of distinct values
+- the kind of every distinct value (missing, integer, float, string, boolean)
+- a float for every distinct value: the number itself, or the index of the string
+- offsets of strings, followed by all strings encoded as UTF-8
+
+Freshness is checked with the Drive API, comparing the current version of the spreadsheet
+with the one stored in the snapshot.
+"""
+
+import gc
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import sys
+
+import click
+
+from . import LOGGER
+from .api import DRIVE, execute
+from .ini import get, get_boolean
+from .profiles import current
+from .services import get_service
+
+# If scopes are modified, delete the drive-token file
+SCOPES = ["https://www.googleapis.com/auth/drive.metadata.readonly"]
+
+MAGIC = b"HAUNTS\x02\x00"
+# version length, rows, cells, distinct values, strings, strings total length
+HEADER = struct.Struct("<8sIIIIII")
+
+MISSING = 0
+INTEGER = 1
+FLOAT = 2
+STRING = 3
+TRUE = 4
+FALSE = 5
+
+
+def init(config_dir, offline=False):
+    """Enable snapshots for the current profile if configured, or if running offline."""
+    if offline or get_boolean("SNAPSHOT_CACHE"):
+        current().snapshots = SnapshotCache(config_dir, offline=offline)
+    else:
+        current().snapshots = None
+
+
+def get_cache():
+    """Snapshots of the current profile, or None if not enabled."""
+    return current().snapshots
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def encode(version, rows):
+    """Encode a sheet snapshot: rows are lists of values, as returned by the Sheets API."""
+    version = version.encode("utf-8")
+    widths = [len(row) for row in rows]
+    # Every distinct value is stored once, cells are indexes of values
+    values = {}
+    cells = [
+        values.setdefault((type(value), value), len(values)) for row in rows for value in row
+    ]
+    kinds = bytearray()
+    numbers = []
+    strings = []
+    for value_type, value in values:
+        if value is None:
+            kinds.append(MISSING)
+            numbers.append(0.0)
+        elif value_type is bool:
+            kinds.append(TRUE if value else FALSE)
+            numbers.append(0.0)
+        elif value_type in (int, float):
+            kinds.append(INTEGER if value_type is int else FLOAT)
+            numbers.append(value)
+        else:
+            kinds.append(STRING)
+            numbers.append(len(strings))
+            strings.append(str(value).encode("utf-8"))
+    offsets = [0]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    blob = b"".join(strings)
+
+    sections = [
+        HEADER.pack(
+            MAGIC, len(version), len(rows), len(cells), len(kinds), len(strings), len(blob)
+        ),
+        version,
+        struct.pack(f"<{len(widths)}I", *widths),
+        struct.pack(f"<{len(cells)}I", *cells),
+        bytes(kinds),
+        struct.pack(f"<{len(numbers)}d", *numbers),
+        struct.pack(f"<{len(offsets)}I", *offsets),
+        blob,
+    ]
+    # Every section starts at a multiple of 8 bytes, so it can be cast without copies
+    return b"".join(section + b"\0" * (_align(len(section)) - len(section)) for section in sections)
+
+
+def _sections(buffer):
+    magic, version_size, rows, cells, values, strings, blob_size = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError("Not a haunts snapshot")
+    view = memoryview(buffer)
+    position = _align(HEADER.size)
+
+    def take(size):
+        nonlocal position
+        section = view[position : position + size]
+        position += _align(size)
+        return section
+
+    return (
+        bytes(take(version_size)).decode("utf-8"),
+        take(rows * 4).cast("I"),
+        take(cells * 4).cast("I"),
+        take(values),
+        take(values * 8).cast("d"),
+        take((strings + 1) * 4).cast("I"),
+        take(blob_size),
+    )
+
+
+def read_version(buffer):
+    """Version of a snapshot, reading just its header."""
+    magic, version_size = HEADER.unpack_from(buffer)[:2]
+    if magic != MAGIC:
+        raise ValueError("Not a haunts snapshot")
+    return bytes(buffer[_align(HEADER.size) : _align(HEADER.size) + version_size]).decode("utf-8")
+
+
+def decode(buffer):
+    """Decode a snapshot, returning its version and rows."""
+    version, widths, cells, kinds, numbers, offsets, blob = _sections(buffer)
+    values = []
+    for kind, number in zip(kinds, numbers):
+        if kind == INTEGER:
+            values.append(int(number))
+        elif kind == FLOAT:
+            values.append(number)
+        elif kind == STRING:
+            index = int(number)
+            values.append(str(blob[offsets[index] : offsets[index + 1]], "utf-8"))
+        else:
+            values.append({MISSING: None, TRUE: True, FALSE: False}[kind])
+    # Distinct values are few: cells are resolved by indexing, without Python loops
+    cells = list(map(values.__getitem__, cells.tolist()))
+    ends = list(itertools.accumulate(widths.tolist()))
+    # Creating many rows at once would trigger many useless garbage collections
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        rows = [cells[end - width : end] for end, width in zip(ends, widths.tolist())]
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return version, rows
+
+
+def get_spreadsheet_version(config_dir, spreadsheet):
+    """Current version of a spreadsheet: it changes every time the spreadsheet is modified."""
+    drive = get_service(config_dir, "drive", "v3", SCOPES, "drive-token.json")
+    return execute(drive.files().get(fileId=spreadsheet, fields="version"), DRIVE)["version"]
+
+
+class SnapshotCache:
+    """Snapshots of whole month sheets, stored in the configuration directory.
+
+    When offline, snapshots are used without checking if they are still fresh.
+    """
+
+    def __init__(self, config_dir, offline=False):
+        self.config_dir = config_dir
+        self.path = config_dir / "cache"
+        self.offline = offline
+
+    def file(self, spreadsheet, sheet):
+        key = hashlib.sha1(f"{spreadsheet}\0{sheet}".encode("utf-8")).hexdigest()
+        return self.path / f"{key}.snapshot"
+
+    def version(self, spreadsheet):
+        """Version to compare snapshots with, or None when offline."""
+        if self.offline:
+            return None
+        return get_spreadsheet_version(self.config_dir, spreadsheet)
+
+    def load(self, spreadsheet, sheet, version=None):
+        """Rows of a sheet snapshot taken at version (any version if None), or None."""
+        snapshot = self.file(spreadsheet, sheet)
+        try:
+            with open(snapshot, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if version is not None and read_version(m) != version:
+                    LOGGER.debug(f"Snapshot of {sheet} is outdated")
+                    return None
+                _, rows = decode(m)
+                return rows
+        except (OSError, ValueError, BufferError, struct.error):
+            LOGGER.debug(f"No valid snapshot of {sheet} at {snapshot}")
+            return None
+
+    def save(self, spreadsheet, sheet, version, rows):
+        snapshot = self.file(spreadsheet, sheet)
+        try:
+            self.path.mkdir(exist_ok=True)
+            temporary = snapshot.with_suffix(".tmp")
+            with open(temporary, "wb") as f:
+                f.write(encode(version, rows))
+            os.replace(temporary, snapshot)
+        except OSError:
+            LOGGER.debug(f"Cannot write snapshot at {snapshot}")
+
+
+def read_sheets(months, fetch):
+    """Rows (headers included) of many month sheets, using snapshots when enabled and fresh.
+
+    fetch is called with the list of sheets to download, and must return their rows.
+    """
+    cache = get_cache()
+    if cache is None:
+        return fetch(months)
+    spreadsheet = get("CONTROLLER_SHEET_DOCUMENT_ID")
+    version = cache.version(spreadsheet)
+    rows = {month: cache.load(spreadsheet, month, version) for month in months}
+    outdated = [month for month in months if rows[month] is None]
+    if outdated and cache.offline:
+        for month in outdated:
+            click.echo(f'No local snapshot of sheet "{month}": cannot read it while offline.')
+        sys.exit(1)
+    if outdated:
+        for month, month_rows in zip(outdated, fetch(outdated)):
+            rows[month] = month_rows
+            cache.save(spreadsheet, month, version, month_rows)
+    LOGGER.debug(f"{len(months) - len(outdated)} of {len(months)} sheets read from snapshots")
+    return [rows[month] for month in months]
@@ -1,22 +1,39 @@
-import datetime
+import numbers
 import string
+from functools import partial
 import sys
-import time
+import uuid
 import click
 from colorama import Back, Fore, Style
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 from . import LOGGER
 from . import actions
-from .credentials import get_credentials
-from .calendars import ORIGIN_TIME, create_event, delete_event
+from . import snapshots
+from .api import CALENDAR, SHEETS_READ, SHEETS_WRITE, execute
+from .services import get_service
+from .state import StateStore, row_hash
+from .calendars import (
+    CalendarBatch,
+    echo_created_event,
+    echo_missing_event,
+    get_calendar_service,
+    prepare_event,
+)
+from .entries import EntryDecoder
+from .journal import SyncJournal
+from .plan import SyncPlan
 from .ini import get
 
 # If scopes are modified, delete the sheets-token file
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
 
+def get_sheet_service(config_dir):
+    """Return the spreadsheets resource of the Google Sheets API."""
+    return get_service(config_dir, "sheets", "v4", SCOPES, "sheets-token.json").spreadsheets()
+
+
 def get_col(row, index, default=None):
     try:
         return row[index]
@@ -24,80 +41,351 @@ def get_col(row, index, default=None):
         return default
 
 
-def get_headers(sheet, month, indexes=False):
-    """Scan headers of a month and returns a structure that assign headers names to indexes"""
-    selected_month = (
+def column_letter(index):
+    """Transform a zero-based column index to its letters in A1 notation (A, B, …, Z, AA, AB, …)"""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = string.ascii_uppercase[remainder] + letters
+    return letters
+
+
+class SheetSchema:
+    """Headers of a month sheet, giving both column indexes and column letters by header name.
+
+    When the same header is used multiple times, the first column wins.
+    """
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.indexes = {}
+        for index, name in enumerate(headers):
+            self.indexes.setdefault(name, index)
+        self.letters = {name: column_letter(index) for name, index in self.indexes.items()}
+
+    def index(self, name):
+        return self.indexes[name]
+
+    def letter(self, name):
+        return self.letters[name]
+
+    @classmethod
+    def fetch(cls, sheet, month):
+        """Read headers from the first row of a month sheet."""
+        selected_month = execute(
+            sheet.values()
+            .get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=f"{month}!A1:ZZ1"),
+            SHEETS_READ,
+        )
+        return cls(selected_month.get("values", [[]])[0])
+
+
+def fetch_months(sheet, months, major_dimension="ROWS"):
+    """Download whole month sheets (headers included) with a single request."""
+    response = execute(
+        sheet.values().batchGet(
+            spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"),
+            ranges=[f"{month}!A1:ZZ" for month in months],
+            valueRenderOption="UNFORMATTED_VALUE",
+            majorDimension=major_dimension,
+        ),
+        SHEETS_READ,
+    )
+    return [value_range.get("values", []) for value_range in response["valueRanges"]]
+
+
+def rows_to_columns(rows):
+    """Transpose rows to columns, like the COLUMNS major dimension of the Sheets API does."""
+    columns = [
+        [get_col(row, index) for row in rows]
+        for index in range(max((len(row) for row in rows), default=0))
+    ]
+    for column in columns:
+        while column and column[-1] is None:
+            column.pop()
+    return columns
+
+
+def get_month(sheet, month):
+    """Read a whole month sheet with a single request (or from its local snapshot).
+
+    Returns the sheet schema and the data rows (headers row excluded).
+    """
+    values = snapshots.read_sheets([month], partial(fetch_months, sheet))[0]
+    schema = SheetSchema(values[0] if values else [])
+    return schema, {"values": values[1:]}
+
+
+def get_months(sheet, months, major_dimension="ROWS"):
+    """Read many whole month sheets with a single request (or from their local snapshots).
+
+    Returns a list of sheet schema and data rows, like get_month, for every sheet.
+    With major_dimension="COLUMNS" data values are columns instead of rows (headers excluded).
+    """
+    if major_dimension == "COLUMNS" and snapshots.get_cache() is None:
+        months_columns = fetch_months(sheet, months, major_dimension)
+    else:
+        months_values = snapshots.read_sheets(months, partial(fetch_months, sheet))
+        if major_dimension == "ROWS":
+            return [
+                (SheetSchema(values[0] if values else []), {"values": values[1:]})
+                for values in months_values
+            ]
+        months_columns = [rows_to_columns(values) for values in months_values]
+    months_data = []
+    for columns in months_columns:
+        headers = [get_col(column, 0, "") for column in columns]
+        months_data.append((SheetSchema(headers), {"values": [column[1:] for column in columns]}))
+    return months_data
+
+
+def get_month_changes(sheet, month, state):
+    """Read rows of a month sheet that can require a sync, based on the state of the last sync.
+
+    Rows after the watermark are always read, while rows before it are read only when they
+    have a date but are not flagged with an ignore action.
+    Returns the same structure of get_month, where rows not read are empty and their sheet
+    row numbers are listed in the "skipped_rows" key.
+    A full read is done when the sheet was never synced or its layout changed.
+    """
+    document_id = get("CONTROLLER_SHEET_DOCUMENT_ID")
+    stored = state.get_sheet(document_id, month)
+    if not stored or stored[1] < 2:
+        return get_month(sheet, month)
+    headers, watermark = stored
+    schema = SheetSchema(headers)
+    try:
+        date_col = schema.letter(get("DATE_COLUMN_NAME", "Date"))
+        action_col = schema.letter(get("ACTION_COLUMN_NAME", "Action"))
+    except KeyError:
+        return get_month(sheet, month)
+
+    response = execute(
         sheet.values()
-        .get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=f"{month}!A1:ZZ1")
-        .execute()
+        .batchGet(
+            spreadsheetId=document_id,
+            ranges=[
+                f"{month}!A1:ZZ1",
+                f"{month}!{date_col}2:{date_col}{watermark - 1}",
+                f"{month}!{action_col}2:{action_col}{watermark - 1}",
+                # The watermark row is read again, to check that the sheet is still the same
+                f"{month}!A{watermark}:ZZ",
+            ],
+            valueRenderOption="UNFORMATTED_VALUE",
+        ),
+        SHEETS_READ,
     )
-    values = selected_month["values"][0]
-    if indexes:
-        return {k: values.index(k) for k in values}
-    return {k: string.ascii_lowercase.upper()[values.index(k)] for k in values}
+    header_values, date_values, action_values, tail = [
+        value_range.get("values", []) for value_range in response["valueRanges"]
+    ]
+    if (header_values[0] if header_values else []) != headers:
+        LOGGER.debug(f"Headers of {month} changed since last sync: reading the whole sheet")
+        return get_month(sheet, month)
+    if row_hash(tail[0] if tail else [], written_indexes(schema)) != state.get_hash(
+        document_id, month, watermark
+    ):
+        LOGGER.debug(f"Sheet {month} changed before row {watermark}: reading the whole sheet")
+        return get_month(sheet, month)
+
+    values = [[] for _ in range(watermark - 2)] + tail
+    changed = [
+        y + 2
+        for y in range(watermark - 2)
+        if get_col(get_col(date_values, y, []), 0)
+        and get_col(get_col(action_values, y, []), 0, "")
+        not in (actions.IGNORE, actions.IGNORE_ALL)
+    ]
+    if changed:
+        # Group consecutive rows, to read them with as few ranges as possible
+        groups = []
+        for row in changed:
+            if groups and groups[-1][1] == row - 1:
+                groups[-1][1] = row
+            else:
+                groups.append([row, row])
+        response = execute(
+            sheet.values()
+            .batchGet(
+                spreadsheetId=document_id,
+                ranges=[f"{month}!A{first}:ZZ{last}" for first, last in groups],
+                valueRenderOption="UNFORMATTED_VALUE",
+            ),
+            SHEETS_READ,
+        )
+        for (first, _), value_range in zip(groups, response["valueRanges"]):
+            for offset, row in enumerate(value_range.get("values", [])):
+                values[first - 2 + offset] = row
+    LOGGER.debug(f"Read {len(changed) + len(tail)} rows of {month} since row {watermark}")
+    return schema, {
+        "values": values,
+        "skipped_rows": set(range(2, watermark)) - set(changed),
+    }
+
+
+def written_indexes(schema):
+    """Indexes of columns written by haunts on sync: they are not part of the row hash"""
+    return {
+        schema.indexes.get(get(name, default))
+        for name, default in (
+            ("ACTION_COLUMN_NAME", "Action"),
+            ("EVENT_ID_COLUMN_NAME", "Event id"),
+            ("LINK_COLUMN_NAME", "Link"),
+        )
+    }
 
 
-def sync_events(config_dir, sheet, data, calendars, days, month, projects=[], allowed_actions=[]):
-    """Create an event when action column is empty."""
-    headers = get_headers(sheet, month)
-    headers_id = get_headers(sheet, month, indexes=True)
-    last_to_time = None
-    last_date = None
-    warn_lines = []
+def save_sync_state(state, month, schema, data, processed_rows):
+    """Store row hashes and the new watermark of a month sheet after a sync.
 
+    The watermark is the last row of the sheet before which every row has been processed:
+    rows flagged with an ignore action, rows without a date or rows synced right now.
+    """
+    skipped_rows = data.get("skipped_rows", set())
+    ignored_indexes = written_indexes(schema)
+    date_index = schema.index(get("DATE_COLUMN_NAME", "Date"))
+    action_index = schema.index(get("ACTION_COLUMN_NAME", "Action"))
+    watermark = 1
+    hashes = {}
     for y, row in enumerate(data["values"]):
-        action = ""
+        if y + 2 in skipped_rows:
+            done = True
+        else:
+            hashes[y + 2] = row_hash(row, ignored_indexes)
+            done = (
+                y + 2 in processed_rows
+                or not get_col(row, date_index)
+                or get_col(row, action_index, "") in (actions.IGNORE, actions.IGNORE_ALL)
+            )
+        if done and watermark == y + 1:
+            watermark = y + 2
+    state.save(get("CONTROLLER_SHEET_DOCUMENT_ID"), month, schema.headers, watermark, hashes)
+
+
+class SheetWriteBuffer:
+    """Collect cell writes for a month sheet and send them as chunked ``batchUpdate`` calls.
+
+    Writes are grouped by row. Every ``flush_every`` rows the pending writes are sent
+    as a single chunk, remaining ones are sent by ``flush``.
+    Clearing a cell is performed by writing an empty value on it.
+    ``on_written`` is called with the row numbers of every chunk written.
+    """
+
+    def __init__(self, sheet, month, flush_every=None, on_written=None):
+        self.sheet = sheet
+        self.month = month
+        self.flush_every = max(1, int(flush_every or get("SHEET_WRITE_BATCH_ROWS", 50)))
+        self.on_written = on_written
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return
+        # Write what can be written, without hiding the error that stopped the sync
         try:
-            action = row[headers_id[get("ACTION_COLUMN_NAME", "Action")]]
-        except IndexError:
-            # We have no action defined
-            pass
+            self.flush()
+        except Exception as err:
+            LOGGER.debug(f"Cannot write pending cells on sheet {self.month}: {err}")
+
+    def update(self, row, cells):
+        """Queue writes for a sheet row.
+
+        cells is a dict that assign column letters to values.
+        """
+        self.pending.append(
+            (
+                row,
+                [
+                    {"range": f"{self.month}!{col}{row}", "values": [[value]]}
+                    for col, value in cells.items()
+                ],
+            )
+        )
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def clear(self, row, cols):
+        """Queue the clear of some cells in a sheet row."""
+        self.update(row, {col: "" for col in cols})
+
+    def flush(self):
+        """Send all pending writes, one chunk of rows at time."""
+        while self.pending:
+            chunk = self.pending[: self.flush_every]
+            self._write_chunk([data for _, row_data in chunk for data in row_data])
+            # Drop the chunk only when written: a failure keeps it for a later flush
+            del self.pending[: len(chunk)]
+            if self.on_written:
+                self.on_written([row for row, _ in chunk])
+
+    def _write_chunk(self, data):
+        request = self.sheet.values().batchUpdate(
+            spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"),
+            body={
+                "valueInputOption": "USER_ENTERED",
+                "data": data,
+            },
+        )
+        LOGGER.debug(f"Writing {len(data)} cells on sheet {self.month}")
+        execute(request, SHEETS_WRITE)
+
+
+def allocate_events(data, schema, calendars, days, projects=[], allowed_actions=[]):
+    """Compute calendar operations required to sync a month sheet, without calling any API.
+
+    Start times of new events are allocated here: an event without a start time begins
+    where the previous one in the same day ends.
+    Returns the list of operations and sheet row numbers with warnings.
+    """
+    last_to_time = None
+    last_date = None
+    operations = []
+    warn_lines = []
+    days = {d.date() for d in days}
 
-        project = get_col(row, headers_id[get("PROJECT_COLUMN_NAME", "Project")])
+    for entry in EntryDecoder(schema).decode_rows(data["values"]):
+        action = entry.action
+        project = entry.project
 
         if action == actions.IGNORE or action == actions.IGNORE_ALL:
             continue
 
         if (
             # We want to filter by Action value and current action is not in the provided set
-            (allowed_actions and action not in allowed_actions and "empty" not in allowed_actions)
+            (
+                allowed_actions
+                and action not in allowed_actions
+                and "empty" not in allowed_actions
+            )
             or
             # …or action is not empty and we want to act on empty Action lines only
             (action and "empty" in allowed_actions)
         ):
             LOGGER.debug(
-                f"Action {action} at line {y + 1}, not in allowed actions {allowed_actions}"
+                f"Action {action} at line {entry.row}, not in allowed actions {allowed_actions}"
             )
             continue
 
-        current_date = get_col(row, headers_id["Date"])
-        if not current_date:
-            LOGGER.debug(f"No date found at line {y + 1}, skipping")
+        if entry.serial is None:
+            LOGGER.debug(f"No date found at line {entry.row}, skipping")
             continue
 
         if projects and project not in projects:
             continue
 
-        date = ORIGIN_TIME + datetime.timedelta(days=current_date)
-        default_start_time = (
-            get_col(row, headers_id[get("START_TIME_COLUMN_NAME", "Start time")])
-            if headers_id.get(get("START_TIME_COLUMN_NAME", "Start time"))
-            and get_col(row, headers_id[get("START_TIME_COLUMN_NAME", "Start time")])
-            else None
-        )
+        date = entry.date
 
         # In case we changed day, let's restart from START_TIME
-        if current_date != last_date:
+        if entry.serial != last_date:
             last_to_time = None
-        last_date = current_date
+        last_date = entry.serial
 
         # short circuit for date filters
-        skip = len(days) > 0
-        for d in days:
-            if date.date() == d.date():
-                skip = False
-                break
-        if skip:
+        if days and date not in days:
             continue
 
         calendar = None
@@ -110,48 +398,26 @@ def sync_events(config_dir, sheet, data, calendars, days, month, projects=[], al
                 + Fore.BLACK
                 + (
                     f"Cannot find a calendar id associated to project "
-                    f'"{get_col(row, headers_id["Project"])}" at line {y + 2}'
+                    f'"{project}" at line {entry.row}'
                 )
                 + Style.RESET_ALL
             )
-            warn_lines.append(y)
+            warn_lines.append(entry.row)
             continue
 
         if action == actions.DELETE:
-            delete_event(
-                config_dir=config_dir,
-                calendar=calendar,
-                event_id=get_col(row, headers_id[get("EVENT_ID_COLUMN_NAME", "Event id")]),
-            )
-            click.echo(
-                f"Deleted event "
-                f'"{get_col(row, headers_id[get("ACTIVITY_COLUMN_NAME", "Activity")])}" in date '
-                f"{date.strftime('%d/%m')} from calendar {project}"
-            )
-            request = sheet.values().batchClear(
-                spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"),
-                body={
-                    "ranges": [
-                        f"{month}!{headers[get('EVENT_ID_COLUMN_NAME', 'Event id')]}{y + 2}",
-                        f"{month}!{headers[get('LINK_COLUMN_NAME', 'Link')]}{y + 2}",
-                        f"{month}!{headers[get('ACTION_COLUMN_NAME', 'Action')]}{y + 2}",
-                    ],
-                },
+            operations.append(
+                {
+                    "type": "delete",
+                    "row": entry.row,
+                    "calendar": calendar,
+                    "event_id": entry.event_id,
+                    "description": (
+                        f'"{entry.activity}" in date {date.strftime("%d/%m")} '
+                        f"from calendar {project}"
+                    ),
+                }
             )
-
-            try:
-                request.execute()
-            except HttpError as err:
-                if err.status_code == 429:
-                    click.echo("Too many requests")
-                    click.echo(err.error_details)
-                    click.echo("haunts will now pause for a while ⏲…")
-                    time.sleep(60)
-                    click.echo("Retrying…")
-                    request.execute()
-                else:
-                    raise
-
             continue
 
         if action:
@@ -159,61 +425,196 @@ def sync_events(config_dir, sheet, data, calendars, days, month, projects=[], al
             click.echo(
                 Back.YELLOW
                 + Fore.BLACK
-                + f'Unknown action "{action}" at line {y + 2}. Ignoring…'
+                + f'Unknown action "{action}" at line {entry.row}. Ignoring…'
                 + Style.RESET_ALL
             )
-            warn_lines.append(y)
+            warn_lines.append(entry.row)
             continue
 
-        event = create_event(
-            config_dir=config_dir,
-            calendar=calendar,
+        event_body, last_to_time = prepare_event(
             date=date,
-            summary=get_col(row, headers_id[get("ACTIVITY_COLUMN_NAME", "Activity")]),
-            details=get_col(row, headers_id[get("DETAILS_COLUMN_NAME", "Details")]),
-            length=get_col(row, headers_id[get("SPENT_COLUMN_NAME", "Spent")]),
-            from_time=default_start_time or last_to_time,
+            summary=entry.activity,
+            details=entry.details,
+            length=entry.spent,
+            from_time=entry.start_time or last_to_time,
         )
-        last_to_time = event["next_slot"]
-
-        request = sheet.values().batchUpdate(
-            spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"),
-            body={
-                "valueInputOption": "USER_ENTERED",
-                "data": [
-                    # Put the action to actions.IGNORE, in this way it will not be processed again
-                    {
-                        "range": f"{month}!{headers[get('ACTION_COLUMN_NAME', 'Action')]}{y + 2}",
-                        "values": [[actions.IGNORE]],
-                    },
-                    # Save the event id, required to interact with the event in future
-                    {
-                        "range": (
-                            f"{month}!{headers[get('EVENT_ID_COLUMN_NAME', 'Event id')]}{y + 2}"
-                        ),
-                        "values": [[event["id"]]],
-                    },
-                    # Quick link to the event on the calendar
-                    {
-                        "range": f"{month}!{headers[get('LINK_COLUMN_NAME', 'Link')]}{y + 2}",
-                        "values": [[f'=HYPERLINK("{event["link"]}";"open")']],
-                    },
-                ],
-            },
+        operations.append(
+            {"type": "insert", "row": entry.row, "calendar": calendar, "event": event_body}
         )
 
-        try:
-            request.execute()
-        except HttpError as err:
-            if err.status_code == 429:
-                click.echo("Too many requests")
-                click.echo(err.error_details)
-                click.echo("haunts will now pause for a while ⏲…")
-                time.sleep(60)
-                click.echo("Retrying…")
-                request.execute()
+    return operations, warn_lines
+
+
+def planned_indexes(schema):
+    """Indexes of columns that are not part of the hash of planned rows.
+
+    Only the link is left out: a row synced (or deleted) after the plan was made changes its
+    Action and Event id, and the plan must not be applied to it again.
+    """
+    return {schema.indexes.get(get("LINK_COLUMN_NAME", "Link"))}
+
+
+def plan_sync(data, schema, calendars, days, month, projects=[], allowed_actions=[]):
+    """Plan the calendar operations and sheet updates required to sync a month sheet."""
+    operations, warn_lines = allocate_events(
+        data,
+        schema,
+        calendars,
+        days,
+        projects=projects,
+        allowed_actions=allowed_actions,
+    )
+    ignored_indexes = planned_indexes(schema)
+    for operation in operations:
+        row = get_col(data["values"], operation["row"] - 2, [])
+        operation["hash"] = row_hash(row, ignored_indexes)
+    return SyncPlan(
+        get("CONTROLLER_SHEET_DOCUMENT_ID"),
+        month,
+        schema.headers,
+        {
+            "action": schema.letter(get("ACTION_COLUMN_NAME", "Action")),
+            "event_id": schema.letter(get("EVENT_ID_COLUMN_NAME", "Event id")),
+            "link": schema.letter(get("LINK_COLUMN_NAME", "Link")),
+        },
+        operations,
+        warn_lines,
+    )
+
+
+def changed_plan_rows(plan, schema, data):
+    """Sheet rows of a plan changed since it was computed (all of them, if headers changed)."""
+    if schema.headers != plan.headers:
+        return [operation["row"] for operation in plan.operations]
+    ignored_indexes = planned_indexes(schema)
+    return [
+        operation["row"]
+        for operation in plan.operations
+        if row_hash(get_col(data["values"], operation["row"] - 2, []), ignored_indexes)
+        != operation["hash"]
+    ]
+
+
+def created_cells(columns, event_id, link):
+    """Sheet cells written for a row when its event has been created."""
+    return {
+        # Put the action to actions.IGNORE, in this way it will not be processed again
+        columns["action"]: actions.IGNORE,
+        # Save the event id, required to interact with the event in future
+        columns["event_id"]: event_id,
+        # Quick link to the event on the calendar
+        columns["link"]: f'=HYPERLINK("{link}";"open")',
+    }
+
+
+def apply_plan(config_dir, sheet, plan, journal=None):
+    """Execute a sync plan: calendar operations first, then sheet updates with their results.
+
+    When a journal is given, new events get their id from haunts, so creating them again
+    (resuming an interrupted sync) is detected, and every result is recorded before being
+    written back on the sheet.
+    Returns sheet row numbers of synced rows.
+    """
+    columns = plan.columns
+    warn_lines = list(plan.warn_lines)
+    processed_rows = set()
+    if journal and journal.file is None:
+        for operation in plan.inserts:
+            operation["event"].setdefault("id", uuid.uuid4().hex)
+        journal.start(plan)
+
+    def on_deleted(row, response, error, event_id=None, description=""):
+        if error is not None:
+            if 400 <= error.status_code < 500 and error.status_code != 429:
+                echo_missing_event(event_id, error.status_code)
             else:
-                raise
+                click.echo(
+                    Back.RED
+                    + f"Cannot delete the event at line {row}: {error.status_code}"
+                    + Style.RESET_ALL
+                )
+                warn_lines.append(row)
+                return
+        else:
+            click.echo(f"Deleted event {description}")
+        clear_row(row)
+
+    def clear_row(row):
+        if journal:
+            journal.deleted(row)
+        writer.clear(row, [columns["event_id"], columns["link"], columns["action"]])
+
+    def on_created(row, event, error, calendar=None, event_id=None):
+        if error is not None and error.status_code == 409 and event_id:
+            # Already created by an interrupted sync
+            LOGGER.debug(f"Event at line {row} already exists")
+            event = execute(
+                get_calendar_service(config_dir)
+                .events()
+                .get(calendarId=calendar, eventId=event_id),
+                CALENDAR,
+            )
+            error = None
+        if error is not None:
+            click.echo(
+                Back.RED
+                + f"Cannot create the event at line {row}: {error.status_code}"
+                + Style.RESET_ALL
+            )
+            click.echo(error.error_details)
+            warn_lines.append(row)
+            return
+        echo_created_event(event)
+        processed_rows.add(row)
+        if journal:
+            journal.created(row, event["id"], event["htmlLink"])
+        writer.update(row, created_cells(columns, event["id"], event["htmlLink"]))
+
+    # Sheet writes are buffered, pending ones are sent also when something goes wrong.
+    # Calendar operations are sent in batches by a pool of threads,
+    # results are written back from callbacks
+    writer = SheetWriteBuffer(sheet, plan.sheet, on_written=journal and journal.written)
+    try:
+        with writer, CalendarBatch(config_dir) as batch:
+            for operation in plan.operations:
+                if operation["type"] == "insert":
+                    batch.insert(
+                        operation["row"],
+                        operation["calendar"],
+                        operation["event"],
+                        partial(
+                            on_created,
+                            calendar=operation["calendar"],
+                            event_id=operation["event"].get("id"),
+                        ),
+                    )
+                elif not operation["event_id"]:
+                    # Nothing to delete on the calendar: the row is cleared anyway
+                    click.echo(
+                        Back.YELLOW
+                        + Fore.BLACK
+                        + f'Missing event id at line {operation["row"]}, cannot delete'
+                        + Style.RESET_ALL
+                    )
+                    clear_row(operation["row"])
+                else:
+                    batch.delete(
+                        operation["row"],
+                        operation["calendar"],
+                        operation["event_id"],
+                        partial(
+                            on_deleted,
+                            event_id=operation["event_id"],
+                            description=operation["description"],
+                        ),
+                    )
+    except BaseException:
+        if journal:
+            # Kept for --resume
+            journal.close()
+        raise
+    if journal:
+        journal.complete()
     click.echo("Done!")
 
     if warn_lines:
@@ -228,6 +629,35 @@ def sync_events(config_dir, sheet, data, calendars, days, month, projects=[], al
             + Style.RESET_ALL
         )
 
+    return processed_rows
+
+
+def resume_sync(config_dir, sheet, journal):
+    """Complete a sync interrupted before its end, as recorded by its journal.
+
+    Results of calendar operations not yet written on the sheet are written back, then
+    operations without a result are executed (events already created are not duplicated).
+    """
+    plan_data, results, written = journal.read()
+    plan = SyncPlan.from_dict(plan_data)
+    columns = plan.columns
+    journal.reopen()
+    write_back = [row for row in results if row not in written]
+    with SheetWriteBuffer(sheet, plan.sheet, on_written=journal.written) as writer:
+        for row in write_back:
+            result = results[row]
+            if result is None:
+                writer.clear(row, [columns["event_id"], columns["link"], columns["action"]])
+            else:
+                writer.update(row, created_cells(columns, result["event_id"], result["link"]))
+    remaining = [operation for operation in plan.operations if operation["row"] not in results]
+    click.echo(
+        f"Resuming sync of {plan.sheet}: {len(write_back)} lines written back, "
+        f"{len(remaining)} calendar operations left"
+    )
+    plan.operations = remaining
+    return apply_plan(config_dir, sheet, plan, journal=journal)
+
 
 def get_calendars(sheet, ignore_alias=False, use_read_col=False):
     """In case ignore_alias is true, only the first occurence of a calendar is returned.
@@ -235,8 +665,9 @@ def get_calendars(sheet, ignore_alias=False, use_read_col=False):
     In case use_read_col is True, the preferred calendar id is taken from "read_from" column
     """
     RANGE = f"{get('CONTROLLER_SHEET_NAME', 'config')}!A2:C"
-    calendars = (
-        sheet.values().get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=RANGE).execute()
+    calendars = execute(
+        sheet.values().get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=RANGE),
+        SHEETS_READ,
     )
     values = calendars.get("values", [])
     configured_calendars = {}
@@ -261,28 +692,15 @@ def get_calendars(sheet, ignore_alias=False, use_read_col=False):
     return configured_calendars
 
 
-def get_calendar_col_values(sheet, month, col_name):
-    """Get all events ids for a month."""
-    headers_ids = get_headers(sheet, month, indexes=True)
-    col_of_interest = headers_ids.get(col_name)
-    # transform a zero.based index to a capital letter
-    col_of_interest = string.ascii_uppercase[col_of_interest]
-    RANGE = f"{month}!{col_of_interest}2:{col_of_interest}"
-    events = (
-        sheet.values().get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=RANGE).execute()
-    )
-    values = events.get("values", [])
-    return [e[0] for e in values if e]
-
-
 def get_calendars_names(sheet, flat=True):
     """Get all calendars names, giving precedence to alias defined in column "linked_calendar".
 
     If multiple aliases are found, the first one will be used
     """
     RANGE = f"{get('CONTROLLER_SHEET_NAME', 'config')}!A2:C"
-    calendars = (
-        sheet.values().get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=RANGE).execute()
+    calendars = execute(
+        sheet.values().get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=RANGE),
+        SHEETS_READ,
     )
     values = calendars.get("values", [])
     names = {}
@@ -299,16 +717,6 @@ def get_calendars_names(sheet, flat=True):
     return names
 
 
-def get_first_empty_line(sheet, month):
-    """Get the first empty line in a month."""
-    RANGE = f"{month}!A1:A"
-    lines = (
-        sheet.values().get(spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), range=RANGE).execute()
-    )
-    values = lines.get("values", [])
-    return len(values) + 1
-
-
 def format_duration(duration):
     """Given a timedelta duration, format is as a string.
 
@@ -321,9 +729,8 @@ def format_duration(duration):
     return str(hours).replace(".", ",")
 
 
-def append_line(
-    sheet,
-    month,
+def format_line(
+    schema,
     date_col,
     time_col,
     project_col,
@@ -334,16 +741,12 @@ def append_line(
     action_col="",
     duration_col=None,
 ):
-    """Append a new line at the end of a sheet."""
-    next_av_line = get_first_empty_line(sheet, month)
-    headers_id = get_headers(sheet, month, indexes=True)
-    # Now write a new line at position next_av_line
-    range = f"{month}!A{next_av_line}:ZZ{next_av_line}"
+    """Create the values of a new sheet line, in the same order of sheet headers."""
     values_line = []
     formatted_time_col = time_col.strftime("%H:%M") if time_col else ""
     formatted_duration_col = format_duration(duration_col) if duration_col else ""
     full_day = formatted_time_col == "00:00" and formatted_duration_col == "24"
-    for key, index in headers_id.items():
+    for key in schema.headers:
         if key == "Date":
             values_line.append(date_col.strftime("%d/%m/%Y"))
         elif key == get("START_TIME_COLUMN_NAME", "Start time"):
@@ -364,42 +767,121 @@ def append_line(
             values_line.append(formatted_duration_col if not full_day else "")
         else:
             values_line.append("")
+    return values_line
+
 
-    request = sheet.values().batchUpdate(
+def append_lines(sheet, month, lines):
+    """Append new lines at the end of a sheet, writing all of them with a single request.
+
+    Rows are inserted by the API after the last row of the sheet, so concurrent runs
+    cannot overwrite each other.
+    """
+    if not lines:
+        return
+    request = sheet.values().append(
         spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"),
-        body={
-            "valueInputOption": "USER_ENTERED",
-            "data": [
-                {
-                    "range": range,
-                    "values": [values_line],
+        range=f"{month}!A1:ZZ",
+        valueInputOption="USER_ENTERED",
+        insertDataOption="INSERT_ROWS",
+        body={"values": lines},
+    )
+    execute(request, SHEETS_WRITE)
+
+
+def get_sheet_id(sheet, month):
+    """Get the numeric id of a sheet, from its name."""
+    spreadsheet = execute(
+        sheet.get(
+            spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"),
+            fields="sheets(properties(sheetId,title))",
+        ),
+        SHEETS_READ,
+    )
+    for sheet_data in spreadsheet.get("sheets", []):
+        if sheet_data["properties"]["title"] == month:
+            return sheet_data["properties"]["sheetId"]
+    raise KeyError(f"Sheet not found: {month}")
+
+
+def insert_lines_sorted(sheet, month, lines, sheet_dates):
+    """Insert new lines in a sheet, every one after the last row with the same date or before.
+
+    lines is a list of (date serial, line values), while sheet_dates are values of the date
+    column, starting from the second row. Rows are inserted with a single request, then
+    filled with a second one.
+    """
+    if not lines:
+        return
+    # Group new lines by the (zero based) sheet row index they must be inserted at
+    groups = {}
+    for serial, values_line in lines:
+        position = 1
+        for y, sheet_date in enumerate(sheet_dates):
+            if isinstance(sheet_date, numbers.Number) and sheet_date <= serial:
+                position = y + 2
+        groups.setdefault(position, []).append(values_line)
+
+    sheet_id = get_sheet_id(sheet, month)
+    # Insert from the bottom, so positions of upper groups are not affected
+    requests = [
+        {
+            "insertDimension": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "dimension": "ROWS",
+                    "startIndex": position,
+                    "endIndex": position + len(groups[position]),
                 },
-            ],
-        },
+                "inheritFromBefore": position > 1,
+            }
+        }
+        for position in sorted(groups, reverse=True)
+    ]
+    execute(
+        sheet.batchUpdate(
+            spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"), body={"requests": requests}
+        ),
+        SHEETS_WRITE,
     )
 
-    try:
-        request.execute()
-    except HttpError as err:
-        if err.status_code == 429:
-            click.echo("Too many requests")
-            click.echo(err.error_details)
-            click.echo("haunts will now pause for a while ⏲…")
-            time.sleep(60)
-            click.echo("Retrying…")
-            request.execute()
-        else:
-            raise
+    data = []
+    shift = 0
+    for position in sorted(groups):
+        group = groups[position]
+        first_row = position + shift + 1
+        data.append(
+            {"range": f"{month}!A{first_row}:ZZ{first_row + len(group) - 1}", "values": group}
+        )
+        shift += len(group)
+    execute(
+        sheet.values().batchUpdate(
+            spreadsheetId=get("CONTROLLER_SHEET_DOCUMENT_ID"),
+            body={"valueInputOption": "USER_ENTERED", "data": data},
+        ),
+        SHEETS_WRITE,
+    )
 
 
-def sync_report(config_dir, month, days=[], projects=[], allowed_actions=[]):
-    """Open a sheet, analyze it and populate calendars with new events."""
-    # The ID and range of the controller timesheet
-    creds = get_credentials(config_dir, SCOPES, "sheets-token.json")
-    service = build("sheets", "v4", credentials=creds)
+def sync_report(
+    config_dir,
+    month,
+    days=[],
+    projects=[],
+    allowed_actions=[],
+    incremental=False,
+    plan_file=None,
+    apply_file=None,
+    resume=False,
+):
+    """Open a sheet, analyze it and populate calendars with new events.
 
+    When incremental, only rows changed since the last incremental sync are read.
+    With plan_file, the sync plan is saved there and shown, without changing anything.
+    With apply_file, a plan saved before is applied, if its rows did not change meanwhile.
+    With resume, the last sync of the sheet, which was interrupted, is completed.
+    """
     # Call the Sheets API
-    sheet = service.spreadsheets()
+    sheet = get_sheet_service(config_dir)
 
     click.echo("Started calendars synchronization")
 
@@ -412,29 +894,84 @@ def sync_report(config_dir, month, days=[], projects=[], allowed_actions=[]):
         )
         sys.exit(1)
 
-    try:
-        data = (
-            sheet.values()
-            .get(
-                spreadsheetId=document_id,
-                range=f"{month}!A2:ZZ",
-                valueRenderOption="UNFORMATTED_VALUE",
+    saved_plan = None
+    if apply_file:
+        try:
+            saved_plan = SyncPlan.load(apply_file)
+        except (OSError, ValueError, KeyError) as err:
+            click.echo(Back.RED + f"Cannot load plan at {apply_file}: {err}" + Style.RESET_ALL)
+            sys.exit(1)
+        if saved_plan.spreadsheet != document_id:
+            click.echo(Back.RED + f"Plan at {apply_file} is for another document" + Style.RESET_ALL)
+            sys.exit(1)
+        if month and saved_plan.sheet != month:
+            click.echo(
+                Back.RED
+                + f'Plan at {apply_file} is for sheet "{saved_plan.sheet}", not "{month}"'
+                + Style.RESET_ALL
+            )
+            sys.exit(1)
+        month = saved_plan.sheet
+
+    journal = SyncJournal(config_dir, document_id, month)
+    if resume:
+        if not journal.exists():
+            click.echo(f"No interrupted sync of {month} to resume.")
+            sys.exit(1)
+        resume_sync(config_dir, sheet, journal)
+        return
+    if journal.exists():
+        click.echo(
+            Back.RED
+            + (
+                f"The last sync of {month} was interrupted. "
+                "Complete it with '--resume' before syncing again."
             )
-            .execute()
+            + Style.RESET_ALL
         )
+        sys.exit(1)
+
+    state = StateStore(config_dir) if incremental and not saved_plan else None
+    try:
+        schema, data = get_month_changes(sheet, month, state) if state else get_month(sheet, month)
     except HttpError as err:
         click.echo(Back.RED + f'Sheet "{month}" not found or not accessible.' + Style.RESET_ALL)
         click.echo(err.error_details)
         sys.exit(1)
 
+    if saved_plan:
+        changed_rows = changed_plan_rows(saved_plan, schema, data)
+        if changed_rows:
+            click.echo(
+                Back.RED
+                + (
+                    f"Sheet {month} changed since the plan was made (lines "
+                    f"{', '.join(map(str, changed_rows))}). Make a new plan."
+                )
+                + Style.RESET_ALL
+            )
+            sys.exit(1)
+        apply_plan(config_dir, sheet, saved_plan, journal=journal)
+        return
+
     calendars = get_calendars(sheet)
-    sync_events(
-        config_dir,
-        sheet,
+    plan = plan_sync(
         data,
+        schema,
         calendars,
-        days=days,
-        month=month,
+        days,
+        month,
         projects=projects,
         allowed_actions=allowed_actions,
     )
+    if plan_file:
+        plan.save(plan_file)
+        plan.echo()
+        click.echo(f"Plan saved at {plan_file}. Nothing changed yet.")
+        if state:
+            state.close()
+        return
+    processed_rows = apply_plan(config_dir, sheet, plan, journal=journal)
+    if state:
+        save_sync_state(state, month, schema, data, processed_rows)
+        state.close()
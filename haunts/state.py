@@ -0,0 +1,90 @@
+"""Local state of synced sheets, used to only download rows changed since last sync"""
+
+import hashlib
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheets (
+    spreadsheet TEXT NOT NULL,
+    sheet TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    watermark INTEGER NOT NULL,
+    PRIMARY KEY (spreadsheet, sheet)
+);
+CREATE TABLE IF NOT EXISTS rows (
+    spreadsheet TEXT NOT NULL,
+    sheet TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (spreadsheet, sheet, row)
+);
+"""
+
+
+def row_hash(row, ignored_indexes=()):
+    """Hash the content of a sheet row, ignoring some columns (like the ones written by haunts)"""
+    content = [value for index, value in enumerate(row) if index not in ignored_indexes]
+    # Trailing empty cells are not returned by the API: they must not change the hash
+    while content and content[-1] in ("", None):
+        content.pop()
+    return hashlib.sha1(json.dumps(content, default=str).encode("utf-8")).hexdigest()
+
+
+class StateStore:
+    """SQLite database inside the configuration directory.
+
+    For every sheet it stores the headers, the content hash of every row and the watermark:
+    the sheet row number up to which every row has been fully processed.
+    """
+
+    def __init__(self, config_dir):
+        self.path = config_dir / "state.sqlite"
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get_sheet(self, spreadsheet, sheet):
+        """Return stored headers and watermark of a sheet, or None if never synced."""
+        found = self.connection.execute(
+            "SELECT headers, watermark FROM sheets WHERE spreadsheet = ? AND sheet = ?",
+            (spreadsheet, sheet),
+        ).fetchone()
+        if not found:
+            return None
+        headers, watermark = found
+        return json.loads(headers), watermark
+
+    def get_hash(self, spreadsheet, sheet, row):
+        found = self.connection.execute(
+            "SELECT hash FROM rows WHERE spreadsheet = ? AND sheet = ? AND row = ?",
+            (spreadsheet, sheet, row),
+        ).fetchone()
+        return found[0] if found else None
+
+    def save(self, spreadsheet, sheet, headers, watermark, hashes):
+        """Store the state of a sheet after a sync.
+
+        hashes is a dict that assign sheet row numbers to row hashes.
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sheets (spreadsheet, sheet, headers, watermark) "
+                "VALUES (?, ?, ?, ?)",
+                (spreadsheet, sheet, json.dumps(headers), watermark),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO rows (spreadsheet, sheet, row, hash) VALUES (?, ?, ?, ?)",
+                [(spreadsheet, sheet, row, hash) for row, hash in hashes.items()],
+            )
+
+    def reset(self, spreadsheet, sheet):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM sheets WHERE spreadsheet = ? AND sheet = ?", (spreadsheet, sheet)
+            )
+            self.connection.execute(
+                "DELETE FROM rows WHERE spreadsheet = ? AND sheet = ?", (spreadsheet, sheet)
+            )
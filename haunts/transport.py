@@ -0,0 +1,88 @@
+"""HTTP transport shared by all Google API clients.
+
+A single ``requests`` session keeps a pool of keep-alive connections, used by every service
+and every thread: requests reuse warm TLS connections instead of opening new ones.
+"""
+
+import threading
+
+import httplib2
+import requests
+from google.auth.transport.requests import Request
+
+from . import LOGGER
+from .ini import get
+from .metrics import metrics
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the HTTP session of this run, creating it the first time."""
+    global session
+    with session_lock:
+        if session is None:
+            size = int(get("HTTP_POOL_SIZE", 10))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        return session
+
+
+class SessionHttp:
+    """Adapter exposing a requests session with the httplib2.Http interface used by API clients.
+
+    Requests are authorized with credentials, refreshing them when needed.
+    Unlike httplib2.Http, it can be used by many threads at once.
+    """
+
+    def __init__(self, credentials, session=None, timeout=None):
+        self.credentials = credentials
+        self.session = session or get_session()
+        self.timeout = timeout or float(get("HTTP_TIMEOUT", 60))
+        self.auth_request = Request(self.session)
+
+    def request(
+        self,
+        uri,
+        method="GET",
+        body=None,
+        headers=None,
+        redirections=5,
+        connection_type=None,
+    ):
+        headers = dict(headers or {})
+        self.credentials.before_request(self.auth_request, method, uri, headers)
+        response = self.send(uri, method, body, headers)
+        if response.status_code == 401:
+            # Token rejected (for example, revoked): refresh it and try again once
+            LOGGER.debug(f"Unauthorized request to {uri}, refreshing token")
+            invalidate = getattr(self.credentials, "invalidate", None)
+            if invalidate:
+                invalidate(headers.get("authorization"))
+            self.credentials.refresh(self.auth_request)
+            self.credentials.apply(headers)
+            response = self.send(uri, method, body, headers)
+        return self.to_httplib2(response)
+
+    def send(self, uri, method, body, headers):
+        """Send a request, counting its bytes (every attempt is counted)."""
+        response = self.session.request(
+            method, uri, data=body, headers=headers, timeout=self.timeout
+        )
+        sent = body.encode() if isinstance(body, str) else body or b""
+        metrics.add_bytes(len(sent), len(response.content))
+        return response
+
+    @staticmethod
+    def to_httplib2(response):
+        """Convert a requests response to the (response, content) tuple of httplib2."""
+        info = {key.lower(): value for key, value in response.headers.items()}
+        # Content is already decompressed by requests
+        info.pop("content-encoding", None)
+        info["status"] = str(response.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = response.reason
+        return resp, response.content
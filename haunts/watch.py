@@ -0,0 +1,54 @@
+"""Watch a month sheet, syncing its changes as soon as they are made.
+
+A single process keeps API clients, connections and tokens warm. The spreadsheet version
+(from the Drive API) is checked every WATCH_INTERVAL seconds: when it changes, an
+incremental sync reads and syncs only the rows changed since the previous one.
+"""
+
+import time
+
+import click
+from colorama import Back, Style
+
+from .ini import get
+from .journal import SyncJournal
+from .snapshots import get_spreadsheet_version
+from .spreadsheet import get_sheet_service, resume_sync, sync_report
+
+
+def watch_sheet(config_dir, month, days=[], projects=[], allowed_actions=[], interval=None):
+    """Public module entry point. Runs until interrupted with Ctrl+C."""
+    interval = float(interval or get("WATCH_INTERVAL", 60))
+    document_id = get("CONTROLLER_SHEET_DOCUMENT_ID")
+    click.echo(f"Watching sheet {month} every {interval:g} seconds. Press Ctrl+C to stop")
+    version = None
+    try:
+        while True:
+            try:
+                current = get_spreadsheet_version(config_dir, document_id)
+                if current != version:
+                    journal = SyncJournal(config_dir, document_id, month)
+                    if journal.exists():
+                        resume_sync(config_dir, get_sheet_service(config_dir), journal)
+                    sync_report(
+                        config_dir,
+                        month,
+                        days=days,
+                        projects=projects,
+                        allowed_actions=allowed_actions,
+                        incremental=True,
+                    )
+                    # Writes of this sync change the version again: the next check will run
+                    # an incremental sync that finds nothing to do
+                    version = current
+            except (Exception, SystemExit) as err:
+                # Commands exit on errors (already reported): the watch goes on anyway
+                reason = f" ({err})" if isinstance(err, Exception) else ""
+                click.echo(
+                    Back.RED
+                    + f"Sync of {month} failed{reason}, trying again in {interval:g} seconds"
+                    + Style.RESET_ALL
+                )
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        click.echo("Stopped watching")
@@ -15,6 +15,7 @@ requirements = [
     "python-dateutil",
     "google-api-python-client",
     "google-auth-httplib2",
+    "requests",
     "google-auth-oauthlib",
     "google-auth<2dev",
     "tabulate",
@@ -42,6 +43,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={"numpy": ["numpy"]},
     license="GNU General Public License v3",
     long_description=readme + "\n\n" + history,
     include_package_data=True,
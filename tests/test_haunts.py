@@ -3,10 +3,239 @@
 """Tests for `haunts` package."""
 
 
+import datetime
+import email.utils
+import json
+import importlib.util
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from pathlib import Path
+from unittest import mock
+
+import httplib2
 from click.testing import CliRunner
+from googleapiclient.errors import HttpError
+
+from haunts import actions, api, cli
+from haunts.profiles import Profile, activate
+
+SETTINGS = """[haunts]
+CONTROLLER_SHEET_DOCUMENT_ID=document
+TIMEZONE=Etc/GMT
+SHEETS_READ_QUOTA=1000000
+SHEETS_WRITE_QUOTA=1000000
+CALENDAR_QUOTA=1000000
+"""
+HEADERS = [
+    "Date",
+    "Start time",
+    "Spent",
+    "Project",
+    "Activity",
+    "Details",
+    "Event id",
+    "Link",
+    "Action",
+]
+# 2024-05-02, as a Google Sheets serial number
+MAY_2 = 45414
+CALENDARS = {"Project A": "calendar-a"}
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({"status": str(status)}), b"{}")
+
+
+class FakeRequest:
+    """API request returning the result of a function."""
+
+    def __init__(self, method_id, function):
+        self.methodId = method_id
+        self.function = function
+
+    def execute(self):
+        return self.function()
+
+
+class FakeSheet:
+    """Spreadsheets resource of the Sheets API, with a May sheet (sheet id 7).
+
+    Ranges read are recorded, as well as single cells written.
+    """
+
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.ranges = []
+        self.cells = {}
+        self.offline = False
+
+    def values(self):
+        return FakeValues(self)
+
+    def get(self, spreadsheetId, fields=None):
+        return FakeRequest(
+            "sheets.spreadsheets.get",
+            lambda: {"sheets": [{"properties": {"sheetId": 7, "title": "May"}}]},
+        )
+
+    def batchUpdate(self, spreadsheetId, body):
+        def update():
+            for request in body["requests"]:
+                rows = request["insertDimension"]["range"]
+                self.rows[rows["startIndex"] : rows["startIndex"]] = [
+                    [] for _ in range(rows["endIndex"] - rows["startIndex"])
+                ]
+
+        return FakeRequest("sheets.spreadsheets.batchUpdate", update)
+
+    def read(self, a1_range):
+        first_col, first_row, last_col, last_row = re.fullmatch(
+            r"May!([A-Z]+)(\d+):([A-Z]+)(\d*)", a1_range
+        ).groups()
+        rows = self.rows[int(first_row) - 1 : int(last_row) if last_row else None]
+        if first_col == last_col:
+            index = ord(first_col) - ord("A")
+            rows = [row[index : index + 1] for row in rows]
+        # Like the API, without empty cells at the end of rows and empty rows at the end
+        rows = [list(row) for row in rows]
+        for row in rows:
+            while row and row[-1] in ("", None):
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def write(self, a1_range, values):
+        if self.offline:
+            raise ConnectionError("Sheets API not reachable")
+        col, row = re.match(r"May!([A-Z])(\d+)", a1_range).groups()
+        col, row = ord(col) - ord("A"), int(row) - 1
+        for line in values:
+            while len(self.rows) <= row:
+                self.rows.append([])
+            target = self.rows[row]
+            target.extend([""] * (col + len(line) - len(target)))
+            target[col : col + len(line)] = line
+            row += 1
+        if len(values) == 1 and len(values[0]) == 1:
+            self.cells[a1_range] = values[0][0]
+
+
+class FakeValues:
+    """Values of a FakeSheet."""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    def batchGet(self, spreadsheetId, ranges, **options):
+        self.sheet.ranges.extend(ranges)
+        return FakeRequest(
+            "sheets.spreadsheets.values.batchGet",
+            lambda: {"valueRanges": [{"values": self.sheet.read(a1_range)} for a1_range in ranges]},
+        )
+
+    def batchUpdate(self, spreadsheetId, body):
+        def write():
+            for data in body["data"]:
+                self.sheet.write(data["range"], data["values"])
+
+        return FakeRequest("sheets.spreadsheets.values.batchUpdate", write)
+
+
+class FakeCalendarBatch:
+    """CalendarBatch executing every operation at once, on calendars kept in memory.
+
+    Inserting an event with the id of an existing one fails with a 409, like the API does.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.inserted = []
+        self.deleted = []
+
+    def __call__(self, config_dir):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def insert(self, key, calendar, event_body, callback):
+        event_id = event_body.get("id") or f"event{len(self.events)}"
+        if event_id in self.events:
+            callback(key, None, http_error(409))
+            return
+        event = {
+            **event_body,
+            "id": event_id,
+            "htmlLink": f"https://calendar.example.com/{event_id}",
+            "organizer": {"displayName": calendar},
+        }
+        self.events[event_id] = event
+        self.inserted.append(event_id)
+        callback(key, event, None)
+
+    def delete(self, key, calendar, event_id, callback):
+        if self.events.pop(event_id, None) is None:
+            callback(key, None, http_error(404))
+            return
+        self.deleted.append(event_id)
+        callback(key, "", None)
 
-from haunts import cli
+    def service(self):
+        """Calendar service, getting events from this batch."""
+        events = mock.Mock()
+        events.get.side_effect = lambda calendarId, eventId: FakeRequest(
+            "calendar.events.get", lambda: self.events[eventId]
+        )
+        service = mock.Mock()
+        service.events.return_value = events
+        return service
+
+
+def write_cells(values, cells):
+    """Copy cells written on the May sheet to its rows (headers excluded)."""
+    for cell, value in cells.items():
+        col, row = re.fullmatch(r"May!([A-Z])(\d+)", cell).groups()
+        line = values[int(row) - 2]
+        index = ord(col) - ord("A")
+        line.extend([""] * (index + 1 - len(line)))
+        line[index] = value
+
+
+class ProfileTestCase(unittest.TestCase):
+    """Tests running on behalf of a profile with a temporary configuration directory."""
+
+    settings = ""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.config_dir = Path(tmp.name)
+        profile = Profile(self.config_dir)
+        profile.parser.read_string(SETTINGS + self.settings)
+        activated = activate(profile)
+        activated.__enter__()
+        self.addCleanup(activated.__exit__, None, None, None)
+        api.buckets.clear()
+        self.addCleanup(api.buckets.clear)
+
+    def patch(self, target, *args, **kwargs):
+        patcher = mock.patch(target, *args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def output(self):
+        """Messages printed with click.echo, when patched."""
+        return "\n".join(str(call.args[0]) for call in self.echo.call_args_list if call.args)
 
 
 class TestHaunts(unittest.TestCase):
@@ -30,3 +259,1423 @@ class TestHaunts(unittest.TestCase):
         help_result = runner.invoke(cli.main, ["--help"])
         assert help_result.exit_code == 0
         assert "--help  Show this message and exit." in help_result.output
+
+    def test_invalid_day(self):
+        """Days are checked before running anything."""
+        runner = CliRunner()
+        for args in (["-d", "2024-05-32"], ["--from", "May 1st"], ["--to", "2024/05/31"]):
+            result = runner.invoke(cli.main, [*args, "-e", "report", "May"])
+            assert result.exit_code == 2
+            assert 'in format "YYYY-MM-DD"' in result.output
+
+    def test_cli_lazy_imports(self):
+        """Google API clients are not imported just to start the CLI."""
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, haunts.cli; "
+                "print(' '.join(m for m in ('googleapiclient', 'google_auth_oauthlib', "
+                "'tabulate', 'dateutil') if m in sys.modules))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout.strip() == ""
+
+
+class TestBatch(unittest.TestCase):
+    """Commands run for many profiles with --batch."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.profiles = [Path(tmp.name) / name for name in ("alice", "bob")]
+        for config_dir in self.profiles:
+            config_dir.mkdir()
+            (config_dir / "haunts.ini").write_text(SETTINGS)
+        for name in ("prepare_profile", "run_command"):
+            patcher = mock.patch(f"haunts.cli.{name}")
+            self.addCleanup(patcher.stop)
+            setattr(self, name, patcher.start())
+
+    def invoke(self, *args):
+        profiles = [option for path in self.profiles for option in ("-P", str(path))]
+        return CliRunner().invoke(cli.main, [*args[:-1], *profiles, args[-1]])
+
+    def test_profiles(self):
+        """Sheets can have any name, "batch" too."""
+        result = self.invoke("--batch", "-e", "report", "--workers", "1", "batch")
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(
+            sorted(call.args for call in self.run_command.call_args_list),
+            [(path.resolve(), "report", "batch") for path in self.profiles],
+        )
+        self.assertIn("2 of 2 profiles completed", result.output)
+
+    def test_failed_profile(self):
+        self.run_command.side_effect = [None, RuntimeError("quota")]
+        result = self.invoke("--batch", "--workers", "1", "May")
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("1 of 2 profiles completed", result.output)
+
+    def test_options(self):
+        self.assertEqual(self.invoke("May").exit_code, 1)
+        self.assertEqual(self.invoke("--batch", "-e", "reconcile", "May").exit_code, 1)
+        self.assertEqual(self.invoke("--batch", "--watch", "May").exit_code, 1)
+        self.run_command.assert_not_called()
+
+
+class SyncTestCase(ProfileTestCase):
+    """Syncs of a May sheet, on fake calendars and sheet."""
+
+    def setUp(self):
+        super().setUp()
+        from haunts.spreadsheet import SheetSchema
+
+        self.schema = SheetSchema(HEADERS)
+        self.values = [
+            [MAY_2, "", 1, "Project A", "Planning", "", "", "", ""],
+            [MAY_2, "", 2, "Project A", "Coding", "", "", "", ""],
+            [MAY_2, "", 1, "Project A", "Old meeting", "", "", "", actions.DELETE],
+        ]
+        self.batch = FakeCalendarBatch()
+        self.sheet = FakeSheet()
+        self.patch("haunts.spreadsheet.CalendarBatch", self.batch)
+        self.patch("haunts.spreadsheet.get_calendar_service", lambda _: self.batch.service())
+        self.echo = self.patch("click.echo")
+
+    def plan(self):
+        from haunts.spreadsheet import plan_sync
+
+        return plan_sync({"values": self.values}, self.schema, CALENDARS, [], "May")
+
+
+class TestPlan(SyncTestCase):
+    """Sync plans."""
+
+    def test_allocate_events(self):
+        """Events without a start time begin where the previous one of the day ends."""
+        plan = self.plan()
+        self.assertEqual(
+            [operation["type"] for operation in plan.operations], ["insert", "insert", "delete"]
+        )
+        starts = [operation["event"]["start"]["dateTime"] for operation in plan.inserts]
+        self.assertEqual(starts, ["2024-05-02T09:00:00", "2024-05-02T10:00:00"])
+        self.assertEqual(plan.deletes[0]["event_id"], "")
+
+    def test_allocate_events_filters(self):
+        """Rows are filtered by day, project and action, and warned about when not valid."""
+        from haunts.spreadsheet import allocate_events
+
+        self.values += [
+            [MAY_2 + 1, "14:30", 1, "Project A", "Review", "", "", "", ""],
+            [MAY_2 + 1, "", 1, "Project Z", "Unknown project", "", "", "", ""],
+            [MAY_2 + 1, "", 1, "Project A", "Unknown action", "", "", "", "X"],
+            [MAY_2 + 1, "", 1, "Project A", "Synced", "ev1", "", "", actions.IGNORE],
+            ["", "", 1, "Project A", "No date", "", "", "", ""],
+        ]
+        data = {"values": self.values}
+
+        operations, warn_lines = allocate_events(data, self.schema, CALENDARS, [])
+        self.assertEqual([operation["row"] for operation in operations], [2, 3, 4, 5])
+        self.assertEqual(operations[3]["event"]["start"]["dateTime"], "2024-05-03T14:30:00")
+        self.assertEqual(warn_lines, [6, 7])
+
+        operations, _ = allocate_events(
+            data, self.schema, CALENDARS, [datetime.datetime(2024, 5, 3)]
+        )
+        self.assertEqual([operation["row"] for operation in operations], [5])
+        operations, _ = allocate_events(
+            data, self.schema, CALENDARS, [], allowed_actions=[actions.DELETE]
+        )
+        self.assertEqual([operation["row"] for operation in operations], [4])
+        operations, _ = allocate_events(
+            data, self.schema, CALENDARS, [], allowed_actions=["empty"]
+        )
+        self.assertEqual([operation["row"] for operation in operations], [2, 3, 5])
+        operations, warn_lines = allocate_events(
+            data, self.schema, CALENDARS, [], projects=["Project Z"]
+        )
+        self.assertEqual((operations, warn_lines), ([], [6]))
+
+    def test_plan_round_trip(self):
+        """A saved plan is loaded as it was, and applied only once."""
+        from haunts.plan import SyncPlan
+        from haunts.spreadsheet import apply_plan, changed_plan_rows
+
+        plan_file = self.config_dir / "plan.json"
+        self.plan().save(plan_file)
+        plan = SyncPlan.load(plan_file)
+        self.assertEqual(plan.to_dict(), self.plan().to_dict())
+        self.assertEqual(changed_plan_rows(plan, self.schema, {"values": self.values}), [])
+
+        apply_plan(self.config_dir, self.sheet, plan)
+        self.assertEqual(len(self.batch.inserted), 2)
+        self.assertEqual(self.sheet.cells["May!I2"], actions.IGNORE)
+        self.assertEqual(self.sheet.cells["May!G3"], self.batch.inserted[1])
+        write_cells(self.values, self.sheet.cells)
+        # Rows synced have a new Action and Event id: the same plan cannot be applied again
+        self.assertEqual(
+            changed_plan_rows(SyncPlan.load(plan_file), self.schema, {"values": self.values}),
+            [2, 3, 4],
+        )
+
+    def test_plan_ignores_link(self):
+        """Links are rewritten by haunts, and do not invalidate a plan."""
+        from haunts.spreadsheet import changed_plan_rows
+
+        plan = self.plan()
+        self.values[0][7] = '=HYPERLINK("https://calendar.example.com";"open")'
+        self.assertEqual(changed_plan_rows(plan, self.schema, {"values": self.values}), [])
+
+    def test_delete_without_event_id(self):
+        """A row to delete without event id is cleared, without deleting anything."""
+        from haunts.spreadsheet import apply_plan
+
+        apply_plan(self.config_dir, self.sheet, self.plan())
+        self.assertEqual(self.batch.deleted, [])
+        self.assertEqual(self.sheet.cells["May!I4"], "")
+        self.assertIn("Missing event id at line 4", self.output())
+        self.assertNotIn("Deleted event", self.output())
+
+
+class TestWatch(ProfileTestCase):
+    """The --watch loop."""
+
+    def test_failed_sync(self):
+        """A failed sync, exiting or raising, does not stop the watch."""
+        from haunts.watch import watch_sheet
+
+        self.echo = self.patch("click.echo")
+        self.patch("haunts.watch.get_spreadsheet_version", side_effect=["1", "2", "3", "3"])
+        sync_report = self.patch(
+            "haunts.watch.sync_report", side_effect=[SystemExit(1), RuntimeError("boom"), None]
+        )
+        self.patch("haunts.watch.time.sleep", side_effect=[None, None, None, KeyboardInterrupt])
+        watch_sheet(self.config_dir, "May", interval=1)
+        self.assertEqual(sync_report.call_count, 3)
+        self.assertIn("Sync of May failed, trying again", self.output())
+        self.assertIn("Sync of May failed (boom)", self.output())
+        self.assertIn("Stopped watching", self.output())
+
+
+def baseline_report(values, working_hours=8, filter=None):
+    """Totals of the report as computed before reports were read by columns.
+
+    Rows are grouped by date, then by project, both in order of first appearance.
+    """
+    dates = {}
+    for row in values:
+        date, spent, project, activity = row[0], row[2], row[3], row[4]
+        date_stats = dates.setdefault(date, {"projects": {}, "have_full_day": False})
+        stats = date_stats["projects"].setdefault(
+            project, {"total": 0, "full_day": False, "ignore": False}
+        )
+        if isinstance(spent, (int, float)):
+            stats["total"] += spent
+        elif not date_stats["have_full_day"]:
+            date_stats["have_full_day"] = True
+            stats["full_day"] = True
+        if filter and filter not in activity:
+            stats["ignore"] = True
+    rows = []
+    for date, date_stats in dates.items():
+        projects = date_stats["projects"].values()
+        for stats in projects:
+            if stats["full_day"]:
+                stats["total"] += working_hours - sum(stats["total"] for stats in projects)
+                break
+        rows.extend(
+            (date, project, stats["total"])
+            for project, stats in date_stats["projects"].items()
+            if not stats["ignore"]
+        )
+    return rows
+
+
+def decode(values, by_columns=False):
+    """Entries of a sheet with HEADERS, read by rows or by columns."""
+    from haunts.entries import EntryDecoder
+    from haunts.spreadsheet import SheetSchema
+
+    decoder = EntryDecoder(SheetSchema(HEADERS))
+    return decoder.decode_columns(values) if by_columns else decoder.decode_rows(values)
+
+
+class TestReportColumns(ProfileTestCase):
+    """Reports aggregated on columns."""
+
+    def setUp(self):
+        super().setUp()
+        self.patch("click.echo")
+
+    def report(self, values, aggregate, filter=None):
+        from haunts import columns
+
+        report = columns.ReportColumns()
+        report.add(decode(values), filter=filter)
+        stats = aggregate(report, 8 * columns.SPENT_SCALE)
+        selected = [position for position in range(len(stats)) if not stats.ignored[position]]
+        return columns.rollup_rows(stats, selected)
+
+    def random_sheets(self, count=200):
+        generator = random.Random(42)
+        for _ in range(count):
+            yield [
+                [
+                    MAY_2 + generator.randrange(5),
+                    "",
+                    generator.choice([0.25, 0.5, 1, 2, 3, ""]),
+                    generator.choice(["Project A", "Project B", "Project C", "Project D"]),
+                    generator.choice(["Coding", "Meeting"]),
+                ]
+                for _ in range(generator.randrange(1, 40))
+            ]
+
+    def check_parity(self, aggregate):
+        from haunts.entries import from_serial
+
+        for values in self.random_sheets():
+            for filter in (None, "Coding"):
+                self.assertEqual(
+                    self.report(values, aggregate, filter=filter),
+                    [
+                        (str(from_serial(date)), project, total)
+                        for date, project, total in baseline_report(values, filter=filter)
+                    ],
+                )
+
+    def test_arrays_parity(self):
+        """Totals and their order are the same of reports computed row by row."""
+        from haunts.columns import aggregate_arrays
+
+        self.check_parity(aggregate_arrays)
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "NumPy is not installed")
+    def test_numpy_parity(self):
+        """Totals and their order are the same of reports computed row by row, with NumPy."""
+        from haunts.columns import aggregate_numpy
+
+        self.check_parity(aggregate_numpy)
+
+    def test_rollup(self):
+        """Rolled up totals are grouped by period, then by project."""
+        from haunts import columns
+
+        report = columns.ReportColumns()
+        report.add(
+            decode(
+                [
+                    [MAY_2, "", 1, "Project A"],
+                    [MAY_2 + 7, "", 2, "Project A"],
+                    [MAY_2 + 1, "", 3, "Project B"],
+                    [MAY_2, "", 4, "Project A"],
+                ]
+            )
+        )
+        stats = report.aggregate(8)
+        self.assertEqual(
+            columns.rollup_rows(stats, range(len(stats)), "week"),
+            [
+                ("2024-W18", "Project A", 5),
+                ("2024-W18", "Project B", 3),
+                ("2024-W19", "Project A", 2),
+            ],
+        )
+
+
+class TestSnapshots(ProfileTestCase):
+    """Binary snapshots of sheets."""
+
+    rows = [
+        ["Date", "Spent", "Project", "Activity"],
+        [MAY_2, 1, "Project A", "Café ☕", True],
+        [MAY_2, 1.0, "Project A", "", False, None, "last"],
+        [],
+        [MAY_2 + 1, 0.25, "Project B", "Café ☕"],
+    ]
+
+    def test_round_trip(self):
+        """Snapshots decode to the same rows, with the same types, in the same positions."""
+        from haunts import snapshots
+
+        version, rows = snapshots.decode(snapshots.encode("123", self.rows))
+        self.assertEqual(version, "123")
+        self.assertEqual(rows, self.rows)
+        # 1, 1.0 and True are equal, but are different values
+        self.assertEqual(
+            [type(value) for value in rows[1] + rows[2]],
+            [type(value) for value in self.rows[1] + self.rows[2]],
+        )
+        self.assertEqual(snapshots.read_version(snapshots.encode("123", self.rows)), "123")
+        self.assertEqual(snapshots.decode(snapshots.encode("", [])), ("", []))
+
+    def test_cache(self):
+        """Snapshots are read through a memory map, only when at the expected version."""
+        from haunts.snapshots import SnapshotCache
+
+        cache = SnapshotCache(self.config_dir)
+        cache.save("document", "May", "7", self.rows)
+        self.assertEqual(cache.load("document", "May", "7"), self.rows)
+        self.assertEqual(cache.load("document", "May"), self.rows)
+        self.assertIsNone(cache.load("document", "May", "8"))
+        self.assertIsNone(cache.load("document", "June"))
+        cache.file("document", "May").write_bytes(b"not a snapshot")
+        self.assertIsNone(cache.load("document", "May"))
+
+    def test_missing_and_empty_cells(self):
+        """Read by columns, a row without spent time is not a full day event.
+
+        Cells at the end of a row are missing, while empty cells followed by other values
+        are empty strings, just like when reading rows.
+        """
+        from haunts import columns
+
+        rows = [
+            [MAY_2, "", "", "Project A"],
+            [MAY_2, "", 1, "Project A", "Coding"],
+            [MAY_2 + 1],
+        ]
+        # As returned by the API: every column without empty cells at its end
+        by_columns = [
+            [MAY_2, MAY_2, MAY_2 + 1],
+            [],
+            ["", 1],
+            ["Project A", "Project A"],
+            ["", "Coding"],
+        ]
+        entries = list(decode(by_columns, by_columns=True))
+        self.assertEqual([entry.spent for entry in entries], ["", 1, None])
+        self.assertEqual(
+            [(entry.spent, entry.activity) for entry in entries],
+            [(entry.spent, entry.activity) for entry in decode(rows)],
+        )
+        report = columns.ReportColumns()
+        report.add(entries)
+        self.assertEqual(list(report.full_day), [1, 0, 0])
+
+
+class TestJournal(SyncTestCase):
+    """Syncs recorded in a journal, resumed when interrupted."""
+
+    def setUp(self):
+        super().setUp()
+        from haunts.journal import SyncJournal
+
+        self.journal = SyncJournal(self.config_dir, "document", "May")
+
+    def test_interrupted_sync(self):
+        """Results not written on the sheet are written back, without creating events again."""
+        from haunts.spreadsheet import apply_plan, resume_sync
+
+        self.sheet.offline = True
+        with self.assertRaises(ConnectionError):
+            apply_plan(self.config_dir, self.sheet, self.plan(), journal=self.journal)
+        self.assertTrue(self.journal.exists())
+        # A crash can leave a truncated record
+        with open(self.journal.path, "a") as journal:
+            journal.write('{"type": "writ')
+
+        plan, results, written = self.journal.read()
+        self.assertEqual(len(plan["operations"]), 3)
+        self.assertEqual(written, set())
+        self.assertEqual(results[2]["event_id"], self.batch.inserted[0])
+        self.assertEqual(
+            results[3]["link"], f"https://calendar.example.com/{self.batch.inserted[1]}"
+        )
+        self.assertIsNone(results[4])
+
+        self.sheet.offline = False
+        resume_sync(self.config_dir, self.sheet, self.journal)
+        self.assertEqual(len(self.batch.inserted), 2)
+        self.assertEqual(self.sheet.cells["May!G2"], self.batch.inserted[0])
+        self.assertEqual(self.sheet.cells["May!I3"], actions.IGNORE)
+        self.assertEqual(self.sheet.cells["May!I4"], "")
+        self.assertFalse(self.journal.exists())
+
+    def test_events_created_before_journal(self):
+        """Events created, but not recorded, before an interruption are not created again."""
+        from haunts.spreadsheet import resume_sync
+
+        plan = self.plan()
+        for index, operation in enumerate(plan.inserts):
+            operation["event"]["id"] = f"haunts{index}"
+        self.journal.start(plan)
+        self.journal.close()
+        # The first event was created, then haunts stopped
+        self.batch.insert(2, "calendar-a", plan.inserts[0]["event"], lambda *args: None)
+        self.batch.inserted = []
+
+        resume_sync(self.config_dir, self.sheet, self.journal)
+        self.assertEqual(self.batch.inserted, ["haunts1"])
+        self.assertEqual(self.sheet.cells["May!G2"], "haunts0")
+        self.assertEqual(
+            self.sheet.cells["May!H2"], '=HYPERLINK("https://calendar.example.com/haunts0";"open")'
+        )
+        self.assertEqual(self.sheet.cells["May!G3"], "haunts1")
+        self.assertFalse(self.journal.exists())
+
+
+class TestIncrementalSync(ProfileTestCase):
+    """Sheet state stored after every incremental sync."""
+
+    def setUp(self):
+        super().setUp()
+        from haunts.spreadsheet import SheetSchema
+        from haunts.state import StateStore
+
+        self.schema = SheetSchema(HEADERS)
+        self.state = StateStore(self.config_dir)
+        self.addCleanup(self.state.close)
+        self.sheet = FakeSheet(
+            [
+                HEADERS,
+                [MAY_2, "", 1, "Project A", "Planning", "", "ev1", "", actions.IGNORE],
+                [MAY_2, "", 1, "Project A", "Meeting", "", "ev2", "", actions.IGNORE],
+                [MAY_2, "", 2, "Project A", "Coding", "", "", "", ""],
+                [MAY_2, "", 1, "Project A", "Review", "", "", "", ""],
+                [MAY_2 + 1, "", 1, "Project A", "Coding", "", "", "", ""],
+            ]
+        )
+
+    def test_column_letter(self):
+        """Column letters go on after Z like in spreadsheets."""
+        from haunts.spreadsheet import SheetSchema, column_letter
+
+        self.assertEqual(
+            [column_letter(index) for index in (0, 25, 26, 27, 51, 52, 701, 702)],
+            ["A", "Z", "AA", "AB", "AZ", "BA", "ZZ", "AAA"],
+        )
+        schema = SheetSchema([f"Column {index}" for index in range(28)] + ["Column 0"])
+        self.assertEqual(schema.letter("Column 27"), "AB")
+        self.assertEqual(schema.index("Column 0"), 0)
+
+    def test_row_hash(self):
+        """Hashes ignore some columns and empty cells at the end of rows."""
+        from haunts.state import row_hash
+
+        row = [MAY_2, "", 1, "Project A", "Coding", "", "ev1", "link", "I"]
+        self.assertEqual(row_hash(row, {6, 7, 8}), row_hash(row[:5]))
+        self.assertEqual(row_hash(row[:5]), row_hash(row[:5] + ["", None]))
+        self.assertNotEqual(row_hash(row), row_hash(row[:5]))
+        self.assertNotEqual(row_hash([MAY_2, "", 1]), row_hash([MAY_2, "", 2]))
+
+    def test_state_store(self):
+        """States are stored by spreadsheet and sheet."""
+        self.assertIsNone(self.state.get_sheet("document", "May"))
+        self.state.save("document", "May", HEADERS, 4, {2: "a", 3: "b"})
+        self.assertEqual(self.state.get_sheet("document", "May"), (HEADERS, 4))
+        self.assertEqual(self.state.get_hash("document", "May", 3), "b")
+        self.assertIsNone(self.state.get_hash("document", "June", 3))
+        self.state.reset("document", "May")
+        self.assertIsNone(self.state.get_sheet("document", "May"))
+
+    def test_watermark(self):
+        """The watermark is the last row of the processed rows at the top of the sheet.
+
+        Rows with an ignore action or without date are processed.
+        """
+        from haunts.spreadsheet import save_sync_state
+
+        values = self.sheet.rows[1:] + [["", "", 1]]
+        save_sync_state(self.state, "May", self.schema, {"values": values}, {4})
+        self.assertEqual(self.state.get_sheet("document", "May"), (HEADERS, 4))
+        save_sync_state(self.state, "May", self.schema, {"values": values}, {4, 6})
+        self.assertEqual(self.state.get_sheet("document", "May")[1], 4)
+        save_sync_state(self.state, "May", self.schema, {"values": values}, {4, 5, 6})
+        self.assertEqual(self.state.get_sheet("document", "May")[1], 7)
+
+    def test_changed_rows(self):
+        """Rows before the watermark are read again only when they may need a sync."""
+        from haunts.spreadsheet import get_month_changes, save_sync_state
+
+        schema, data = get_month_changes(self.sheet, "May", self.state)
+        self.assertEqual(data["values"], self.sheet.read("May!A2:ZZ"))
+        self.assertNotIn("skipped_rows", data)
+        # Row 4 synced, rows 5 and 6 failed
+        self.sheet.rows[3][8] = actions.IGNORE
+        save_sync_state(self.state, "May", schema, data, {4})
+        # Row 3 flagged to be deleted
+        self.sheet.rows[2][8] = actions.DELETE
+
+        self.sheet.ranges = []
+        schema, data = get_month_changes(self.sheet, "May", self.state)
+        self.assertEqual(data["skipped_rows"], {2})
+        self.assertEqual(data["values"], [[]] + self.sheet.read("May!A3:ZZ"))
+        self.assertEqual(
+            self.sheet.ranges,
+            ["May!A1:ZZ1", "May!A2:A3", "May!I2:I3", "May!A4:ZZ", "May!A3:ZZ3"],
+        )
+
+        # The watermark row changed: the whole sheet is read again
+        self.sheet.rows[3][4] = "Code review"
+        schema, data = get_month_changes(self.sheet, "May", self.state)
+        self.assertEqual(data["values"], self.sheet.read("May!A2:ZZ"))
+        self.assertNotIn("skipped_rows", data)
+
+
+class TestEntries(ProfileTestCase):
+    """Rows decoded into entries."""
+
+    def test_missing_columns(self):
+        """Columns not in the sheet are None, even when other columns follow known ones."""
+        from haunts.entries import EntryDecoder
+        from haunts.spreadsheet import SheetSchema
+
+        headers = [
+            "Date",
+            "Spent",
+            "Project",
+            "Activity",
+            "Event id",
+            "Link",
+            "Action",
+            "Billable",
+        ]
+        rows = [[MAY_2, 1, "Project A", "Coding", "", "", "", "yes"], [MAY_2, 2]]
+        decoder = EntryDecoder(SheetSchema(headers))
+        for entries in (
+            list(decoder.decode_rows(rows)),
+            list(
+                decoder.decode_columns(
+                    [[MAY_2, MAY_2], [1, 2], ["Project A"], ["Coding"], [], [], [], ["yes"]]
+                )
+            ),
+        ):
+            self.assertEqual([entry.details for entry in entries], [None, None])
+            self.assertEqual([entry.start for entry in entries], [None, None])
+            self.assertEqual([entry.action for entry in entries], ["", ""])
+            self.assertEqual([entry.spent for entry in entries], [1, 2])
+
+
+class TestReadEvents(ProfileTestCase):
+    """Lines of events read from calendars, written on the sheet."""
+
+    def test_insert_lines_sorted(self):
+        """New lines go after the last line with the same date or before, in their order."""
+        from haunts.spreadsheet import insert_lines_sorted
+
+        def line(serial, activity):
+            return [serial, "", 1, "Project A", activity]
+
+        sheet = FakeSheet(
+            [
+                HEADERS,
+                line(MAY_2, "May 2"),
+                line(MAY_2 + 2, "May 4"),
+                # Out of order
+                line(MAY_2 + 1, "May 3"),
+                line(MAY_2 + 2, "May 4 again"),
+            ]
+        )
+        lines = [
+            line(MAY_2 + 1, "New May 3"),
+            line(MAY_2 + 2, "New May 4"),
+            line(MAY_2, "New May 2"),
+            line(MAY_2 - 5, "New April 27"),
+            line(MAY_2 + 2, "Another new May 4"),
+        ]
+        sheet_dates = [row[0] for row in sheet.rows[1:]]
+        insert_lines_sorted(sheet, "May", [(values[0], values) for values in lines], sheet_dates)
+        self.assertEqual(
+            [row[4] for row in sheet.rows[1:]],
+            [
+                "New April 27",
+                "May 2",
+                "New May 2",
+                "May 4",
+                "May 3",
+                "New May 3",
+                "May 4 again",
+                "New May 4",
+                "Another new May 4",
+            ],
+        )
+        self.assertEqual(sheet.rows[2], line(MAY_2, "May 2"))
+
+
+class FakeEvents:
+    """Events resource of the Calendar API, listing pages of responses in order."""
+
+    def __init__(self, *pages):
+        self.pages = list(pages)
+        self.requests = []
+
+    def list(self, **params):
+        self.requests.append(params)
+        return FakeRequest("calendar.events.list", lambda: self.pages.pop(0))
+
+
+def event(event_id, day, status="confirmed"):
+    return {
+        "id": event_id,
+        "status": status,
+        "start": {"dateTime": f"2024-{day}T10:00:00+00:00"},
+        "end": {"dateTime": f"2024-{day}T11:00:00+00:00"},
+    }
+
+
+class TestWriteBuffer(ProfileTestCase):
+    """Cell writes sent in chunks of rows."""
+
+    def setUp(self):
+        super().setUp()
+        self.sheet = FakeSheet([HEADERS])
+        self.written = []
+
+    def buffer(self):
+        from haunts.spreadsheet import SheetWriteBuffer
+
+        return SheetWriteBuffer(self.sheet, "May", flush_every=2, on_written=self.written.append)
+
+    def test_failed_chunk(self):
+        """A chunk not written is kept, and sent again by the next flush."""
+        buffer = self.buffer()
+        buffer.update(2, {"A": "one"})
+        self.sheet.offline = True
+        with self.assertRaises(ConnectionError):
+            buffer.update(3, {"A": "two"})
+        self.assertEqual(len(buffer.pending), 2)
+        self.sheet.offline = False
+        buffer.update(4, {"A": "three"})
+        self.assertEqual(self.written, [[2, 3], [4]])
+        self.assertEqual(buffer.pending, [])
+        self.assertEqual([row[0] for row in self.sheet.rows[1:]], ["one", "two", "three"])
+
+    def test_error_in_block(self):
+        """Leaving the block for an error, a failed flush does not replace that error."""
+        with self.assertRaises(KeyError):
+            with self.buffer() as buffer:
+                buffer.update(2, {"A": "one"})
+                self.sheet.offline = True
+                raise KeyError("Project")
+        self.assertEqual(len(buffer.pending), 1)
+        # Without errors, flush failures are raised
+        with self.assertRaises(ConnectionError):
+            with self.buffer() as buffer:
+                buffer.update(2, {"A": "one"})
+
+
+class TestListEvents(ProfileTestCase):
+    """Events of a calendar in a range of dates, read directly from the API."""
+
+    def test_pages(self):
+        from haunts.download import list_events_between
+
+        events = FakeEvents(
+            {"items": [event("a", "05-02")], "nextPageToken": "page-2"},
+            {"items": [event("b", "05-03")], "nextPageToken": "page-3"},
+            {"items": [event("c", "05-03")]},
+        )
+        listed = list_events_between(
+            events, "calendar-a", datetime.date(2024, 5, 2), datetime.date(2024, 5, 3)
+        )
+        self.assertEqual([e["id"] for e in listed], ["a", "b", "c"])
+        self.assertEqual({e["calendar_id"] for e in listed}, {"calendar-a"})
+        self.assertEqual(
+            [request["pageToken"] for request in events.requests], [None, "page-2", "page-3"]
+        )
+        self.assertEqual(
+            {(request["timeMin"], request["timeMax"]) for request in events.requests},
+            {("2024-05-02T00:00:00+00:00", "2024-05-04T00:00:00+00:00")},
+        )
+
+
+class TestCalendarCache(ProfileTestCase):
+    """Local copies of calendars, listed once and then updated with incremental syncs."""
+
+    def read(self, events, from_day, to_day):
+        from haunts.calendar_cache import get_events_between
+
+        return [
+            e["id"]
+            for e in get_events_between(
+                self.config_dir,
+                events,
+                "calendar-a",
+                datetime.date.fromisoformat(from_day),
+                datetime.date.fromisoformat(to_day),
+            )
+        ]
+
+    def test_full_and_incremental_sync(self):
+        events = FakeEvents(
+            {"items": [event("a", "05-02")], "nextPageToken": "page-2"},
+            {"items": [event("b", "05-20")], "nextSyncToken": "sync-1"},
+            {
+                "items": [
+                    event("a", "05-02", status="cancelled"),
+                    event("c", "05-03"),
+                    # Out of the months held
+                    event("d", "09-01"),
+                ],
+                "nextSyncToken": "sync-2",
+            },
+        )
+        self.assertEqual(self.read(events, "2024-05-01", "2024-05-31"), ["a", "b"])
+        self.assertEqual(self.read(events, "2024-05-02", "2024-05-03"), ["c"])
+        full, next_page, incremental = events.requests
+        # The full listing is bounded, as recurring events are expanded
+        self.assertEqual(
+            (full["timeMin"], full["timeMax"]),
+            ("2024-05-01T00:00:00+00:00", "2024-06-01T00:00:00+00:00"),
+        )
+        self.assertEqual(next_page["pageToken"], "page-2")
+        self.assertEqual(incremental["syncToken"], "sync-1")
+        self.assertNotIn("timeMin", incremental)
+        cache_files = list((self.config_dir / "calendar-cache").iterdir())
+        self.assertEqual([path.suffix for path in cache_files], [".json"])
+        data = json.loads(cache_files[0].read_text())
+        self.assertEqual(sorted(data["events"]), ["b", "c"])
+        self.assertEqual(data["sync_token"], "sync-2")
+
+    def test_range_grows(self):
+        """Reading a month not held lists again all the months, up to it."""
+        events = FakeEvents(
+            {"items": [event("a", "05-02")], "nextSyncToken": "sync-1"},
+            {"items": [event("a", "05-02"), event("b", "06-03")], "nextSyncToken": "sync-2"},
+        )
+        self.read(events, "2024-05-02", "2024-05-02")
+        self.assertEqual(self.read(events, "2024-06-01", "2024-06-30"), ["b"])
+        self.assertEqual(
+            (events.requests[1]["timeMin"], events.requests[1]["timeMax"]),
+            ("2024-05-01T00:00:00+00:00", "2024-07-01T00:00:00+00:00"),
+        )
+
+
+def batch_response(*parts):
+    """Multipart response of a batch request.
+
+    Every part is the (status, JSON body) of a request, optionally followed by more headers.
+    """
+    content = "".join(
+        "--batch\r\nContent-Type: application/http\r\n"
+        f"Content-ID: <response-batch + {request_id}>\r\n\r\n"
+        f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+        + "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        + f"\r\n{body}\r\n"
+        for request_id, (status, body, *more) in enumerate(parts)
+        for headers in [more[0] if more else {}]
+    )
+    return {"status": "200", "content-type": "multipart/mixed; boundary=batch"}, (
+        content + "--batch--"
+    )
+
+
+def error_body(status, reason="backendError"):
+    return json.dumps(
+        {"error": {"code": status, "message": reason, "errors": [{"reason": reason}]}}
+    )
+
+
+class TestCalendarBatch(ProfileTestCase):
+    """Calendar operations sent as batch requests."""
+
+    def setUp(self):
+        super().setUp()
+        self.patch("click.echo")
+        self.sleep = self.patch("haunts.api.time.sleep")
+        self.results = {}
+
+    def run_batch(self, responses, size=None):
+        """Insert events at keys 2 and 3, delete events at keys 4 and 5."""
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        from googleapiclient.http import HttpMockSequence
+
+        from haunts.calendars import CalendarBatch
+
+        http = HttpMockSequence(responses)
+        service = build_from_document(json.loads(get_static_doc("calendar", "v3")), http=http)
+        self.patch("haunts.calendars.get_calendar_service", return_value=service)
+
+        def callback(key, response, error):
+            self.results[key] = error.status_code if error is not None else response
+
+        with CalendarBatch(self.config_dir, size=size, workers=1) as batch:
+            batch.insert(2, "calendar-a", {"summary": "Planning"}, callback)
+            batch.insert(3, "calendar-a", {"summary": "Coding"}, callback)
+            batch.delete(4, "calendar-a", "missing", callback)
+            batch.delete(5, "calendar-a", "ev5", callback)
+        return http.request_sequence
+
+    def test_results_by_key(self):
+        """Every response goes to the callback of its operation, errors included."""
+        requests = self.run_batch(
+            [
+                batch_response(
+                    (200, '{"id": "ev2"}'),
+                    (200, '{"id": "ev3"}'),
+                    (404, error_body(404, "notFound")),
+                    (204, ""),
+                )
+            ]
+        )
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(self.results, {2: {"id": "ev2"}, 3: {"id": "ev3"}, 4: 404, 5: ""})
+
+    def test_retry(self):
+        """Only operations failed with a temporary error are sent again, after a pause."""
+        requests = self.run_batch(
+            [
+                batch_response(
+                    (200, '{"id": "ev2"}'),
+                    (429, error_body(429, "rateLimitExceeded")),
+                    (400, error_body(400, "badRequest")),
+                    (503, error_body(503)),
+                ),
+                batch_response((200, '{"id": "ev3"}'), (204, "")),
+            ]
+        )
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[1][2].count("Content-ID"), 2)
+        self.assertIn('"summary": "Coding"', requests[1][2])
+        self.assertIn("/events/ev5", requests[1][2])
+        self.assertEqual(self.results, {2: {"id": "ev2"}, 3: {"id": "ev3"}, 4: 400, 5: ""})
+        self.assertEqual(self.sleep.call_count, 1)
+
+    def test_retry_after(self):
+        """The pause before retrying a batch is the longest one asked."""
+        self.run_batch(
+            [
+                batch_response(
+                    (200, '{"id": "ev2"}'),
+                    (429, error_body(429, "rateLimitExceeded"), {"Retry-After": "3"}),
+                    (429, error_body(429, "rateLimitExceeded"), {"Retry-After": "10"}),
+                    (503, error_body(503), {"Retry-After": "2"}),
+                ),
+                batch_response((200, '{"id": "ev3"}'), (204, ""), (204, "")),
+            ]
+        )
+        self.sleep.assert_called_once_with(10.0)
+        self.assertEqual(self.results, {2: {"id": "ev2"}, 3: {"id": "ev3"}, 4: "", 5: ""})
+
+    def test_batch_size(self):
+        """Operations are sent in batches of CALENDAR_BATCH_SIZE at most."""
+        requests = self.run_batch(
+            [
+                batch_response((200, '{"id": "ev2"}'), (200, '{"id": "ev3"}')),
+                batch_response((204, ""), (204, "")),
+            ],
+            size=2,
+        )
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(self.results, {2: {"id": "ev2"}, 3: {"id": "ev3"}, 4: "", 5: ""})
+
+
+def batch_requests(body):
+    """Method, path and JSON body (None if empty) of every request in a batch request."""
+    return [
+        (
+            method,
+            path.split("?")[0].replace("/calendar/v3/calendars/", ""),
+            json.loads(content or "null"),
+        )
+        for method, path, content in re.findall(
+            r"^(\w+) (\S+) HTTP/1.1$.*?^\r?$\n(.*?)\r?\n--", body, re.M | re.S
+        )
+    ]
+
+
+class TestReconcile(ProfileTestCase):
+    """Events compared with their rows, then moved or patched only when something changed."""
+
+    def setUp(self):
+        super().setUp()
+        from haunts.spreadsheet import SheetSchema
+
+        self.schema = SheetSchema(HEADERS)
+        self.echo = self.patch("click.echo")
+
+    def entry(self, start="10:00", spent=1, project="Project A", activity="Planning", details=""):
+        from haunts.entries import EntryDecoder
+
+        values = [MAY_2, start, spent, project, activity, details, "ev1", "", actions.IGNORE]
+        return next(EntryDecoder(self.schema).decode_rows([values]))
+
+    def event(self, event_id="ev1", start="10:00", end="11:00", summary="Planning", **fields):
+        return {
+            "id": event_id,
+            "summary": summary,
+            "start": {"dateTime": f"2024-05-02T{start}:00+00:00"},
+            "end": {"dateTime": f"2024-05-02T{end}:00+00:00"},
+            "htmlLink": f"https://calendar.example.com/{event_id}",
+            **fields,
+        }
+
+    def test_event_changes(self):
+        """Patches only hold the fields that changed."""
+        from haunts.reconcile import event_changes
+
+        self.assertEqual(event_changes(self.entry(), self.event()), {})
+        self.assertEqual(event_changes(self.entry(details=""), self.event(description="")), {})
+        # Rows without a start time keep the one of their event
+        self.assertEqual(event_changes(self.entry(start=""), self.event()), {})
+        self.assertEqual(
+            event_changes(self.entry(activity="Coding"), self.event()), {"summary": "Coding"}
+        )
+        self.assertEqual(
+            event_changes(self.entry(details="Notes"), self.event()), {"description": "Notes"}
+        )
+        times = {
+            "start": {"dateTime": "2024-05-02T10:00:00", "date": None, "timeZone": "Etc/GMT"},
+            "end": {"dateTime": "2024-05-02T12:00:00", "date": None, "timeZone": "Etc/GMT"},
+        }
+        self.assertEqual(event_changes(self.entry(spent=2), self.event()), times)
+        times["start"]["dateTime"] = "2024-05-02T11:00:00"
+        times["end"]["dateTime"] = "2024-05-02T12:00:00"
+        self.assertEqual(event_changes(self.entry(start="11:00"), self.event()), times)
+        self.assertEqual(
+            event_changes(self.entry(spent=""), self.event()),
+            {
+                "start": {"date": "2024-05-02", "dateTime": None, "timeZone": "Etc/GMT"},
+                "end": {"date": "2024-05-03", "dateTime": None, "timeZone": "Etc/GMT"},
+            },
+        )
+
+    def test_reconcile(self):
+        """Events of another project are moved (and linked again), changed ones patched."""
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        from googleapiclient.http import HttpMockSequence
+
+        from haunts.reconcile import reconcile_events
+
+        def row(event_id, project="Project A", activity="Planning", spent=1):
+            return [MAY_2, "10:00", spent, project, activity, "", event_id, "", actions.IGNORE]
+
+        values = [
+            row("ev1"),
+            row("ev2", project="Project B"),
+            row("ev3", activity="Coding"),
+            row("ev4", spent=2),
+            # Not synced
+            [MAY_2, "10:00", 1, "Project A", "Lunch", "", "ev5", "", ""],
+        ]
+        sheet = FakeSheet([HEADERS, *values])
+        events = [self.event(event_id) for event_id in ("ev1", "ev2", "ev3", "ev4", "ev5")]
+        self.patch("haunts.reconcile.get_sheet_service", return_value=sheet)
+        self.patch("haunts.reconcile.get_month", return_value=(self.schema, {"values": values}))
+        self.patch(
+            "haunts.reconcile.get_calendars",
+            return_value={"Project A": "calendar-a", "Project B": "calendar-b"},
+        )
+        self.patch(
+            "haunts.reconcile.get_calendars_events_between",
+            return_value=[[{**event, "calendar_id": "calendar-a"} for event in events], []],
+        )
+        moved = self.event("ev2", htmlLink="https://calendar.example.com/moved")
+        http = HttpMockSequence(
+            [
+                batch_response((200, json.dumps(moved))),
+                batch_response((200, json.dumps(events[2])), (200, json.dumps(events[3]))),
+            ]
+        )
+        service = build_from_document(json.loads(get_static_doc("calendar", "v3")), http=http)
+        self.patch("haunts.calendars.get_calendar_service", return_value=service)
+
+        reconcile_events(self.config_dir, "May")
+
+        moves, patches = [batch_requests(request[2]) for request in http.request_sequence]
+        self.assertEqual(moves, [("POST", "calendar-a/events/ev2/move", None)])
+        self.assertEqual(
+            patches,
+            [
+                ("PATCH", "calendar-a/events/ev3", {"summary": "Coding"}),
+                (
+                    "PATCH",
+                    "calendar-a/events/ev4",
+                    {
+                        "start": {
+                            "dateTime": "2024-05-02T10:00:00",
+                            "date": None,
+                            "timeZone": "Etc/GMT",
+                        },
+                        "end": {
+                            "dateTime": "2024-05-02T12:00:00",
+                            "date": None,
+                            "timeZone": "Etc/GMT",
+                        },
+                    },
+                ),
+            ],
+        )
+        self.assertEqual(
+            sheet.cells, {"May!H3": '=HYPERLINK("https://calendar.example.com/moved";"open")'}
+        )
+        self.assertIn("4 synced rows checked: 1 events to move and 2 to update", self.output())
+
+
+class FailingRequest:
+    """Request failing with the given errors, then succeeding."""
+
+    methodId = "test.request"
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+def api_error(status, reason=None, headers=None):
+    content = {
+        "error": {
+            "code": status,
+            "message": reason or "Error",
+            "errors": [{"reason": reason}] if reason else [],
+        }
+    }
+    return HttpError(
+        httplib2.Response({"status": str(status), **(headers or {})}),
+        json.dumps(content).encode(),
+    )
+
+
+class TestApi(ProfileTestCase):
+    """Execution of requests, retried and paced on quotas."""
+
+    settings = "API_MAX_RETRIES=3\n"
+
+    def setUp(self):
+        super().setUp()
+        self.patch("click.echo")
+        self.sleep = self.patch("haunts.api.time.sleep")
+        self.patch("haunts.api.random.random", return_value=0.5)
+
+    def test_backoff(self):
+        """Temporary errors and rate limits are retried with an exponential backoff."""
+        from haunts.api import SHEETS_READ, execute
+
+        request = FailingRequest(
+            api_error(429),
+            api_error(503),
+            api_error(403, "rateLimitExceeded"),
+        )
+        self.assertEqual(execute(request, SHEETS_READ), "done")
+        self.assertEqual(request.calls, 4)
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [1.5, 2.5, 4.5])
+
+    def test_not_retried(self):
+        """Other errors are raised at once."""
+        from haunts.api import SHEETS_READ, execute
+
+        for error in (api_error(404), api_error(403, "forbidden"), api_error(400)):
+            request = FailingRequest(error)
+            with self.assertRaises(HttpError):
+                execute(request, SHEETS_READ)
+            self.assertEqual(request.calls, 1)
+        self.sleep.assert_not_called()
+
+    def test_retry_after(self):
+        """Retry-After is honored, in seconds or as a date."""
+        from haunts.api import SHEETS_READ, execute
+
+        retry_date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        request = FailingRequest(
+            api_error(429, headers={"retry-after": "7"}),
+            api_error(503, headers={"retry-after": retry_date}),
+        )
+        self.assertEqual(execute(request, SHEETS_READ), "done")
+        self.assertEqual(self.sleep.call_args_list[0].args[0], 7.0)
+        self.assertAlmostEqual(self.sleep.call_args_list[1].args[0], 30, delta=2)
+
+    def test_give_up(self):
+        """Requests are retried API_MAX_RETRIES times at most."""
+        from haunts.api import SHEETS_READ, execute
+
+        request = FailingRequest(*[api_error(500) for _ in range(10)])
+        with self.assertRaises(HttpError):
+            execute(request, SHEETS_READ)
+        self.assertEqual(request.calls, 4)
+        self.assertEqual(self.sleep.call_count, 3)
+
+    def test_token_bucket(self):
+        """Tokens are refilled continuously, up to the bucket capacity."""
+        from haunts.api import TokenBucket
+
+        clock = [1000.0]
+        self.patch("haunts.api.time.monotonic", side_effect=lambda: clock[0])
+        self.sleep.side_effect = lambda delay: clock.__setitem__(0, clock[0] + delay)
+        bucket = TokenBucket(60)
+        self.assertEqual(sum(bucket.acquire() for _ in range(60)), 0)
+        # Empty bucket: one token a second
+        self.assertAlmostEqual(bucket.acquire(), 1.0)
+        self.assertAlmostEqual(bucket.acquire(5), 5.0)
+        clock[0] += 10
+        self.assertEqual(sum(bucket.acquire() for _ in range(10)), 0)
+        self.assertGreater(bucket.acquire(), 0)
+        # Never more tokens than the capacity
+        clock[0] += 3600
+        self.assertEqual(sum(bucket.acquire() for _ in range(60)), 0)
+        self.assertGreater(bucket.acquire(), 0)
+
+
+class TestCredentials(ProfileTestCase):
+    """Tokens shared by threads, refreshed once and ahead of their expiration."""
+
+    settings = "COMBINED_TOKEN=true\n"
+
+    def credentials(self, expiry, scopes=("calendar",)):
+        from haunts.credentials import SharedCredentials
+
+        return SharedCredentials(
+            token="token-1",
+            refresh_token="refresh",
+            token_uri="https://oauth2.example.com/token",
+            client_id="client",
+            client_secret="secret",
+            scopes=list(scopes),
+            expiry=expiry,
+        )
+
+    def test_single_refresh(self):
+        """Threads waiting for a refresh use the new token."""
+        from haunts.credentials import utcnow
+
+        creds = self.credentials(utcnow())
+        schedule = self.patch("haunts.credentials.SharedCredentials.schedule_refresh")
+        refreshed = []
+
+        def refresh(self, request):
+            time.sleep(0.05)
+            refreshed.append(request)
+            self.token = f"token-{len(refreshed) + 1}"
+            self.expiry = utcnow() + datetime.timedelta(hours=1)
+
+        self.patch("google.oauth2.credentials.Credentials.refresh", refresh)
+        threads = [threading.Thread(target=creds.refresh, args=(None,)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(refreshed), 1)
+        self.assertEqual(creds.token, "token-2")
+        schedule.assert_called_once_with()
+        # An old token is invalidated only if it's still in use
+        creds.invalidate("Bearer token-1")
+        self.assertFalse(creds.expiring())
+        creds.invalidate("Bearer token-2")
+        self.assertTrue(creds.expiring())
+
+    def test_refresh_timer(self):
+        from haunts.credentials import REFRESH_MARGIN, utcnow
+
+        timer = self.patch("haunts.credentials.threading.Timer")
+        creds = self.credentials(utcnow() + REFRESH_MARGIN + datetime.timedelta(minutes=10))
+        creds.schedule_refresh()
+        delay, callback = timer.call_args.args
+        self.assertAlmostEqual(delay, 600, delta=5)
+        self.assertEqual(callback, creds.refresh_ahead)
+        self.assertTrue(timer.return_value.daemon)
+        timer.return_value.start.assert_called_once_with()
+        # A new schedule replaces the previous timer
+        creds.schedule_refresh()
+        timer.return_value.cancel.assert_called_once_with()
+        # Expired tokens are refreshed at once, failures are left to the next use
+        creds.expiry = utcnow() - datetime.timedelta(hours=1)
+        creds.schedule_refresh()
+        self.assertEqual(timer.call_args.args[0], 0)
+        self.patch(
+            "google.oauth2.credentials.Credentials.refresh", side_effect=ConnectionError("offline")
+        )
+        creds.refresh_ahead()
+        self.assertTrue(creds.expiring())
+
+    def test_combined_token_scopes(self):
+        """A combined token not covering new scopes is replaced, logging in again."""
+        from haunts.credentials import get_credentials, utcnow
+
+        self.patch("haunts.credentials.SharedCredentials.schedule_refresh")
+        loaded = self.credentials(utcnow() + datetime.timedelta(hours=1))
+        loaded.token_path = self.config_dir / "token.json"
+        authorized = self.credentials(
+            utcnow() + datetime.timedelta(hours=1), scopes=("calendar", "sheets")
+        )
+        load = self.patch("haunts.credentials.load_credentials", return_value=loaded)
+        authorize = self.patch("haunts.credentials.authorize", return_value=authorized)
+
+        def calendar_credentials():
+            return get_credentials(self.config_dir, ["calendar"], "calendars-token.json")
+
+        self.assertIs(calendar_credentials(), loaded)
+        self.assertIs(calendar_credentials(), loaded)
+        load.return_value = None
+        self.assertIs(get_credentials(self.config_dir, ["sheets"], "sheets-token.json"), authorized)
+        authorize.assert_called_once_with(self.config_dir, ["calendar", "sheets"], "token.json")
+        # The replaced token is not saved over the new one
+        self.assertIsNone(loaded.token_path)
+        self.assertIs(calendar_credentials(), authorized)
+
+
+class TestMetrics(unittest.TestCase):
+    """Requests, errors, retries, latency and bytes counted by endpoint."""
+
+    def setUp(self):
+        from haunts.metrics import Metrics
+
+        self.clock = [100.0]
+        patcher = mock.patch("haunts.metrics.time.monotonic", side_effect=lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.metrics = Metrics()
+
+    def request(self, endpoint, latency, error=None, sent=0, received=0):
+        with self.metrics.request(endpoint):
+            self.clock[0] += latency
+            if sent or received:
+                self.metrics.add_bytes(sent, received)
+            if error:
+                raise error
+
+    def test_endpoints(self):
+        self.request("sheets.values.batchGet", 0.02, sent=100, received=2048)
+        self.request("sheets.values.batchGet", 0.3)
+        with self.assertRaises(ConnectionError):
+            self.request("calendar.batch", 12, error=ConnectionError())
+        self.metrics.add_retry("calendar.batch", 1.5, count=3)
+        self.metrics.add_quota_wait("sheets.values.batchGet", 0.25)
+        # Bytes sent out of a request
+        self.metrics.add_bytes(10, 20)
+        self.clock[0] += 1
+        data = self.metrics.to_dict()
+        self.assertEqual(
+            sorted(data["endpoints"]), ["calendar.batch", "other", "sheets.values.batchGet"]
+        )
+        sheets = data["endpoints"]["sheets.values.batchGet"]
+        self.assertEqual((sheets["requests"], sheets["errors"]), (2, 0))
+        self.assertEqual((sheets["bytes_sent"], sheets["bytes_received"]), (100, 2048))
+        self.assertEqual(sheets["latency_max"], 0.3)
+        self.assertEqual(sheets["quota_wait"], 0.25)
+        calendar = data["endpoints"]["calendar.batch"]
+        self.assertEqual((calendar["requests"], calendar["errors"]), (1, 1))
+        self.assertEqual((calendar["retries"], calendar["backoff"]), (3, 1.5))
+        self.assertEqual(
+            data["totals"],
+            {
+                "requests": 3,
+                "errors": 1,
+                "retries": 3,
+                "bytes_sent": 110,
+                "bytes_received": 2068,
+                "backoff": 1.5,
+                "quota_wait": 0.25,
+            },
+        )
+        self.assertAlmostEqual(data["elapsed"], 13.32)
+
+    def test_histogram(self):
+        """Latencies go in the first bucket they fit in, the last one being unbounded."""
+        for latency in (0.02, 0.026, 0.1, 0.1, 3, 11):
+            self.request("sheets.get", latency)
+        stats = self.metrics.endpoints["sheets.get"]
+        histogram = stats.to_dict()["latency_histogram"]
+        self.assertEqual(
+            {bucket: count for bucket, count in histogram.items() if count},
+            {"le_25ms": 1, "le_50ms": 1, "le_100ms": 2, "le_5000ms": 1, "le_inf": 1},
+        )
+        self.assertEqual(sum(histogram.values()), 6)
+        self.assertEqual(stats.percentile(50), 100)
+        self.assertEqual(stats.percentile(80), 5000)
+        # Beyond the last bound
+        self.assertIsNone(stats.percentile(100))
+
+    def test_save(self):
+        self.request("drive.files.get", 0.2, sent=5, received=7)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "metrics.json"
+            self.metrics.save(path)
+            data = json.loads(path.read_text())
+        self.assertEqual(data, json.loads(json.dumps(self.metrics.to_dict())))
+        self.assertEqual(data["endpoints"]["drive.files.get"]["latency_histogram"]["le_250ms"], 1)
+        self.assertEqual(data["totals"]["bytes_received"], 7)
+
+
+class TestSessionHttp(ProfileTestCase):
+    """API requests sent through the shared session, with the httplib2 interface."""
+
+    def setUp(self):
+        super().setUp()
+        from haunts.metrics import metrics
+
+        self.metrics = metrics
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.credentials = mock.Mock()
+        self.credentials.token = "token-1"
+
+        def apply(headers):
+            headers["authorization"] = f"Bearer {self.credentials.token}"
+
+        self.credentials.before_request.side_effect = lambda request, method, uri, headers: apply(
+            headers
+        )
+        self.credentials.apply.side_effect = apply
+        self.session = mock.Mock()
+
+    def response(self, status, content=b""):
+        response = mock.Mock(status_code=status, content=content, reason="OK")
+        response.headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+        return response
+
+    def request(self, *responses):
+        from haunts.transport import SessionHttp
+
+        responses = list(responses)
+        self.sent = []
+
+        def send(method, uri, headers, **options):
+            self.sent.append(dict(headers))
+            return responses.pop(0)
+
+        self.session.request.side_effect = send
+        http = SessionHttp(self.credentials, session=self.session, timeout=5)
+        with self.metrics.request("sheets.get"):
+            return http.request("https://sheets.example.com/v4", "POST", body='{"a": 1}')
+
+    def test_response(self):
+        resp, content = self.request(self.response(200, b'{"ok": true}'))
+        self.assertEqual((resp.status, content), (200, b'{"ok": true}'))
+        self.assertEqual(resp["content-type"], "application/json")
+        # Content is decompressed by requests
+        self.assertNotIn("content-encoding", resp)
+        self.session.request.assert_called_once_with(
+            "POST",
+            "https://sheets.example.com/v4",
+            data='{"a": 1}',
+            headers={"authorization": "Bearer token-1"},
+            timeout=5,
+        )
+        stats = self.metrics.endpoints["sheets.get"]
+        self.assertEqual((stats.bytes_sent, stats.bytes_received), (8, 12))
+        self.credentials.refresh.assert_not_called()
+
+    def test_unauthorized(self):
+        """A rejected token is invalidated and refreshed, then the request is sent once more."""
+
+        def refresh(request):
+            self.credentials.token = "token-2"
+
+        self.credentials.refresh.side_effect = refresh
+        resp, content = self.request(self.response(401, b"denied"), self.response(200, b"{}"))
+        self.assertEqual((resp.status, content), (200, b"{}"))
+        self.credentials.invalidate.assert_called_once_with("Bearer token-1")
+        self.credentials.refresh.assert_called_once()
+        self.assertEqual(
+            self.sent, [{"authorization": "Bearer token-1"}, {"authorization": "Bearer token-2"}]
+        )
+        # Bytes of both attempts are counted
+        stats = self.metrics.endpoints["sheets.get"]
+        self.assertEqual((stats.bytes_sent, stats.bytes_received), (16, 8))
+
+    def test_unauthorized_again(self):
+        """The request is retried only once."""
+        resp, content = self.request(self.response(401), self.response(401, b"denied"))
+        self.assertEqual((resp.status, content), (401, b"denied"))
+        self.assertEqual(self.session.request.call_count, 2)